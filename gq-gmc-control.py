@@ -20,9 +20,12 @@ import sys
 import os
 import argparse
 import platform
-import tempfile
 import datetime
 import gq_gmc
+import gq_gmc_recorder
+import gq_gmc_exporter
+import gq_gmc_rollup
+import gq_gmc_archive
 
 VERSION = '1.1.0'
 
@@ -62,6 +65,57 @@ def handle_arguments():
         action='store_true', default=None,
         help="do not parse the history data into a csv file, only store the binary data. "
              + "use only in combination with the '--data' command option.")
+    parser.add_argument('-y', '--sync',
+        action='store_true', default=None,
+        help="only download the history data written since the previous download, and update the binary file "
+             + "of the previous download (default '{}'). use only in combination with the '--data' command option."
+             .format(gq_gmc.DEFAULT_BIN_FILE))
+    parser.add_argument('-j', '--resume',
+        action='store_true', default=None,
+        help="store a checkpoint next to the csv file, and only add the rows of the new data when the binary file "
+             + "is parsed again (e.g. after '--data --sync'). use only in combination with the '--data' or "
+             + "'--only-parse' command options.")
+    parser.add_argument('-D', '--full-dump',
+        action='store_true', default=None,
+        help="download the complete flash, also when the rest of the flash is erased (by default the download "
+             + "stops at the first erased page after the history data). use only in combination with the "
+             + "'--data' command option.")
+    parser.add_argument('-f', '--format',
+        action='store', default=None, choices=gq_gmc.OUTPUT_FORMATS, dest='output_format',
+        help="the format of the parsed history data (default '{}'). the 'parquet' and 'arrow' formats require "
+             .format(gq_gmc.DEFAULT_OUTPUT_FORMAT)
+             + "numpy and pyarrow, the 'npz' format requires numpy. use only in combination with the '--data' or "
+             + "'--only-parse' command options.")
+    parser.add_argument('-g', '--rollup',
+        action='store', default=None, choices=sorted(gq_gmc_rollup.LEVELS.keys(), key=gq_gmc_rollup.LEVELS.get),
+        help="store the number of samples, mean, minimum, maximum and dose per minute, hour or day in the csv "
+             + "file, instead of every sample. the rollups are kept next to the binary file, and only updated with "
+             + "the data added since the previous run. use only in combination with the '--data' or "
+             + "'--only-parse' command options.")
+    parser.add_argument('-W', '--archive',
+        nargs='?', type=str, default=None, const='', dest='archive_dir', metavar='DIR',
+        help="store the binary file in an archive (default '{}'), in which every 4 KByte page is stored once, "
+             .format(gq_gmc_archive.DEFAULT_ARCHIVE_DIR)
+             + "and the dump as a manifest of pages. a manifest can be parsed with '--only-parse'. use only in "
+             + "combination with the '--data' or '--only-parse' command options.")
+    parser.add_argument('-U', '--socket',
+        action='store', default=None,
+        help="the unix socket of the daemon (default '{}'). when a daemon is running for the port, the commands "
+             .format(gq_gmc.DEFAULT_SOCKET)
+             + "are send to the daemon instead of opening the port. use an empty string to not use the daemon.")
+    parser.add_argument('-X', '--no-cache',
+        action='store_true', default=None,
+        help="don't use (or update) the cached device type and configuration of the device. the cache is stored "
+             + "per serial number in '{}'.".format(gq_gmc.DEFAULT_STATE_DIR))
+    parser.add_argument('-t', '--poll-interval',
+        action='store', default=None, type=float, metavar='SECONDS',
+        help="the interval between reading the device by '--metrics' (default {:.0f} seconds)."
+             .format(gq_gmc_exporter.DEFAULT_POLL_INTERVAL))
+    parser.add_argument('-I', '--stats',
+        nargs='?', type=str, default=None, const='', metavar='JSON_FILE',
+        help="show the statistics of the serial traffic when done: the number of commands, bytes, reads, short "
+             + "reads, timeouts and retries, and the read latencies per command. the statistics are stored in a "
+             + "JSON file, if provided.")
     parser.add_argument('-c', '--config',
         action='store', default=None,
         help='load command line options from a configuration file')
@@ -114,6 +168,19 @@ def handle_arguments():
     command_group.add_argument('-A', '--heartbeat-off',
         action='store_true', default=None,
         help="disable the heartbeat (should normally not be needed when using the '--heartbeat' command)")
+    command_group.add_argument('-H', '--record',
+        nargs='?', type=str, dest='record_file', const='',
+        help="record the heartbeat (the CPS of every second) to a csv file (default '{}') until CTRL-C is "
+             .format(gq_gmc_recorder.DEFAULT_RECORD_FILE)
+             + "pressed. every minute the samples are appended to the file, and the CPM of the last minute and the "
+             + "average of the last hour are shown. files ending with '.db', '.sqlite' or '.sqlite3' are stored as a "
+             + "SQLite database")
+    command_group.add_argument('-m', '--metrics',
+        nargs='?', type=str, dest='metrics_address', const='', metavar='[HOST]:PORT',
+        help="serve the CPM, CPS, voltage, temperature and gyroscopic data as Prometheus metrics on "
+             + "'http://[HOST]:PORT/metrics' (default '{}') until CTRL-C is pressed. the device is read every "
+             .format(gq_gmc_exporter.DEFAULT_METRICS_ADDRESS)
+             + "'--poll-interval' seconds, scrapes are served from memory.")
     command_group.add_argument('-V', '--voltage',
         action='store_true', default=None,
         help='get the current voltage of the battery (or power supply)')
@@ -138,6 +205,18 @@ def handle_arguments():
              + "can be used in combination with the '--data' option to create a csv file with a different file-name, "
              + "and the '--output-in-usievert',  '--unit-conversion-from-device' and/or '--output-in-cpm' options"
              .format(gq_gmc.DEFAULT_CSV_FILE))
+    command_group.add_argument('-N', '--pool',
+        action='store', default=None, nargs='+', metavar='PORT',
+        help="read the CPM and download the history data of multiple devices in parallel. the history data of "
+             + "every device is stored in a binary file named after its serial number ('{}'), the time needed "
+             .format(gq_gmc.DEFAULT_POOL_BIN_FILE)
+             + "for every step is shown per device.")
+    command_group.add_argument('-Z', '--daemon',
+        action='store_true', default=None,
+        help="keep the port open, and execute the commands of other invocations of this tool (received on the "
+             + "'--socket' unix socket), until stopped with CTRL-C. the device type and configuration are only "
+             + "read once, and the heartbeat can be followed while other commands are executed (Linux and OS X "
+             + "only).")
     command_group.add_argument('-l', '--list-config',
         action='store_true', default=None,
         help='shows the current device configuration')
@@ -184,12 +263,39 @@ def valid_date_time(s):
         raise argparse.ArgumentTypeError(msg)
 
 
+def parse_data_file(bin_file, output_file, output_format, cpm_to_usievert, rollup=None, resume=False):
+    if bin_file.endswith(gq_gmc_archive.MANIFEST_SUFFIX):
+        return gq_gmc_archive.parse_manifest(bin_file, output_file, output_format, cpm_to_usievert)
+
+    if rollup is not None:
+        return gq_gmc_rollup.write_rollup(bin_file, output_file, rollup, cpm_to_usievert=cpm_to_usievert)
+
+    if output_format == 'csv':
+        gq_gmc.parse_data_file_fast(bin_file, output_file, cpm_to_usievert=cpm_to_usievert, resume=resume)
+        return 0
+
+    import gq_gmc_columns
+    return gq_gmc_columns.parse_data_file(bin_file, output_file, output_format,
+                                          cpm_to_usievert=cpm_to_usievert)
+
+
 def main():
     baud_rate = gq_gmc.DEFAULT_BAUD_RATE
     port = gq_gmc.DEFAULT_PORT
     bin_file = gq_gmc.DEFAULT_BIN_FILE
     output_file = gq_gmc.DEFAULT_CSV_FILE
     no_parse = gq_gmc.DEFAULT_NO_PARSE
+    sync = gq_gmc.DEFAULT_SYNC
+    resume = gq_gmc.DEFAULT_RESUME
+    full_dump = gq_gmc.DEFAULT_FULL_DUMP
+    output_format = gq_gmc.DEFAULT_OUTPUT_FORMAT
+    rollup = None
+    archive_dir = gq_gmc_archive.DEFAULT_ARCHIVE_DIR
+    socket = gq_gmc.DEFAULT_SOCKET
+    record_file = gq_gmc_recorder.DEFAULT_RECORD_FILE
+    metrics_address = gq_gmc_exporter.DEFAULT_METRICS_ADDRESS
+    poll_interval = gq_gmc_exporter.DEFAULT_POLL_INTERVAL
+    use_cache = gq_gmc.DEFAULT_USE_CACHE
     output_in_usievert = gq_gmc.DEFAULT_CPM_TO_SIEVERT
     output_in_cpm = gq_gmc.DEFAULT_OUTPUT_IN_CPM
     skip_check = gq_gmc.DEFAULT_SKIP_CHECK
@@ -215,10 +321,36 @@ def main():
         port = args.port
     if args.bin_file is not None and args.bin_file != '':
         bin_file = args.bin_file
+    if args.output_format is not None:
+        output_format = args.output_format
     if args.output_file is not None:
         output_file = args.output_file
+    elif output_format != 'csv':
+        import gq_gmc_columns
+        output_file = os.path.splitext(gq_gmc.DEFAULT_CSV_FILE)[0] + \
+            gq_gmc_columns.FORMATS.get(output_format, '.' + output_format)
     if args.no_parse is not None:
         no_parse = args.no_parse
+    if args.sync is not None:
+        sync = args.sync
+    if args.resume is not None:
+        resume = args.resume
+    if args.full_dump is not None:
+        full_dump = args.full_dump
+    if args.rollup is not None:
+        rollup = args.rollup
+    if args.archive_dir is not None and args.archive_dir != '':
+        archive_dir = args.archive_dir
+    if args.socket is not None:
+        socket = args.socket
+    if args.record_file is not None and args.record_file != '':
+        record_file = args.record_file
+    if args.metrics_address is not None and args.metrics_address != '':
+        metrics_address = args.metrics_address
+    if args.poll_interval is not None:
+        poll_interval = args.poll_interval
+    if args.no_cache is not None:
+        use_cache = not args.no_cache
     if args.output_in_usievert is not None and args.output_in_usievert != '':
         output_in_usievert = args.output_in_usievert
     if args.output_in_cpm is not None:
@@ -249,6 +381,52 @@ def main():
         print("ERROR: the '--no-parse' option can only be used with the '--data' option.")
         sys.exit(-1)
 
+    if args.sync is not None and not args.data:
+        print("ERROR: the '--sync' option can only be used with the '--data' option.")
+        sys.exit(-1)
+
+    if args.resume is not None and not args.data and args.bin_file is None:
+        print("ERROR: the '--resume' option can only be used with the '--data' or '--only-parse' options.")
+        sys.exit(-1)
+
+    if resume and (no_parse or rollup is not None or output_format != 'csv'):
+        print("ERROR: the '--resume' option can not be combined with the '--no-parse', '--rollup' or '--format' "
+              "options.")
+        sys.exit(-1)
+
+    if args.full_dump is not None and not args.data:
+        print("ERROR: the '--full-dump' option can only be used with the '--data' option.")
+        sys.exit(-1)
+
+    if args.output_format is not None and not args.data and args.bin_file is None:
+        print("ERROR: the '--format' option can only be used with the '--data' or '--only-parse' options.")
+        sys.exit(-1)
+
+    if args.rollup is not None and not args.data and args.bin_file is None:
+        print("ERROR: the '--rollup' option can only be used with the '--data' or '--only-parse' options.")
+        sys.exit(-1)
+
+    if rollup is not None and (no_parse or output_format != 'csv'):
+        print("ERROR: the '--rollup' option can not be combined with the '--no-parse' or '--format' options.")
+        sys.exit(-1)
+
+    if args.archive_dir is not None and not args.data and args.bin_file is None:
+        print("ERROR: the '--archive' option can only be used with the '--data' or '--only-parse' options.")
+        sys.exit(-1)
+
+    if args.bin_file is not None and bin_file.endswith(gq_gmc_archive.MANIFEST_SUFFIX) and \
+            (rollup is not None or args.archive_dir is not None):
+        print("ERROR: an archived dump can not be parsed with the '--rollup' or '--archive' options.")
+        sys.exit(-1)
+
+    if args.poll_interval is not None and args.metrics_address is None:
+        print("ERROR: the '--poll-interval' option can only be used with the '--metrics' option.")
+        sys.exit(-1)
+
+    if poll_interval <= 0:
+        print("ERROR: the poll interval should be more than 0 seconds.")
+        sys.exit(-1)
+
     # show existing configuration
     if args.list_tool_config:
         print("baud_rate                    = {}".format(baud_rate))
@@ -256,6 +434,20 @@ def main():
         print("bin_file                    = '{}'".format(bin_file))
         print("output_file                 = '{}'".format(output_file))
         print("no_parse                    = {}".format(no_parse))
+        print("sync                        = {}".format(sync))
+        print("resume                      = {}".format(resume))
+        print("full_dump                   = {}".format(full_dump))
+        print("output_format               = '{}'".format(output_format))
+        if rollup is None:
+            print("rollup                      = None")
+        else:
+            print("rollup                      = '{}'".format(rollup))
+        print("archive_dir                 = '{}'".format(archive_dir))
+        print("socket                      = '{}'".format(socket))
+        print("record_file                 = '{}'".format(record_file))
+        print("metrics_address             = '{}'".format(metrics_address))
+        print("poll_interval               = {}".format(poll_interval))
+        print("use_cache                   = {}".format(use_cache))
         print("output_in_usievert          = '{}'".format(output_in_usievert))
         print("output_in_cpm               = {}".format(output_in_cpm))
         print("skip_check                  = {}".format(skip_check))
@@ -280,111 +472,201 @@ def main():
         else:
             cpm_to_usievert = (int(conversion[0]), float(conversion[1]))
 
+    # use the daemon, if it's running for this port
+    device = None
+    if socket != '' and not args.daemon and os.path.exists(os.path.expanduser(socket)):
+        import gq_gmc_daemon
+        device = gq_gmc_daemon.connect(socket, port)
+    if device is None:
+        device = gq_gmc.m_default_device
+
+    # record the statistics of the serial traffic, shown when exiting
+    if args.stats is not None:
+        if isinstance(device, gq_gmc.GMCDevice):
+            import atexit
+            import gq_gmc_stats
+            device.stats = gq_gmc_stats.SerialStats()
+            atexit.register(device.stats.report, args.stats)
+        else:
+            print("WARNING: no statistics available while a daemon is using the port")
+
     # only parse a binary file, if needed
     if args.bin_file is not None:
-        if unit_conversion_from_device:
-            res = gq_gmc.open_device(port=port, baud_rate=baud_rate, skip_check=skip_check,
-                              device_type=device_type, allow_fail=True)
+        # the cached calibration of the device the data was downloaded from
+        # can be used without a connected device
+        cached_cpm_to_usievert = None
+        if unit_conversion_from_device and use_cache:
+            cached_cpm_to_usievert = gq_gmc.get_cached_unit_conversion(bin_file)
+
+        if cached_cpm_to_usievert is not None:
+            cpm_to_usievert = cached_cpm_to_usievert
+        elif unit_conversion_from_device:
+            res = device.open(port=port, baud_rate=baud_rate, skip_check=skip_check,
+                              device_type=device_type, allow_fail=True, use_cache=use_cache)
             if res != 0:
                 print('WARNING: no connection to device, defaulting to known unit '
                       + 'conversion ({:d} CPM = {:.2f} uSv/h)'
                         .format(cpm_to_usievert[0], cpm_to_usievert[1]))
             else:
-                cpm_to_usievert = gq_gmc.get_unit_conversion_from_device()
-
-        gq_gmc.parse_data_file(bin_file, output_file, cpm_to_usievert=cpm_to_usievert)
-        sys.exit(0)
+                cpm_to_usievert = device.get_unit_conversion_from_device()
+
+        if args.archive_dir is not None:
+            gq_gmc_archive.PageArchive(archive_dir).store(bin_file)
+        sys.exit(-parse_data_file(bin_file, output_file, output_format, cpm_to_usievert, rollup, resume))
+
+    # read multiple devices at once
+    if args.pool is not None:
+        results = gq_gmc.read_devices(args.pool, out_files=[gq_gmc.DEFAULT_POOL_BIN_FILE] * len(args.pool),
+                                      cpm_to_usievert=cpm_to_usievert, skip_check=skip_check,
+                                      device_type=device_type, baud_rate=baud_rate)
+        res = 0
+        for result in results:
+            if result['error'] is not None:
+                print("{}: ERROR: {}".format(result['port'], result['error']))
+                res = -1
+                continue
+            print("{}: {}, serial {}, {}, {} bytes stored to '{}'"
+                  .format(result['port'], result['device_type'], result['serial'], result['cpm'],
+                          result['size'], result['out_file']))
+            print("{}: open {:.2f} s, cpm {:.2f} s, data {:.2f} s, total {:.2f} s"
+                  .format(result['port'], result['timing']['open'], result['timing']['cpm'],
+                          result['timing']['data'], result['timing']['total']))
+        sys.exit(-res)
 
     if args.device_info:
         skip_check = True
 
     # all commands below require a connected device
-    res = gq_gmc.open_device(port=port, baud_rate=baud_rate, skip_check=skip_check,
-                      device_type=device_type)
+    res = device.open(port=port, baud_rate=baud_rate, skip_check=skip_check,
+                      device_type=device_type, use_cache=use_cache)
     if res != 0:
         sys.exit(-res)
 
+    # serve the commands of other invocations
+    if args.daemon:
+        if socket == '':
+            print("ERROR: no socket provided for the daemon")
+            sys.exit(1)
+        import gq_gmc_daemon
+        sys.exit(-gq_gmc_daemon.Daemon(device, socket).serve())
+
     # determine CPM to uSievert conversion factor by using the calibration
     # values from the device
     if unit_conversion_from_device:
-        cpm_to_usievert = gq_gmc.get_unit_conversion_from_device()
+        cpm_to_usievert = device.get_unit_conversion_from_device()
 
     # parse all history data, and get it from the device if needed
     if args.data:
-        tmp_file = None
-        if no_parse:
-            if args.output_file is not None:
+        if no_parse or sync or resume or rollup is not None or args.archive_dir is not None:
+            # the rollups are updated from (and the archive stores and the
+            # checkpoint continues) the binary file
+            if no_parse and args.output_file is not None:
                 bin_output_file = output_file
             else:
                 bin_output_file = bin_file
-        else:
-            tmp_file = tempfile.mktemp('.bin')
-            bin_output_file = tmp_file
 
-        gq_gmc.get_data(out_file=bin_output_file)
+            if sync:
+                res = device.sync_data(out_file=bin_output_file, full_dump=full_dump)
+            else:
+                res = device.get_data(out_file=bin_output_file, full_dump=full_dump)
+            if res != 0:
+                sys.exit(1)
 
-        if not no_parse:
-            gq_gmc.parse_data_file(bin_output_file, output_file,
-                            cpm_to_usievert=cpm_to_usievert)
+            if args.archive_dir is not None:
+                gq_gmc_archive.PageArchive(archive_dir).store(bin_output_file, device.get_serial_number())
 
-        if tmp_file is not None and os.path.exists(tmp_file):
-            os.remove(tmp_file)
+            if not no_parse:
+                parse_data_file(bin_output_file, output_file, output_format, cpm_to_usievert, rollup, resume)
+
+        else:
+            # parse the history data while it's downloaded
+            if verbose >= 1:
+                print("parsing history data, and storing data to '" + output_file + "'")
+            try:
+                if output_format == 'csv':
+                    gq_gmc.parse_data_stream(device.stream_data(full_dump=full_dump), output_file,
+                                             cpm_to_usievert=cpm_to_usievert, flush=True)
+                else:
+                    import gq_gmc_columns
+                    if gq_gmc_columns.parse_data_stream(device.stream_data(full_dump=full_dump), output_file,
+                                                        output_format, cpm_to_usievert=cpm_to_usievert) != 0:
+                        sys.exit(1)
+            except IOError as e:
+                print("ERROR: {}".format(e))
+                sys.exit(1)
 
     # handle the rest of the commands
 
     elif args.device_info:
-        print(gq_gmc.get_device_type())
+        print(device.get_device_type())
 
     elif args.serial:
-        print(gq_gmc.get_serial_number())
+        print(device.get_serial_number())
 
     elif args.power_on:
-        gq_gmc.set_power(True)
+        device.set_power(True)
 
     elif args.power_off:
-        gq_gmc.set_power(False)
+        device.set_power(False)
 
     elif args.heartbeat:
-        gq_gmc.set_heartbeat(True, cpm_to_usievert=cpm_to_usievert)
+        device.set_heartbeat(True, cpm_to_usievert=cpm_to_usievert)
 
     elif args.heartbeat_off:
-        gq_gmc.set_heartbeat(False)
+        device.set_heartbeat(False)
+
+    elif args.record_file is not None:
+        if not isinstance(device, gq_gmc.GMCDevice):
+            print("ERROR: the heartbeat can't be recorded while a daemon is using the port")
+            sys.exit(1)
+        sys.exit(-gq_gmc_recorder.record(device, record_file, cpm_to_usievert=cpm_to_usievert))
+
+    elif args.metrics_address is not None:
+        if not isinstance(device, gq_gmc.GMCDevice):
+            print("ERROR: the metrics can't be served while a daemon is using the port")
+            sys.exit(1)
+        if ':' not in metrics_address:
+            print("ERROR: invalid metrics address '{}', use [HOST]:PORT".format(metrics_address))
+            sys.exit(1)
+        exporter = gq_gmc_exporter.Exporter(device, metrics_address, poll_interval=poll_interval,
+                                            cpm_to_usievert=cpm_to_usievert)
+        sys.exit(-exporter.serve())
 
     elif args.voltage:
-        print(gq_gmc.get_voltage())
+        print(device.get_voltage())
 
     elif args.cpm:
-        print(gq_gmc.get_cpm(cpm_to_usievert=cpm_to_usievert))
+        print(device.get_cpm(cpm_to_usievert=cpm_to_usievert))
 
     elif args.temperature:
-        print(gq_gmc.get_temperature())
+        print(device.get_temperature())
 
     elif args.gyro:
-        print(gq_gmc.get_gyro())
+        print(device.get_gyro())
 
     elif args.list_config:
-        gq_gmc.list_config()
+        device.list_config()
 
     elif args.write_config is not None:
-        gq_gmc.write_config(args.write_config)
+        device.write_config(args.write_config)
 
     elif args.get_date_and_time:
-        print(gq_gmc.get_date_and_time())
+        print(device.get_date_and_time())
 
     elif args.set_date_and_time is not None:
-        gq_gmc.set_date_and_time(args.set_date_and_time)
+        device.set_date_and_time(args.set_date_and_time)
 
     elif args.send_key is not None:
-        gq_gmc.send_key(args.send_key)
+        device.send_key(args.send_key)
 
     elif args.firmware_update is not None:
-        gq_gmc.firmware_update()
+        device.firmware_update()
 
     elif args.reset:
-        gq_gmc.factory_reset()
+        device.factory_reset()
 
     elif args.reboot:
-        gq_gmc.reboot()
+        device.reboot()
 
 
 main()
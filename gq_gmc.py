@@ -15,16 +15,24 @@
 #
 #  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
 
+import io
+import os
 import sys
-import serial
+import json
+import hashlib
+import itertools
 import struct
 import platform
-import ctypes
+import time
+import datetime
+import mmap
 import signal
+import threading
 
 DEFAULT_CONFIG = '~/.gq-gmc-control.conf'
 DEFAULT_BIN_FILE = 'gq-gmc-log.bin'
 DEFAULT_CSV_FILE = 'gq-gmc-log.csv'
+DEFAULT_POOL_BIN_FILE = 'gq-gmc-log-{serial}.bin'
 if platform.system() == 'Windows':
     DEFAULT_PORT = 'COM99'
 else:
@@ -39,6 +47,35 @@ DEFAULT_DEVICE_TYPE = None
 DEFAULT_FLASH_SIZE = 0x00100000  # 1 MByte
 DEFAULT_CONFIGURATION_SIZE = 0x100  # 256 byte
 DEFAULT_VERBOSE_LEVEL = 2
+DEFAULT_STATE_DIR = '~/.gq-gmc-control'
+DEFAULT_SOCKET = '~/.gq-gmc-control/daemon.sock'
+DEFAULT_USE_CACHE = True
+DEVICE_CACHE_SUFFIX = '.device'
+DEVICE_CACHE_VERSION = 1
+DEFAULT_SYNC = False
+DEFAULT_RESUME = False
+DEFAULT_FULL_DUMP = False
+DATA_INFO_SUFFIX = '.info'
+DEFAULT_OUTPUT_FORMAT = 'csv'
+OUTPUT_FORMATS = ['csv', 'parquet', 'arrow', 'npz']
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 1
+INDEX_STEP = 1024  # samples between two checkpoints in the history index
+CHECKPOINT_SUFFIX = '.checkpoint'
+CHECKPOINT_VERSION = 1
+FLASH_PAGE_SIZE = 0x1000  # 4 KByte
+SPIR_MAX_SIZE = 0x1000  # maximum data length of a single SPIR request
+SPIR_MIN_SIZE = 0x100
+SPIR_WINDOW = 2  # initial number of SPIR requests in flight
+SPIR_MAX_WINDOW = 8
+SPIR_MAX_RETRIES = 5
+SPIR_GROW_AFTER = 4  # number of successful batches before growing
+SPIR_TIMEOUT = 1.0  # seconds
+SPIR_RETRY_DELAY = 0.1  # seconds, times the number of failed batches in a row
+WCFG_WINDOW = 32  # number of WCFG commands in flight
+WCFG_MAX_RETRIES = 3  # rewrites of the addresses which differ when read back
+CLEAR_QUIET = 0.1  # seconds without data before the port is considered clear
+ACK = b'\xaa'
 
 EOL = '\n'
 
@@ -63,6 +100,67 @@ FLASH_SIZE = {
     'GMC-500': 0x00100000
 }
 
+# save mode: (data type, description)
+SAVE_MODE = {
+    0: ('', 'off'),
+    1: ('CPS', 'every second'),
+    2: ('CPM', 'every minute'),
+    3: ('CPM', 'every hour'),
+    4: ('CPS', 'every second - threshold'),
+    5: ('CPM', 'every minute - threshold')
+}
+
+# save mode: interval between two samples in seconds
+SAVE_MODE_INTERVAL = {
+    1: 1,
+    2: 60,
+    3: 3600,
+    4: 1,
+    5: 60
+}
+
+# history log events, as returned by the HistoryDecoder
+EVENT_HEADER = 0
+EVENT_SAMPLES = 1
+EVENT_VALUE = 2
+EVENT_NOTE = 3
+EVENT_UNKNOWN = 4
+
+EOF_COUNT = 100  # number of consecutive 0xff samples marking the end of the log
+DEFAULT_BLOCK_SIZE = 0x10000  # 64 KByte
+WRITE_LINES = 0x1000  # csv rows written at once
+VALUE_CACHE_SIZE = 0x1000  # formatted rows of multi-byte values
+
+# command: (reply size in bytes, deadline in seconds). the reply is returned
+# as soon as it's complete, the deadline is only reached when it's short. the
+# size of GETCFG depends on the device, and of SPIR on the request.
+COMMAND_TABLE = {
+    'GETVER': (14, 0.5),
+    'GETSERIAL': (7, 0.5),
+    'GETCPM': (2, 0.5),
+    'GETCPS': (2, 0.5),
+    'GETVOLT': (3, 0.5),
+    'GETTEMP': (4, 0.5),
+    'GETGYRO': (7, 0.5),
+    'GETCFG': (None, 1.0),
+    'GETDATETIME': (7, 0.5),
+    'SETDATETIME': (1, 1.0),
+    'ECFG': (1, 5.0),  # erases the configuration flash
+    'WCFG': (1, 0.5),
+    'CFGUPDATE': (1, 5.0),  # writes the configuration flash
+    'FACTORYRESET': (1, 5.0),
+    'SPIR': (None, SPIR_TIMEOUT),
+    'POWERON': (0, 0.0),
+    'POWEROFF': (0, 0.0),
+    'HEARTBEAT1': (0, 0.0),
+    'HEARTBEAT0': (0, 0.0),
+    'KEY0': (0, 0.0),
+    'KEY1': (0, 0.0),
+    'KEY2': (0, 0.0),
+    'KEY3': (0, 0.0),
+    'REBOOT': (0, 0.0)
+}
+
 CONFIGURATION_BUFFER_SIZE = {
     'GMC-280': 0x100,
     'GMC-300': 0x100,
@@ -70,193 +168,1233 @@ CONFIGURATION_BUFFER_SIZE = {
     'GMC-500': 0x200
 }
 
-m_device = None
-m_device_type = None
-m_device_name = DEFAULT_DEVICE_TYPE
-m_config = None
-m_config_data = None
 m_verbose = DEFAULT_VERBOSE_LEVEL
-m_terminate = False
 
 
-def command_returned_ok():
-    ret = ''
-    for loop in range(10):
-        ret = m_device.read(1)
-        if ret != '':
-            break
+def to_str(data):
+    # the native string of bytes received from the device (latin-1 on python
+    # 3, which maps every byte to the character of the same value)
+    data = bytes(data)
+    if sys.version_info[0] < 3:
+        return data
+    return data.decode('latin-1')
+
+
+def open_text(file_name, mode='w'):
+    # a text file which stores the strings of to_str() unchanged (latin-1 on
+    # python 3, so every byte written is the byte received, and tell() is the
+    # byte offset)
+    if sys.version_info[0] < 3:
+        return open(file_name, mode)
+    return io.open(file_name, mode, encoding='latin-1')
+
+
+class GMCDevice(object):
+    """
+    A GQ GMC device, connected to a (serial) port. Every instance has its own
+    port, device type and cached configuration, so multiple devices can be
+    used at the same time (each from a single thread).
+    """
+
+    def __init__(self):
+        self.port = None
+        self.device = None
+        self.device_type = None
+        self.device_name = DEFAULT_DEVICE_TYPE
+        self.config = None
+        self.config_data = None
+        self.terminate = False
+        self.serial_number = None
+        self.use_cache = DEFAULT_USE_CACHE
+        self.state_dir = DEFAULT_STATE_DIR
+        self.stats = None  # gq_gmc_stats.SerialStats, if set before opening
+
+    def transaction(self, command, args=b'', size=None, deadline=None):
+        # send a command and return its reply, as soon as all bytes (of the
+        # size in the COMMAND_TABLE, unless provided) are received. the reply
+        # is shorter if the deadline (in seconds) expires.
+        reply_size, reply_deadline = COMMAND_TABLE[command]
+        if size is None:
+            size = reply_size
+        if deadline is None:
+            deadline = reply_deadline
+
+        self.device.write(b'<' + command.encode('ascii') + bytes(args) + b'>>')
+        if size == 0:
+            return b''
+        return self.read_reply(size, deadline)
+
+    def command_returned_ok(self, deadline=COMMAND_TABLE['WCFG'][1]):
+        return self.read_reply(1, deadline) == ACK
+
+    def read_reply(self, size, deadline):
+        # read size bytes, or less if the deadline (in seconds) expires
+        timeout = self.device.timeout
+        self.device.timeout = deadline
+        try:
+            return self.device.read(size)
+        finally:
+            self.device.timeout = timeout
+
+    def read_reply_into(self, buf, deadline):
+        # read len(buf) bytes into a (preallocated) buffer, or less if the
+        # deadline (in seconds) expires. returns the number of bytes read.
+        end = time.time() + deadline
+        timeout = self.device.timeout
+        received = 0
+        try:
+            while received < len(buf):
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self.device.timeout = remaining
+                size = self.device.readinto(buf[received:])
+                if not size:
+                    break
+                received += size
+        finally:
+            self.device.timeout = timeout
+        return received
+
+    def count_retries(self, command, count=1):
+        # a command is sent again after a short or failed reply (only
+        # recorded with the 'stats' attribute)
+        if self.stats is not None and count > 0:
+            self.stats.add_retry(command, count)
+
+    def clear_port(self, quiet=CLEAR_QUIET):
+        # close any pending previous command
+        self.device.write(b'>>')
+
+        # get rid off all buffered data still in the queue
+        self.drain(quiet)
+
+    def drain(self, quiet=CLEAR_QUIET):
+        # discard all received data, until nothing is received for a short
+        # (quiet) period in seconds. returns the number of discarded bytes.
+        discarded = self.device.in_waiting
+        self.device.reset_input_buffer()
+        while True:
+            data = self.read_reply(max(1, self.device.in_waiting), quiet)
+            if len(data) == 0:
+                return discarded
+            discarded += len(data)
 
-    if ret == '' or ord(ret) != 0xaa:
-        return False
-    return True
+    def check_device_type(self):
+        self.device_type = self.get_device_type()
 
+        if self.device_type == '' or len(self.device_type) < 8:
+            print("ERROR: device not found or supported")
+            return -1
 
-def clear_port():
-    # close any pending previous command
-    m_device.write(">>")
+        self.device_name = self.device_type[:7]
 
-    # get rid off all buffered data still in the queue
-    while True:
-        x = m_device.read(1)
-        if x == '':
-            break
+        if self.device_name == 'GMC-280' or \
+           self.device_name == 'GMC-300' or \
+           self.device_name == 'GMC-320' or \
+           self.device_name == 'GMC-500':
+            if m_verbose == 2:
+                print("device found: {}".format(self.device_type))
 
+        elif self.device_name[:3] == 'GMC':
+            print("WARNING: device found ({}) but officially not supported, using defaults"
+                  .format(self.device_type))
+            self.device_name = DEFAULT_DEVICE_TYPE
 
-def check_device_type():
-    global m_device_type, m_device_name
+        else:
+            print("ERROR: device not found or supported")
+            return -1
 
-    m_device_type = get_device_type()
+        return 0
 
-    if m_device_type == '' or len(m_device_type) < 8:
-        print("ERROR: device not found or supported")
-        return -1
+    def get_device_type(self):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return ''
 
-    m_device_name = m_device_type[:7]
+        return to_str(self.transaction('GETVER'))
 
-    if m_device_name == 'GMC-280' or \
-       m_device_name == 'GMC-300' or \
-       m_device_name == 'GMC-320' or \
-       m_device_name == 'GMC-500':
-        if m_verbose == 2:
-            print("device found: {}".format(m_device_type))
+    def get_serial_number(self):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
 
-    elif m_device_name[:3] == 'GMC':
-        print("WARNING: device found ({}) but officially not supported, using defaults"
-              .format(m_device_type))
-        m_device_name = DEFAULT_DEVICE_TYPE
+        serial_number = self.transaction('GETSERIAL')
 
-    else:
-        print("ERROR: device not found or supported")
-        return -1
+        if len(serial_number) < 7:
+            print('WARNING: no valid serial number received')
+            return ''
 
-    return 0
+        ser = ''.join('{:02X}'.format(c) for c in bytearray(serial_number[:7]))
+        self.serial_number = ser
+        return ser
 
+    def set_power(self, on=True):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
 
-def get_device_type():
-    if m_device is None:
-        print('ERROR: no device connected')
-        return ''
+        if on:
+            self.transaction('POWERON')
+            if m_verbose == 2:
+                print('device power on')
+        else:
+            self.transaction('POWEROFF')
+            if m_verbose == 2:
+                print('device power off')
 
-    m_device.write('<GETVER>>')
-    return m_device.read(14)
+    def get_voltage(self):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
 
+        voltage = self.transaction('GETVOLT')
 
-def get_serial_number():
-    if m_device is None:
-        print('ERROR: no device connected')
-        return -1
+        if len(voltage) < 3:
+            print('WARNING: no valid voltage received')
+            return ''
 
-    m_device.write('<GETSERIAL>>')
-    serial_number = m_device.read(7)
+        return '{} V'.format(to_str(voltage))
 
-    if serial_number == '' or len(serial_number) < 7:
-        print('WARNING: no valid serial number received')
-        return ''
+    def get_cpm(self, cpm_to_usievert=None):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
 
-    ser = ''
-    for x in range(7):
-        ser += '{:02X}'.format(ord(serial_number[x]))
-    return ser
+        cpm = self.transaction('GETCPM')
 
+        if len(cpm) < 2:
+            print('WARNING: no valid cpm received')
+            return ''
 
-def set_power(on=True):
-    if m_device is None:
-        print('ERROR: no device connected')
-        return -1
+        value = struct.unpack(">H", cpm)[0]
+        return format_unit_value(value, 'CPM', cpm_to_usievert)
+
+    def get_data(self, address=0x000000, length=None, out_file=DEFAULT_BIN_FILE,
+                 full_dump=DEFAULT_FULL_DUMP):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
+
+        if address is None:
+            address = 0x000000
+        if length is None:
+            length = self.get_flash_size()
+        if out_file is None or out_file == '':
+            out_file = DEFAULT_BIN_FILE
+
+        if m_verbose >= 1:
+            print("storing data to '" + out_file + "'")
+
+        total_len = 0
+        flash_end = FlashEnd(address)
+
+        try:
+            with open(out_file, 'wb') as f_out:
+                for data in self.stream_data(address, length, full_dump, flash_end):
+                    f_out.write(data)
+                    total_len += len(data)
+        except IOError as e:
+            # the partial download must not look complete
+            print("ERROR: {}".format(e))
+            remove_data_info(out_file)
+            return -1
+
+        save_data_info(out_file, address, total_len, flash_end.end, full_dump, self.serial_number)
+        return 0
+
+    def stream_data(self, address=0x000000, length=None, full_dump=DEFAULT_FULL_DUMP,
+                    flash_end=None):
+        # yields the history data in chunks, as soon as they are read from the
+        # device. raises IOError if the flash can't be read.
+        if address is None:
+            address = 0x000000
+        if length is None:
+            length = self.get_flash_size()
+        if flash_end is None:
+            flash_end = FlashEnd(address)
+
+        # make sure we don't have any data in the device buffer
+        self.clear_port()
+
+        for sub_addr, data in self.read_flash(address, length):
+            yield data
+
+            # the rest of the flash is erased, unless it has wrapped
+            if flash_end.update(sub_addr, data) and not full_dump:
+                if m_verbose >= 1:
+                    print("erased flash found at address 0x%06x, end of history data at 0x%06x"
+                          % (sub_addr, flash_end.end))
+                break
+
+    def read_flash(self, address, length, chunk_size=SPIR_MAX_SIZE, window=SPIR_WINDOW):
+        # read (part of) the flash, yielding the address and data of every chunk
+        reader = FlashReader(self, chunk_size=chunk_size, window=window)
+        try:
+            for sub_addr, data in reader.read(address, length):
+                yield sub_addr, data
+        finally:
+            if m_verbose >= 1 and reader.total_len > 0:
+                print(reader.summary())
+
+    def get_flash_size(self):
+        if self.device_name is not None and self.device_name in FLASH_SIZE:
+            return FLASH_SIZE[self.device_name]
+        return DEFAULT_FLASH_SIZE
+
+    def sync_data(self, out_file=DEFAULT_BIN_FILE, state_dir=DEFAULT_STATE_DIR,
+                  full_dump=DEFAULT_FULL_DUMP):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
+
+        if out_file is None or out_file == '':
+            out_file = DEFAULT_BIN_FILE
+        if state_dir is None or state_dir == '':
+            state_dir = DEFAULT_STATE_DIR
+
+        # make sure we don't have any data in the device buffer
+        self.clear_port()
+
+        serial_number = self.get_serial_number()
+        if serial_number == '':
+            print('WARNING: no serial number, downloading all history data')
+            return self.get_data(out_file=out_file, full_dump=full_dump)
+
+        state_dir = os.path.expanduser(state_dir)
+        state_file = os.path.join(state_dir, serial_number + '.sync')
+        state = load_sync_state(state_file, out_file)
+        length = self.get_flash_size()
+
+        # the last (partially written) page of the previous download must still be
+        # the same, otherwise the flash has wrapped or was erased
+        start = 0
+        page = None
+        if state is not None:
+            start = int((state['address'] - 1) / FLASH_PAGE_SIZE) * FLASH_PAGE_SIZE
+            try:
+                page = b''.join(data for sub_addr, data in self.read_flash(start, FLASH_PAGE_SIZE, window=1))
+            except IOError as e:
+                print("ERROR: {}".format(e))
+                return -1
+            if hashlib.sha1(page[:state['address'] - start]).hexdigest() != state['hash']:
+                if m_verbose >= 1:
+                    print('flash contents changed since the previous download, downloading all history data')
+                start = 0
+                page = None
+
+        if m_verbose >= 1:
+            print("storing data to '{}' (from address 0x{:06x})".format(out_file, start))
+
+        flash_end = FlashEnd(start)
+        if page is None:
+            f_out = open(out_file, 'w+b')
+            chunks = self.read_flash(0, length)
+        else:
+            f_out = open(out_file, 'r+b')
+            chunks = itertools.chain([(start, page)],
+                                     self.read_flash(start + len(page), length - start - len(page)))
+
+        with f_out:
+            f_out.seek(start)
+            f_out.truncate()
+            try:
+                for sub_addr, data in chunks:
+                    f_out.write(data)
+                    if flash_end.update(sub_addr, data) and not full_dump:
+                        # no new data after an erased page
+                        break
+            except IOError as e:
+                # the next download continues from the previous (still valid)
+                # sync state, the partial download must not look complete
+                print("ERROR: {}".format(e))
+                remove_data_info(out_file)
+                return -1
+
+            # remember the last written page for the next download
+            last_address = flash_end.end
+            page_start = int(max(last_address - 1, 0) / FLASH_PAGE_SIZE) * FLASH_PAGE_SIZE
+            f_out.seek(page_start)
+            page_hash = hashlib.sha1(f_out.read(last_address - page_start)).hexdigest()
+
+            f_out.seek(0, os.SEEK_END)
+            total_len = f_out.tell()
+
+        save_data_info(out_file, 0, total_len, last_address, full_dump, serial_number)
+        if last_address > 0:
+            save_sync_state(state_file, out_file, last_address, page_hash)
+        return 0
+
+    def get_unit_conversion_from_device(self):
+        # make sure the cached config is up to date
+        if self.config_data is None:
+            self.get_config()
+
+        cal_sv = get_calibration(self.config)
 
-    if on:
-        m_device.write('<POWERON>>')
         if m_verbose == 2:
-            print('device power on')
-    else:
-        m_device.write('<POWEROFF>>')
+            print("calibration value 1 from device: {:d} CPM = {:.2f} uSievert/h"
+                  .format(self.config['cal1_cpm'], self.config['cal1_sv']))
+            print("calibration value 2 from device: {:d} CPM = {:.2f} uSievert/h"
+                  .format(self.config['cal2_cpm'], self.config['cal2_sv']))
+            print("calibration value 3 from device: {:d} CPM = {:.2f} uSievert/h"
+                  .format(self.config['cal3_cpm'], self.config['cal3_sv']))
+            print("using the average of calibration values: {:d} CPM = {:.2f} uSievert/h"
+                  .format(1000, cal_sv))
+
+        return 1000, cal_sv
+
+    def exit_gracefully(self, signum, frame):
+        self.terminate = True
+
+    def set_heartbeat(self, enable, cpm_to_usievert=None):
+        import serial
+
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
+
+        if enable:
+            self.transaction('HEARTBEAT1')
+
+            # signal handlers can only be installed from the main thread
+            if isinstance(threading.current_thread(), threading._MainThread):
+                signal.signal(signal.SIGINT, self.exit_gracefully)
+                signal.signal(signal.SIGTERM, self.exit_gracefully)
+
+            try:
+                while not self.terminate:
+                    cpm = self.device.read(2)
+                    if len(cpm) == 0:
+                        continue
+                    value = struct.unpack(">H", cpm)[0] & 0x3fff
+                    print(format_unit_value(value, 'CPS', cpm_to_usievert))
+
+            except KeyboardInterrupt:
+                print("")
+            except serial.SerialException:
+                pass
+            finally:
+                # make sure we stop the heartbeat
+                self.transaction('HEARTBEAT0')
+
+        else:
+            self.transaction('HEARTBEAT0')
+            sys.stdout.write('.' * (self.drain() + 1))
+            if m_verbose == 2:
+                print("ok")
+
+    def get_temperature(self):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
+
+        temp = self.transaction('GETTEMP')
+
+        if len(temp) < 4:
+            print('WARNING: no valid temperature received')
+            return ''
+
+        temp = bytearray(temp)
+        sign = ''
+        if temp[2] != 0:
+            sign = '-'
+        temp_str = u'{:s}{:d}.{:d} \u00b0C'.format(sign, temp[0], temp[1])
+        if sys.version_info[0] < 3:
+            # printed as utf-8 encoded bytes by python 2
+            return temp_str.encode('utf-8')
+        return temp_str
+
+    def get_gyro(self):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
+
+        gyro = self.transaction('GETGYRO')
+
+        if len(gyro) < 7:
+            print('WARNING: no valid gyro data received')
+            return ''
+
+        (x, y, z, dummy) = struct.unpack_from(">hhhB", gyro)
+        return "x:{}, y:{}, z:{}".format(x, y, z)
+
+    def get_config(self):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
+
+        if self.device_name in CONFIGURATION_BUFFER_SIZE:
+            size = CONFIGURATION_BUFFER_SIZE[self.device_name]
+        else:
+            size = DEFAULT_CONFIGURATION_SIZE
+
+        data = self.transaction('GETCFG', size=size)
+
+        if len(data) == 0:
+            print("WARNING: reading device configuration failed")
+            return -1
+
+        self.set_config_data(data)
+        self.save_cache()
+
+    def set_config_data(self, data):
+        self.config_data = bytearray(data)
+        self.config = parse_config(self.config_data)
+
+    def list_config(self):
+        # always show (and cache) the configuration as stored on the device
+        if self.get_config() == -1:
+            return
+
+        dump_data(self.config_data)
+
+        print("server website: {}".format(self.config['server_website']))
+        print("server url: {}".format(self.config['server_url']))
+        print("user id: {}".format(self.config['user_id']))
+        print("counter id: {}".format(self.config['counter_id']))
+        print("wifi active: {}".format(str(self.config['wifi_active'])))
+        print("wifi ssid: {}".format(self.config['wifi_ssid']))
+        print("wifi password: {}".format(self.config['wifi_password']))
+        print("calibrate 1: {:d} cpm = {:.2f} sv"
+              .format(self.config['cal1_cpm'], self.config['cal1_sv']))
+        print("calibrate 2: {:d} cpm = {:.2f} sv"
+              .format(self.config['cal2_cpm'], self.config['cal2_sv']))
+        print("calibrate 3: {:d} cpm = {:.2f} sv"
+              .format(self.config['cal3_cpm'], self.config['cal3_sv']))
+
+    def write_config(self, parameters):
+        if self.device_name == 'GMC-280' or \
+           self.device_name == 'GMC-300' or \
+           self.device_name == 'GMC-320':
+            address_size = 'B'  # 1 byte address
+        elif self.device_name == 'GMC-500':
+            address_size = 'H'  # 2 byte address
+        else:
+            print('ERROR: device not supported, feature not available')
+            return -1
+
+        # the configuration could be changed on the device since it was
+        # cached, only the provided parameters may change
+        if self.get_config() == -1:
+            return -1
+
+        # update the cached configuration (in memory)
+        for par in parameters:
+            par_value = par.split('=')
+            if len(par_value) != 2:
+                print("WARNING: skipping parameter '{}', it doesn't seem to contain a 'parameter-name=value' pair."
+                      .format(par))
+                continue
+
+            if par_value[0] == 'cal1-cpm':
+                struct.pack_into('>H', self.config_data, ADDRESS_CALIBRATE1_CPM,
+                                 int(par_value[1]))
+            elif par_value[0] == 'cal1-sv':
+                struct.pack_into('>f', self.config_data, ADDRESS_CALIBRATE1_SV,
+                                 float(par_value[1]))
+            elif par_value[0] == 'cal2-cpm':
+                struct.pack_into('>H', self.config_data, ADDRESS_CALIBRATE2_CPM,
+                                 int(par_value[1]))
+            elif par_value[0] == 'cal2-sv':
+                struct.pack_into('>f', self.config_data, ADDRESS_CALIBRATE2_SV,
+                                 float(par_value[1]))
+            elif par_value[0] == 'cal3-cpm':
+                struct.pack_into('>H', self.config_data, ADDRESS_CALIBRATE3_CPM,
+                                 int(par_value[1]))
+            elif par_value[0] == 'cal3-sv':
+                struct.pack_into('>f', self.config_data, ADDRESS_CALIBRATE3_SV,
+                                 float(par_value[1]))
+            else:
+                print("WARNING: parameter with name '{}' not supported".format(par_value[0]))
+
+        # erase all stored parameters in flash
+        if self.transaction('ECFG') != ACK:
+            print("WARNING: erase operation failed, parameters not stored on device")
+            return -1
+
+        if self.device_name in CONFIGURATION_BUFFER_SIZE:
+            size = CONFIGURATION_BUFFER_SIZE[self.device_name]
+        else:
+            size = DEFAULT_CONFIGURATION_SIZE
+
+        # write all cached parameters (from memory) into the device, the
+        # addresses which differ when read back are written again
+        writer = ConfigWriter(self, address_size)
+        failed = writer.write(bytes(self.config_data[:size]))
         if m_verbose == 2:
-            print('device power off')
+            print(writer.summary())
+        if failed:
+            print("WARNING: write operation failed at address(es) %s, parameters not stored on device" %
+                  ', '.join('0x%02X' % i for i in failed))
+            return -1
+
+        # make the change permanent (write flash)
+        if self.transaction('CFGUPDATE') != ACK:
+            print("WARNING: update operation failed, parameters not stored on device")
+            self.remove_cache()
+            return -1
+
+        # the written configuration is verified, cache it
+        self.set_config_data(self.config_data[:size])
+        self.save_cache()
+        return 0
+
+    def get_date_and_time(self):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
+
+        date = self.transaction('GETDATETIME')
+
+        if len(date) < 7:
+            print('WARNING: no valid date received')
+            return ''
+
+        (year, month, day, hour, minute, second, dummy) = struct.unpack_from(">BBBBBBB", date)
+        return "{}/{}/{} {}:{}:{}".format(year, month, day, hour, minute, second)
+
+    def set_date_and_time(self, date_time):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
+
+        cmd = struct.pack('>BBBBBB',
+                          date_time.year - 2000,
+                          date_time.month,
+                          date_time.day,
+                          date_time.hour,
+                          date_time.minute,
+                          date_time.second)
+        if self.transaction('SETDATETIME', cmd) != ACK:
+            print("WARNING: setting date and time not succeded")
+
+    def send_key(self, key):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
+
+        if key.lower() == 's1':
+            self.transaction('KEY0')
+
+        elif key.lower() == 's2':
+            self.transaction('KEY1')
+
+        elif key.lower() == 's3':
+            self.transaction('KEY2')
+
+        elif key.lower() == 's4':
+            self.transaction('KEY3')
+
+    def firmware_update(self):
+        print('ERROR: option not yet available')
+
+    def factory_reset(self):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
+
+        if self.transaction('FACTORYRESET') != ACK:
+            print("WARNING: factory reset not succeded")
+
+        # the configuration is reset
+        self.config = None
+        self.config_data = None
+        self.remove_cache()
+
+    def reboot(self):
+        if self.device is None:
+            print('ERROR: no device connected')
+            return -1
+
+        self.transaction('REBOOT')
+
+    def open(self, port=None, baud_rate=115200, skip_check=False, device_type=None,
+             allow_fail=False, use_cache=DEFAULT_USE_CACHE, state_dir=DEFAULT_STATE_DIR):
+        if port is None or port == '':
+            port = DEFAULT_PORT
+
+        # pyserial is only imported once a device is opened, parsing a binary
+        # file doesn't need it
+        import serial
 
+        try:
+            self.port = port
+            self.device = serial.Serial(port, baudrate=baud_rate, timeout=1.0)
+            if self.stats is not None:
+                self.device = self.stats.wrap(self.device)
+        except serial.serialutil.SerialException:
+            if not allow_fail:
+                if platform.system() == 'Windows':
+                    print("ERROR: No device found (use the '-p COM1' option and provide the correct port)")
+                else:
+                    print("ERROR: No device found (use the '-p /dev/ttyUSB0' option and provide the correct port, or install the udev rule as described in the INSTALL file)")
+            return -1
+
+        self.clear_port()
+        self.use_cache = use_cache
+        self.state_dir = state_dir
+
+        # the device type (and configuration) of a known serial number are
+        # cached, otherwise check and cache the device type
+        res = 0
+        if not skip_check and not self.load_cache():
+            res = self.check_device_type()
+            if res == 0:
+                self.save_cache()
+
+        if device_type is not None:
+            if device_type == 'GMC-280' or \
+               device_type == 'GMC-300' or \
+               device_type == 'GMC-320' or \
+               device_type == 'GMC-500':
+                self.device_name = device_type
+                if m_verbose == 2:
+                    print("using device-type: {}".format(self.device_name))
+            else:
+                print("WARNING: unsupported selected device type '{}', defaulting to '{}'"
+                      .format(device_type, self.device_name))
+
+        return res
+
+    def close(self):
+        if self.device is not None:
+            self.device.close()
+            self.device = None
+
+    def load_cache(self):
+        # use the cached device type and configuration, returns False if not
+        # cached (or the cache isn't used)
+        if not self.use_cache:
+            return False
+
+        serial_number = self.get_serial_number()
+        cache = load_device_cache(serial_number, self.state_dir)
+        if cache is None:
+            return False
+
+        self.device_type = cache['version']
+        self.device_name = cache['model']
+        if cache['config'] is not None:
+            self.set_config_data(bytes(bytearray.fromhex(cache['config'])))
+        if m_verbose == 2:
+            print("device found: {} (cached)".format(self.device_type))
+        return True
+
+    def save_cache(self):
+        if not self.use_cache or self.device_type is None:
+            return
+
+        if self.serial_number is None and self.get_serial_number() == '':
+            return
+
+        config = None
+        if self.config_data is not None:
+            config = bytes(self.config_data)
+        save_device_cache(self.serial_number, self.state_dir, self.device_type, self.device_name, config)
+
+    def remove_cache(self):
+        if self.serial_number is not None:
+            remove_device_cache(self.serial_number, self.state_dir)
+
+
+class FlashEnd(object):
+    """
+    Keeps track of the end of the history data while reading the flash. The
+    flash is written sequentially, so once a whole page is erased (0xff) there
+    is no more history data (unless the flash has wrapped).
+    """
+
+    def __init__(self, address=0):
+        self.end = address  # address after the last non-erased byte
+        self.erased = 0  # number of erased bytes after the end
+
+    def update(self, sub_addr, data):
+        # returns True once a whole erased page is found
+        used = len(data.rstrip(b'\xff'))
+        if used > 0:
+            self.end = sub_addr + used
+            self.erased = len(data) - used
+        else:
+            self.erased += len(data)
+        return self.erased >= FLASH_PAGE_SIZE
+
+
+class FlashReader(object):
+    """
+    Reads the flash using pipelined SPIR requests. A batch of 'window' requests
+    is sent at once, and all responses are read as a single block. When the
+    block is complete, and no unexpected data follows, it's split in chunks.
+
+    The chunk size and window adapt to the link: a short read (or unexpected
+    data) discards the batch and shrinks the window (or the chunk size once
+    the window is 1), a successful batch grows them again as long as the
+    throughput improves.
+    """
+
+    def __init__(self, gmc_device, chunk_size=SPIR_MAX_SIZE, window=SPIR_WINDOW,
+                 max_window=SPIR_MAX_WINDOW):
+        self.gmc_device = gmc_device
+        self.chunk_size = max(SPIR_MIN_SIZE, min(chunk_size, SPIR_MAX_SIZE))
+        self.window = max(1, window)
+        self.max_window = max(self.window, max_window)
+        self.total_len = 0
+        self.duration = 0.0
+        self.retries = 0
+        self._rate = None
+        self._previous = None
+        self._settled = False
+        self._successes = 0
+        self._failures = 0
+        # the replies of a batch are read into a single (reused) buffer
+        self._buffer = memoryview(bytearray(SPIR_MAX_SIZE * self.max_window))
+
+    def read(self, address, length):
+        device = self.gmc_device.device
+        sub_addr = address
+        end = address + length
+        start_time = time.time()
+
+        while sub_addr < end:
+            requests, cmd = self._batch(sub_addr, end)
+            batch_len = requests[-1][0] + requests[-1][1] - sub_addr
+
+            # allow the whole batch to be transferred at half the line rate
+            batch_time = time.time()
+            device.write(cmd)
+            data = self._buffer[:self.gmc_device.read_reply_into(self._buffer[:batch_len],
+                                                                 self._timeout(batch_len))]
+            batch_time = time.time() - batch_time
+
+            sent = requests
+            requests, ok = self._check(requests, data, sub_addr, batch_len, batch_time,
+                                       device.in_waiting > 0)
+            if not ok:
+                # empty and short batches are retried alike, after the port
+                # is clear and a delay which grows with every failure
+                if self._failures > SPIR_MAX_RETRIES:
+                    raise IOError("reading flash failed at address 0x%06x" % sub_addr)
+                self.gmc_device.clear_port()
+                time.sleep(SPIR_RETRY_DELAY * self._failures)
+                # the requests which aren't completely received are sent again
+                self.gmc_device.count_retries('SPIR', len([r for r in sent if r not in requests]))
+
+            for chunk_addr, chunk in self._split(requests, data, sub_addr, length, start_time):
+                yield chunk_addr, chunk
+            if requests:
+                sub_addr = requests[-1][0] + requests[-1][1]
+
+        self.duration = time.time() - start_time
+
+    def _batch(self, sub_addr, end):
+        # returns the (address, size) of the requests in the next batch, and
+        # the SPIR commands to send
+        requests = []
+        cmd = b''
+        batch_end = sub_addr
+        for i in range(self.window):
+            if batch_end >= end:
+                break
+            size = min(self.chunk_size, end - batch_end)
+            requests.append((batch_end, size))
+            cmd += b'<SPIR' + struct.pack('>BBBH',
+                (batch_end >> 16) & 0xff,
+                (batch_end >> 8) & 0xff,
+                batch_end & 0xff,
+                size) + b'>>'
+            batch_end += size
+        return requests, cmd
+
+    def _timeout(self, batch_len):
+        return SPIR_TIMEOUT + batch_len * 20.0 / self.baud_rate()
+
+    def _check(self, requests, data, sub_addr, batch_len, batch_time, pending):
+        # returns the requests for which valid data was received, and whether
+        # the whole batch was received (without any unexpected data pending)
+        if len(data) < batch_len or pending:
+            self._failures += 1
+            self.retries += 1
+            if m_verbose == 2:
+                print("address: 0x%06x, received %d of %d bytes, retrying" %
+                      (sub_addr, len(data), batch_len))
 
-def get_voltage():
-    if m_device is None:
-        print('ERROR: no device connected')
-        return -1
+            # with a single request the received data is still valid
+            if len(requests) == 1 and len(data) > 0 and len(data) < batch_len:
+                requests = [(sub_addr, len(data))]
+            else:
+                requests = []
+            self._shrink()
+            return requests, False
+
+        self._failures = 0
+        self._grow(batch_len / max(batch_time, 1e-6))
+        return requests, True
+
+    def _split(self, requests, data, sub_addr, length, start_time):
+        # yields the address and data of every request in the batch, copied
+        # from the buffer which is reused by the next batch
+        data = memoryview(data)
+        for chunk_addr, size in requests:
+            chunk = data[chunk_addr - sub_addr:chunk_addr - sub_addr + size].tobytes()
+            self.total_len += len(chunk)
+            self.duration = time.time() - start_time
+            if m_verbose == 2:
+                print("address: 0x%06x, size: %s, total size: %d bytes (%d%%)" %
+                      (chunk_addr, len(chunk), self.total_len, int(self.total_len * 100 / length)))
+            yield chunk_addr, chunk
+
+    def baud_rate(self):
+        return self.gmc_device.device.baudrate
+
+    def throughput(self):
+        # achieved bytes per second
+        if self.duration <= 0:
+            return 0.0
+        return self.total_len / self.duration
+
+    def summary(self):
+        line_rate = self.baud_rate() / 10.0
+        return "transferred %d bytes in %.2f s: %.0f bytes/s (%d%% of the line rate), " \
+               "chunk size: %d, window: %d, retries: %d" % \
+               (self.total_len, self.duration, self.throughput(),
+                int(self.throughput() * 100 / line_rate), self.chunk_size, self.window,
+                self.retries)
+
+    def _shrink(self):
+        if self.window > 1:
+            self.window = int(self.window / 2)
+        else:
+            self.chunk_size = max(SPIR_MIN_SIZE, int(self.chunk_size / 2))
+        self._rate = None
+        self._previous = None
+        self._successes = 0
+
+    def _grow(self, rate):
+        if self._previous is not None and self._rate is not None and rate < self._rate:
+            # the last step didn't improve the throughput, undo it and stop growing
+            self.chunk_size, self.window = self._previous
+            self._previous = None
+            self._settled = True
+            return
+
+        self._rate = rate
+        self._previous = None
+        self._successes += 1
+        if self._settled or self._successes < SPIR_GROW_AFTER:
+            return
+
+        self._successes = 0
+        if self.chunk_size < SPIR_MAX_SIZE:
+            self._previous = (self.chunk_size, self.window)
+            self.chunk_size = min(SPIR_MAX_SIZE, self.chunk_size * 2)
+        elif self.window < self.max_window:
+            self._previous = (self.chunk_size, self.window)
+            self.window = min(self.max_window, self.window * 2)
+
+
+class ConfigWriter(object):
+    """
+    Writes the configuration using pipelined WCFG commands. A batch of up to
+    'window' commands is sent at once, and the acks (0xAA) of the batch are
+    matched by count. Afterwards the configuration is read back (GETCFG), and
+    only the addresses which differ are written again.
+    """
+
+    def __init__(self, gmc_device, address_size, window=WCFG_WINDOW):
+        self.gmc_device = gmc_device
+        self.address_size = address_size
+        self.window = max(1, window)
+        self.written = 0
+        self.rewritten = 0
+        self.missing_acks = 0
+        self.duration = 0.0
+
+    def write(self, data):
+        # write all bytes of data, returns the addresses which still differ
+        # after WCFG_MAX_RETRIES rewrites
+        data = bytearray(data)
+        addresses = list(range(len(data)))
+        start_time = time.time()
+
+        for retry in range(WCFG_MAX_RETRIES + 1):
+            if retry > 0:
+                self.rewritten += len(addresses)
+                self.gmc_device.count_retries('WCFG', len(addresses))
+            self._write(data, addresses)
+
+            readback = bytearray(self.gmc_device.transaction('GETCFG', size=len(data)))
+            addresses = [i for i in range(len(data)) if i >= len(readback) or readback[i] != data[i]]
+            if len(addresses) == 0:
+                break
+            if m_verbose == 2:
+                print("%d address(es) differ after writing the configuration, retrying" % len(addresses))
+
+        self.duration = time.time() - start_time
+        return addresses
+
+    def _write(self, data, addresses):
+        device = self.gmc_device.device
+        for pos in range(0, len(addresses), self.window):
+            batch = addresses[pos:pos + self.window]
+            cmd = b''.join(b'<WCFG' + struct.pack('>' + self.address_size + 'B', i, data[i]) + b'>>'
+                           for i in batch)
+
+            # allow the commands to be transferred at half the line rate
+            device.write(cmd)
+            acks = self.gmc_device.read_reply(len(batch), COMMAND_TABLE['WCFG'][1]
+                                              + len(cmd) * 20.0 / device.baudrate)
+            self.written += len(batch)
+
+            missing = len(batch) - acks.count(ACK)
+            if missing > 0:
+                self.missing_acks += missing
+                if m_verbose == 2:
+                    print("address: 0x%02X, %d of %d acks missing" % (batch[0], missing, len(batch)))
+                # don't count late acks for the next batch
+                self.gmc_device.clear_port()
+
+    def summary(self):
+        return "written %d bytes in %.2f s, %d rewritten, %d acks missing" % \
+               (self.written, self.duration, self.rewritten, self.missing_acks)
+
+
+def save_data_info(out_file, address, length, end, full_dump, serial_number=None):
+    # store where the download stopped, where the history data ends, and the
+    # serial number of the device
+    with open(out_file + DATA_INFO_SUFFIX, 'w') as f_out:
+        json.dump({'address': address,
+                   'length': length,
+                   'end': end,
+                   'full_dump': full_dump,
+                   'serial': serial_number}, f_out)
+
+
+def remove_data_info(out_file):
+    # a binary file which isn't (completely) downloaded has no download
+    # information
+    info_file = out_file + DATA_INFO_SUFFIX
+    if os.path.isfile(info_file):
+        os.remove(info_file)
+
+
+def load_data_info(in_file):
+    # returns the download information of a binary file, or None if not
+    # available (or not up to date)
+    info_file = in_file + DATA_INFO_SUFFIX
+    if not os.path.isfile(info_file):
+        return None
 
-    m_device.write('<GETVOLT>>')
-    voltage = m_device.read(3)
+    try:
+        with open(info_file, 'r') as f_in:
+            info = json.load(f_in)
+    except ValueError:
+        return None
 
-    if voltage == '' or len(voltage) < 3:
-        print('WARNING: no valid voltage received')
-        return ''
+    if info.get('length') != os.path.getsize(in_file):
+        return None
+    return info
 
-    return '{} V'.format(voltage)
 
+def load_checkpoint(in_file, out_file, cpm_to_usievert=None):
+    # returns the checkpoint of the previous parse of a binary file and a
+    # hash of the parsed data (to continue hashing from the checkpoint), or
+    # None if the binary file doesn't start with the parsed data or the csv
+    # file changed
+    checkpoint_file = out_file + CHECKPOINT_SUFFIX
+    if not os.path.isfile(checkpoint_file) or not os.path.isfile(out_file):
+        return None
 
-def get_cpm(cpm_to_usievert=None):
-    if m_device is None:
-        print('ERROR: no device connected')
-        return -1
+    try:
+        with open(checkpoint_file, 'r') as f_in:
+            checkpoint = json.load(f_in)
+    except ValueError:
+        return None
 
-    m_device.write('<GETCPM>>')
-    cpm = m_device.read(2)
+    conversion = list(cpm_to_usievert) if cpm_to_usievert is not None else None
+    if checkpoint.get('version') != CHECKPOINT_VERSION or \
+       checkpoint.get('cpm_to_usievert') != conversion or \
+       os.path.getsize(out_file) < checkpoint['csv_size'] or \
+       os.path.getsize(in_file) < checkpoint['offset']:
+        return None
 
-    if cpm == '' or len(cpm) < 2:
-        print('WARNING: no valid cpm received')
-        return ''
+    prefix_hash = hashlib.sha1()
+    with open(in_file, 'rb') as f_in:
+        for block in read_blocks(f_in, DEFAULT_BLOCK_SIZE, checkpoint['offset']):
+            prefix_hash.update(block)
+    if prefix_hash.hexdigest() != checkpoint['hash']:
+        return None
+    return checkpoint, prefix_hash
 
-    value = struct.unpack(">H", cpm)[0]
 
-    unit_value = (value, 'CPM')
-    if cpm_to_usievert is not None:
-        unit_value = convert_cpm_to_usievert(value, 'CPM', cpm_to_usievert)
+def get_checkpoint(decoder, prefix_hash, csv_size, cpm_to_usievert=None):
+    # the state of the decoder after parsing the data up to the end of the
+    # history data, so the parse of a longer download can continue there
+    return {'version': CHECKPOINT_VERSION,
+            'offset': decoder.offset,
+            'marker': decoder.marker,
+            'save_mode': decoder.save_mode,
+            'data_type': decoder.data_type,
+            'eof_count': decoder.eof_count,
+            'hash': prefix_hash.hexdigest(),
+            'csv_size': csv_size,
+            'cpm_to_usievert': list(cpm_to_usievert) if cpm_to_usievert is not None else None}
 
-    if unit_value[1] == 'uSv/h':
-        return '{:.4f} {:s}'.format(unit_value[0], unit_value[1])
-    else:
-        return '{:d} {:s}'.format(unit_value[0], unit_value[1])
 
+def save_checkpoint(out_file, checkpoint):
+    with open(out_file + CHECKPOINT_SUFFIX, 'w') as f_out:
+        json.dump(checkpoint, f_out)
 
-def get_data(address=0x000000, length=None, out_file=DEFAULT_BIN_FILE):
-    if m_device is None:
-        print('ERROR: no device connected')
-        return -1
 
-    if address is None:
-        address = 0x000000
-    if length is None:
-        if m_device_name is not None and m_device_name in FLASH_SIZE:
-            length = FLASH_SIZE[m_device_name]
-        else:
-            length = DEFAULT_FLASH_SIZE
-    if out_file is None or out_file == '':
-        out_file = DEFAULT_BIN_FILE
+def remove_checkpoint(out_file):
+    # a csv file which is written from the start invalidates its checkpoint
+    checkpoint_file = out_file + CHECKPOINT_SUFFIX
+    if os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
 
-    total_len = 0
-    sub_addr = address
-    sub_len = 4096
 
-    # make sure we don't have any data in the device buffer
-    clear_port()
+def load_sync_state(state_file, out_file):
+    # returns the state of the previous download, or None if it can't be used
+    if not os.path.isfile(state_file) or not os.path.isfile(out_file):
+        return None
 
-    if m_verbose >= 1:
-        print("storing data to '" + out_file + "'")
+    try:
+        with open(state_file, 'r') as f_in:
+            state = json.load(f_in)
+    except ValueError:
+        print("WARNING: ignoring invalid state file '{}'".format(state_file))
+        return None
 
-    with open(out_file, 'wb') as f_out:
-        while True:
-            cmd = struct.pack('>BBBH',
-                (sub_addr >> 16) & 0xff,
-                (sub_addr >> 8) & 0xff,
-                sub_addr & 0xff,
-                sub_len)
-            m_device.write('<SPIR' + cmd + '>>')
-
-            data = m_device.read(sub_len)
-            if data == '' or total_len >= length:
-                break
+    if state.get('file') != os.path.abspath(out_file) or \
+       state.get('address', 0) <= 0 or \
+       os.path.getsize(out_file) < state['address']:
+        return None
+    return state
 
-            f_out.write(data)
-            total_len += len(data)
-            if m_verbose == 2:
-                print("address: 0x%06x, size: %s, total size: %d bytes (%d%%)" %
-                      (sub_addr, sub_len, total_len, int(total_len * 100 / length)))
-            sub_addr += sub_len
+
+def save_sync_state(state_file, out_file, address, page_hash):
+    state_dir = os.path.dirname(state_file)
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+
+    with open(state_file, 'w') as f_out:
+        json.dump({'file': os.path.abspath(out_file),
+                   'address': address,
+                   'hash': page_hash}, f_out)
+
+
+def get_device_cache_file(serial_number, state_dir=DEFAULT_STATE_DIR):
+    return os.path.join(os.path.expanduser(state_dir), serial_number + DEVICE_CACHE_SUFFIX)
+
+
+def load_device_cache(serial_number, state_dir=DEFAULT_STATE_DIR):
+    # returns the cached device type and configuration of a serial number, or
+    # None if not (validly) cached
+    if serial_number is None or serial_number == '' or serial_number == -1:
+        return None
+
+    cache_file = get_device_cache_file(serial_number, state_dir)
+    if not os.path.isfile(cache_file):
+        return None
+
+    try:
+        with open(cache_file, 'r') as f_in:
+            cache = json.load(f_in)
+    except ValueError:
+        print("WARNING: ignoring invalid cache file '{}'".format(cache_file))
+        return None
+
+    if cache.get('cache_version') != DEVICE_CACHE_VERSION or \
+       cache.get('serial') != serial_number or \
+       not cache.get('version') or \
+       'model' not in cache or \
+       'config' not in cache:
+        return None
+
+    # json strings are unicode (in python 2)
+    cache['version'] = str(cache['version'])
+    if cache['model'] is not None:
+        cache['model'] = str(cache['model'])
+    return cache
+
+
+def save_device_cache(serial_number, state_dir, version, model, config=None):
+    # cache the device type (GETVER), model and raw configuration (GETCFG),
+    # including the calibration derived from it
+    cache_file = get_device_cache_file(serial_number, state_dir)
+    cache_dir = os.path.dirname(cache_file)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    cpm_to_usievert = None
+    if config is not None:
+        try:
+            cpm_to_usievert = [1000, get_calibration(parse_config(config))]
+        except ZeroDivisionError:
+            pass
+        config = ''.join('{:02x}'.format(c) for c in bytearray(config))
+
+    with open(cache_file, 'w') as f_out:
+        json.dump({'cache_version': DEVICE_CACHE_VERSION,
+                   'serial': serial_number,
+                   'version': version.decode('latin-1') if isinstance(version, bytes) else version,
+                   'model': model,
+                   'config': config,
+                   'cpm_to_usievert': cpm_to_usievert}, f_out)
+
+
+def remove_device_cache(serial_number, state_dir=DEFAULT_STATE_DIR):
+    cache_file = get_device_cache_file(serial_number, state_dir)
+    if os.path.isfile(cache_file):
+        os.remove(cache_file)
+
+
+def get_cached_unit_conversion(in_file, state_dir=DEFAULT_STATE_DIR):
+    # returns the cached calibration of the device the binary file was
+    # downloaded from, or None if not available
+    info = load_data_info(in_file)
+    if info is None:
+        return None
+
+    cache = load_device_cache(info.get('serial'), state_dir)
+    if cache is None or cache.get('cpm_to_usievert') is None:
+        return None
+
+    if m_verbose == 2:
+        print("using the cached calibration values of device {}: {:d} CPM = {:.2f} uSievert/h"
+              .format(info['serial'], cache['cpm_to_usievert'][0], cache['cpm_to_usievert'][1]))
+    return tuple(cache['cpm_to_usievert'])
+
+
+def parse_config(config_data):
+    # returns the known parameters of a raw configuration
+    config_data = bytearray(config_data)
+    config = {}
+    config['cal1_cpm'] = struct.unpack_from('>H', config_data, ADDRESS_CALIBRATE1_CPM)[0]
+    config['cal1_sv'] = struct.unpack_from('>f', config_data, ADDRESS_CALIBRATE1_SV)[0]
+    config['cal2_cpm'] = struct.unpack_from('>H', config_data, ADDRESS_CALIBRATE2_CPM)[0]
+    config['cal2_sv'] = struct.unpack_from('>f', config_data, ADDRESS_CALIBRATE2_SV)[0]
+    config['cal3_cpm'] = struct.unpack_from('>H', config_data, ADDRESS_CALIBRATE3_CPM)[0]
+    config['cal3_sv'] = struct.unpack_from('>f', config_data, ADDRESS_CALIBRATE3_SV)[0]
+    config['server_website'] = to_str(config_data[ADDRESS_SERVER_WEBSITE:ADDRESS_SERVER_WEBSITE + 32])
+    config['server_url'] = to_str(config_data[ADDRESS_SERVER_URL:ADDRESS_SERVER_URL + 32])
+    config['user_id'] = to_str(config_data[ADDRESS_USER_ID:ADDRESS_USER_ID + 16])
+    config['counter_id'] = to_str(config_data[ADDRESS_COUNTER_ID:ADDRESS_COUNTER_ID + 16])
+    if config_data[ADDRESS_WIFI_ON_OFF] == 255:
+        config['wifi_active'] = True
+    else:
+        config['wifi_active'] = False
+    config['wifi_ssid'] = to_str(config_data[ADDRESS_WIFI_SSID:ADDRESS_WIFI_SSID + 16])
+    config['wifi_password'] = to_str(config_data[ADDRESS_WIFI_PASSWORD:ADDRESS_WIFI_PASSWORD + 16])
+    # TODO: figure out the other configuration parameters...
+    return config
+
+
+def get_calibration(config):
+    # the average of the calibration values in uSievert/h per 1000 CPM
+    cal1_sv = config['cal1_sv'] * 1000 / config['cal1_cpm']
+    cal2_sv = config['cal2_sv'] * 1000 / config['cal2_cpm']
+    cal3_sv = config['cal3_sv'] * 1000 / config['cal3_cpm']
+    return (cal1_sv + cal2_sv + cal3_sv) / 3
 
 
 def convert_cpm_to_usievert(cpm, unit, cpm_to_usievert):
@@ -273,39 +1411,46 @@ def convert_cpm_to_usievert(cpm, unit, cpm_to_usievert):
         return cpm, unit
 
 
-def get_unit_conversion_from_device():
-    # make sure the cached config is up to date
-    if m_config_data is None:
-        get_config()
+def format_unit_value(value, unit, cpm_to_usievert=None):
+    # formats a single measurement, e.g. '23 CPM' or '0.1495 uSv/h'
+    unit_value = convert_cpm_to_usievert(value, unit, cpm_to_usievert)
+
+    if unit_value[1] == 'uSv/h':
+        return '{:.4f} {:s}'.format(unit_value[0], unit_value[1])
+    else:
+        return '{:d} {:s}'.format(unit_value[0], unit_value[1])
 
-    cal1_sv = m_config['cal1_sv'] * 1000 / m_config['cal1_cpm']
-    cal2_sv = m_config['cal2_sv'] * 1000 / m_config['cal2_cpm']
-    cal3_sv = m_config['cal3_sv'] * 1000 / m_config['cal3_cpm']
-    cal_sv = (cal1_sv + cal2_sv + cal3_sv) / 3
 
-    if m_verbose == 2:
-        print("calibration value 1 from device: {:d} CPM = {:.2f} uSievert/h"
-              .format(m_config['cal1_cpm'], m_config['cal1_sv']))
-        print("calibration value 2 from device: {:d} CPM = {:.2f} uSievert/h"
-              .format(m_config['cal2_cpm'], m_config['cal2_sv']))
-        print("calibration value 3 from device: {:d} CPM = {:.2f} uSievert/h"
-              .format(m_config['cal3_cpm'], m_config['cal3_sv']))
-        print("using the average of calibration values: {:d} CPM = {:.2f} uSievert/h"
-              .format(1000, cal_sv))
+def get_save_mode(save_mode):
+    if save_mode in SAVE_MODE:
+        return SAVE_MODE[save_mode]
+    return '', '[UNKNOWN]'
 
-    return 1000, cal_sv
+
+def get_header_time(date):
+    # returns the start time of a history segment (year, month, day, hour,
+    # minute, second), or None if the date isn't valid
+    try:
+        return datetime.datetime(2000 + date[0], date[1], date[2], date[3], date[4], date[5])
+    except ValueError:
+        return None
 
 
 def print_data(out_file, data_type, c_str, size=1, cpm_to_usievert=None):
     if size < 5:
         c_value = 0
-        for i in range(size):
-            c_value = c_value * 256 + ord(c_str[i])
-        value = convert_cpm_to_usievert(c_value, data_type, cpm_to_usievert)
+        for c in bytearray(c_str[:size]):
+            c_value = c_value * 256 + c
 
     else:
         return '(unsupported size: {})'.format(size)
 
+    return format_value(c_value, data_type, cpm_to_usievert)
+
+
+def format_value(c_value, data_type, cpm_to_usievert=None):
+    value = convert_cpm_to_usievert(c_value, data_type, cpm_to_usievert)
+
     if value[1] is None or value[1] == '':
         return None
     elif value[1] == 'uSv/h':
@@ -314,6 +1459,47 @@ def print_data(out_file, data_type, c_str, size=1, cpm_to_usievert=None):
         return '{:d},{:s}'.format(value[0], value[1])
 
 
+def get_sample_table(data_type, cpm_to_usievert=None):
+    # all 256 possible one byte values, formatted as csv rows
+    table = []
+    for c in range(256):
+        value = format_value(c, data_type, cpm_to_usievert)
+        if value is None:
+            table.append('')
+        else:
+            table.append(value + EOL)
+    return table
+
+
+class SampleFormatter(object):
+    """
+    Formats samples as csv rows (including the end of line), an empty row if
+    the value isn't logged. The rows of all 256 one byte values are formatted
+    once per data type, the rows of larger values are cached.
+    """
+
+    def __init__(self, cpm_to_usievert=None):
+        self.cpm_to_usievert = cpm_to_usievert
+        self.tables = {}
+        self.rows = {}
+
+    def table(self, data_type):
+        if data_type not in self.tables:
+            self.tables[data_type] = get_sample_table(data_type, self.cpm_to_usievert)
+        return self.tables[data_type]
+
+    def row(self, value, data_type):
+        key = (value, data_type)
+        row = self.rows.get(key)
+        if row is None:
+            if len(self.rows) >= VALUE_CACHE_SIZE:
+                self.rows.clear()
+            row = format_value(value, data_type, self.cpm_to_usievert)
+            row = '' if row is None else row + EOL
+            self.rows[key] = row
+        return row
+
+
 def parse_data_file(in_file=DEFAULT_BIN_FILE, out_file=DEFAULT_CSV_FILE,
                     cpm_to_usievert=None):
     if in_file is None:
@@ -322,96 +1508,82 @@ def parse_data_file(in_file=DEFAULT_BIN_FILE, out_file=DEFAULT_CSV_FILE,
         print("parsing file '" + in_file + "', and storing data to '" +
               out_file + "'")
 
+    remove_checkpoint(out_file)
     marker = 0
     eof_count = 0
     data_type = '*'
+    formatter = SampleFormatter(cpm_to_usievert)
+    table = formatter.table(data_type)
+    lines = []
+    data = bytearray()
+    size = 0
+    pos = 0
+    eof = False
     f_in = open(in_file, 'rb')
-    f_out = open(out_file, 'w')
+    f_out = open_text(out_file)
 
     while True:
-        c_str = f_in.read(1)
-        if c_str == '':
+        # write the csv rows in large chunks
+        if len(lines) >= WRITE_LINES:
+            f_out.write(''.join(lines))
+            del lines[:]
+
+        # read the next block before the longest command (a note of 255
+        # bytes) could reach the end of the data
+        if not eof and size - pos < 0x200:
+            del data[:pos]
+            pos = 0
+            while not eof and len(data) < 0x200:
+                block = f_in.read(DEFAULT_BLOCK_SIZE)
+                eof = len(block) < DEFAULT_BLOCK_SIZE
+                data += block
+            size = len(data)
+        if pos >= size:
             break
-        c = ord(c_str)
+
+        c = data[pos]
+        pos += 1
 
         # handle commands and large values
         if marker == 0x55aa:
             # command: set count type
             if c == 0x00:
-                data = f_in.read(9)
-                if data == '' or len(data) < 9:
+                if pos + 9 > size:
                     break
 
-                save_mode = ord(data[8])
-                if save_mode == 0:
-                    data_type = ''
-                    mode_str = 'off'
-                elif save_mode == 1:
-                    data_type = 'CPS'
-                    mode_str = 'every second'
-                elif save_mode == 2:
-                    data_type = 'CPM'
-                    mode_str = 'every minute'
-                elif save_mode == 3:
-                    data_type = 'CPM'
-                    mode_str = 'every hour'
-                elif save_mode == 4:
-                    data_type = 'CPS'
-                    mode_str = 'every second - threshold'
-                elif save_mode == 5:
-                    data_type = 'CPM'
-                    mode_str = 'every minute - threshold'
-                else:
-                    data_type = ''
-                    mode_str = '[UNKNOWN]'
-
-                f_out.write(',,20%02d/%02d/%02d %02d:%02d:%02d,%s' %
-                    (ord(data[0]), ord(data[1]), ord(data[2]), ord(data[3]),
-                     ord(data[4]), ord(data[5]), mode_str) + EOL)
+                save_mode = data[pos + 8]
+                data_type, mode_str = get_save_mode(save_mode)
+                table = formatter.table(data_type)
 
-            # command: two byte value (large numbers)
-            elif c == 0x01:
-                data = f_in.read(2)
-                if data == '' or len(data) < 2:
-                    break
-
-                value = print_data(f_out, data_type, data, size=2,
-                                   cpm_to_usievert=cpm_to_usievert)
-                f_out.write(value + EOL)
+                lines.append(',,20%02d/%02d/%02d %02d:%02d:%02d,%s' %
+                    (data[pos], data[pos + 1], data[pos + 2], data[pos + 3],
+                     data[pos + 4], data[pos + 5], mode_str) + EOL)
+                pos += 9
 
-            # command: three byte value (very large numbers)
-            elif c == 0x02:
-                data = f_in.read(3)
-                if data == '' or len(data) < 3:
+            # command: two, three or four byte value (large numbers)
+            elif c == 0x01 or c == 0x02 or c == 0x03:
+                length = c + 1
+                if pos + length > size:
                     break
 
-                value = print_data(f_out, data_type, data, size=3,
-                                   cpm_to_usievert=cpm_to_usievert)
-                f_out.write(value + EOL)
-
-            # command: four byte value (huge numbers)
-            elif c == 0x03:  # TODO: test me ;)
-                data = f_in.read(4)
-                if data == '' or len(data) < 4:
-                    break
-
-                value = print_data(f_out, data_type, data, size=4,
-                                   cpm_to_usievert=cpm_to_usievert)
-                f_out.write(value + EOL)
+                c_value = 0
+                for x in range(pos, pos + length):
+                    c_value = c_value * 256 + data[x]
+                lines.append(formatter.row(c_value, data_type))
+                pos += length
 
             # command: note
             elif c == 0x04:
-                data = f_in.read(1)
-                if data == '':
+                if pos >= size:
                     break
 
-                length = ord(data)
-                data = f_in.read(length)
-                f_out.write(',,,,' + data + EOL)
+                length = data[pos]
+                lines.append(',,,,' + to_str(data[pos + 1:pos + 1 + length]) + EOL)
+                pos += 1 + length
 
             # command: unknown/unsupported
             else:
-                f_out.write(',,,,[%d?]' % c + EOL)
+                lines.append(',,,,[%d?]' % c + EOL)
 
             marker = 0
             # end of command
@@ -425,8 +1597,7 @@ def parse_data_file(in_file=DEFAULT_BIN_FILE, out_file=DEFAULT_CSV_FILE,
                 continue
             else:
                 # possible command turns out to be a regular value
-                f_out.write(print_data(f_out, data_type, chr(0x55), size=1,
-                                       cpm_to_usievert=cpm_to_usievert) + EOL)
+                lines.append(table[0x55])
                 marker = 0
         else:
             marker = 0
@@ -436,369 +1607,626 @@ def parse_data_file(in_file=DEFAULT_BIN_FILE, out_file=DEFAULT_CSV_FILE,
             marker = 0x55
             continue
 
-        value = print_data(f_out, data_type, c_str, size=1,
-                           cpm_to_usievert=cpm_to_usievert)
-        if value is not None:
-            f_out.write(value + EOL)
+        lines.append(table[c])
 
         # detect end of file, this is needed if the device is still logging but
         # hasn't reached the end of the flash memory yet
-        if ord(c_str[0]) == 0xff:
+        if c == 0xff:
             eof_count += 1
             if eof_count == 100:
                 break
         else:
             eof_count = 0
 
+    f_out.write(''.join(lines))
     f_in.close()
     f_out.close()
 
 
-def exit_gracefully(signum, frame):
-    global m_terminate
-    m_terminate = True
-
-
-def set_heartbeat(enable, cpm_to_usievert=None):
-    if m_device is None:
-        print('ERROR: no device connected')
-        return -1
-
-    if enable:
-        m_device.write('<HEARTBEAT1>>')
-
-        signal.signal(signal.SIGINT, exit_gracefully)
-        signal.signal(signal.SIGTERM, exit_gracefully)
-
-        try:
-            while not m_terminate:
-                cpm = m_device.read(2)
-                if cpm == '':
-                    continue
-                value = struct.unpack(">H", cpm)[0] & 0x3fff
-
-                unit_value = (value, 'CPS')
-                if cpm_to_usievert is not None:
-                    unit_value = convert_cpm_to_usievert(value, 'CPS', cpm_to_usievert)
-
-                if unit_value[1] == 'uSv/h':
-                    print('{:.4f} {:s}'.format(unit_value[0], unit_value[1]))
+class HistoryDecoder(object):
+    """
+    Incremental decoder for the history data stored in flash. Data is fed in
+    blocks of any size (commands split over two blocks are kept until the next
+    block arrives), and decoded into a list of events:
+
+    (EVENT_HEADER, offset, (year, month, day, hour, minute, second), save_mode)
+    (EVENT_SAMPLES, offset, bytearray of one byte values)
+    (EVENT_VALUE, offset, value, size)
+    (EVENT_NOTE, offset, note)
+    (EVENT_UNKNOWN, offset, command)
+
+    The offset is the position of the event in the binary data. The decoding
+    rules (and the end of file detection) are the same as in parse_data_file().
+    """
+
+    def __init__(self):
+        self.marker = 0
+        self.eof_count = 0
+        self.save_mode = None
+        self.data_type = '*'
+        self.finished = False
+        self.offset = 0  # offset of the first byte in the buffer
+        self._buffer = bytearray()
+
+    def feed(self, data, final=False):
+        buf = self._buffer
+        buf += data
+        events = []
+        pos = 0
+        size = len(buf)
+
+        while pos < size and not self.finished:
+            if self.marker == 0x55aa:
+                used = self._command(buf, pos, final, events)
+                if used == 0:
+                    # wait for the rest of the command
+                    break
+                pos += used
+                self.marker = 0
+
+            elif self.marker == 0x55:
+                if buf[pos] == 0xaa:
+                    # command detected, handle it in the next loop
+                    self.marker = 0x55aa
+                    pos += 1
                 else:
-                    print('{:d} {:s}'.format(unit_value[0], unit_value[1]))
-
-        except KeyboardInterrupt:
-            print("")
-        except serial.SerialException:
-            pass
-        finally:
-            # make sure we stop the heartbeat
-            m_device.write('<HEARTBEAT0>>')
-
-    else:
-        m_device.write('<HEARTBEAT0>>')
-        while True:
-            x = m_device.read(1)
-            sys.stdout.write('.')
-            if x == '':
-                break
-        if m_verbose == 2:
-            print("ok")
-
-
-def get_temperature():
-    if m_device is None:
-        print('ERROR: no device connected')
-        return -1
-
-    m_device.write('<GETTEMP>>')
-    temp = m_device.read(4)
-
-    if temp == '' or len(temp) < 4:
-        print('WARNING: no valid temperature received')
-        return ''
-
-    sign = ''
-    if ord(temp[2]) != 0:
-        sign = '-'
-    temp_str = u'{:s}{:d}.{:d} {:s}{:s}' \
-               .format(sign, ord(temp[0]), ord(temp[1]), unichr(0x00B0), unichr(0x0043))
-    return temp_str.encode('utf-8')
-
-
-def get_gyro():
-    if m_device is None:
-        print('ERROR: no device connected')
-        return -1
-
-    m_device.write('<GETGYRO>>')
-    gyro = m_device.read(7)
-
-    if gyro == '' or len(gyro) < 7:
-        print('WARNING: no valid gyro data received')
-        return ''
-
-    (x, y, z, dummy) = struct.unpack(">hhhB", gyro)
-    return "x:{}, y:{}, z:{}".format(x, y, z)
-
-
-def get_config():
-    global m_config_data, m_config
-
-    if m_device is None:
-        print('ERROR: no device connected')
-        return -1
-
-    if m_device_name in CONFIGURATION_BUFFER_SIZE:
-        size = CONFIGURATION_BUFFER_SIZE[m_device_name]
-    else:
-        size = DEFAULT_CONFIGURATION_SIZE
+                    # possible command turns out to be a regular value
+                    events.append((EVENT_SAMPLES, self.offset + pos - 1, bytearray(b'\x55')))
+                    self.marker = 0
 
-    m_device.write('<GETCFG>>')
-    data = m_device.read(size)
-
-    if data == '' or len(data) == 0:
-        print("WARNING: reading device configuration failed")
-        return -1
-
-    m_config_data = ctypes.create_string_buffer(data)
-
-    m_config = {}
-    m_config['cal1_cpm'] = ord(m_config_data[ADDRESS_CALIBRATE1_CPM]) * 256 \
-                           + ord(m_config_data[ADDRESS_CALIBRATE1_CPM + 1])
-    m_config['cal1_sv'] = struct.unpack(">f",
-                                        m_config_data[ADDRESS_CALIBRATE1_SV:ADDRESS_CALIBRATE1_SV + 4])[0]
-    m_config['cal2_cpm'] = ord(m_config_data[ADDRESS_CALIBRATE2_CPM]) * 256 \
-                           + ord(m_config_data[ADDRESS_CALIBRATE2_CPM + 1])
-    m_config['cal2_sv'] = struct.unpack(">f",
-                                        m_config_data[ADDRESS_CALIBRATE2_SV:ADDRESS_CALIBRATE2_SV + 4])[0]
-    m_config['cal3_cpm'] = ord(m_config_data[ADDRESS_CALIBRATE3_CPM]) * 256 \
-                           + ord(m_config_data[ADDRESS_CALIBRATE3_CPM + 1])
-    m_config['cal3_sv'] = struct.unpack(">f",
-                                        m_config_data[ADDRESS_CALIBRATE3_SV:ADDRESS_CALIBRATE3_SV + 4])[0]
-    m_config['server_website'] = m_config_data[ADDRESS_SERVER_WEBSITE:ADDRESS_SERVER_WEBSITE + 32]
-    m_config['server_url'] = m_config_data[ADDRESS_SERVER_URL:ADDRESS_SERVER_URL + 32]
-    m_config['user_id'] = m_config_data[ADDRESS_USER_ID:ADDRESS_USER_ID + 16]
-    m_config['counter_id'] = m_config_data[ADDRESS_COUNTER_ID:ADDRESS_COUNTER_ID + 16]
-    if ord(m_config_data[ADDRESS_WIFI_ON_OFF]) == 255:
-        m_config['wifi_active'] = True
-    else:
-        m_config['wifi_active'] = False
-    m_config['wifi_ssid'] = m_config_data[ADDRESS_WIFI_SSID:ADDRESS_WIFI_SSID + 16]
-    m_config['wifi_password'] = m_config_data[ADDRESS_WIFI_PASSWORD:ADDRESS_WIFI_PASSWORD + 16]
-    # TODO: figure out the other configuration parameters...
-
-
-def list_config():
-    # make sure the cached config is up to date
-    if m_config_data is None:
-        get_config()
-
-    dump_data(m_config_data)
-
-    print("server website: {}".format(m_config['server_website']))
-    print("server url: {}".format(m_config['server_url']))
-    print("user id: {}".format(m_config['user_id']))
-    print("counter id: {}".format(m_config['counter_id']))
-    print("wifi active: {}".format(str(m_config['wifi_active'])))
-    print("wifi ssid: {}".format(m_config['wifi_ssid']))
-    print("wifi password: {}".format(m_config['wifi_password']))
-    print("calibrate 1: {:d} cpm = {:.2f} sv"
-          .format(m_config['cal1_cpm'], m_config['cal1_sv']))
-    print("calibrate 2: {:d} cpm = {:.2f} sv"
-          .format(m_config['cal2_cpm'], m_config['cal2_sv']))
-    print("calibrate 3: {:d} cpm = {:.2f} sv"
-          .format(m_config['cal3_cpm'], m_config['cal3_sv']))
-
-
-def write_config(parameters):
-    global m_config_data
-
-    if m_device_name == 'GMC-280' or \
-       m_device_name == 'GMC-300' or \
-       m_device_name == 'GMC-320':
-        address_size = 'B'  # 1 byte address
-    elif m_device_name == 'GMC-500':
-        address_size = 'H'  # 2 byte address
-    else:
-        print('ERROR: device not supported, feature not available')
-        return
-
-    # make sure the cached config is up to date
-    if m_config_data is None:
-        get_config()
-
-    # update the cached configuration (in memory)
-    for par in parameters:
-        par_value = par.split('=')
-        if len(par_value) != 2:
-            print("WARNING: skipping parameter '{}', it doesn't seem to contain a 'parameter-name=value' pair."
-                  .format(par))
-            continue
-
-        if par_value[0] == 'cal1-cpm':
-            struct.pack_into('>H', m_config_data, ADDRESS_CALIBRATE1_CPM,
-                             int(par_value[1]))
-        elif par_value[0] == 'cal1-sv':
-            struct.pack_into('>f', m_config_data, ADDRESS_CALIBRATE1_SV,
-                             float(par_value[1]))
-        elif par_value[0] == 'cal2-cpm':
-            struct.pack_into('>H', m_config_data, ADDRESS_CALIBRATE2_CPM,
-                             int(par_value[1]))
-        elif par_value[0] == 'cal2-sv':
-            struct.pack_into('>f', m_config_data, ADDRESS_CALIBRATE2_SV,
-                             float(par_value[1]))
-        elif par_value[0] == 'cal3-cpm':
-            struct.pack_into('>H', m_config_data, ADDRESS_CALIBRATE3_CPM,
-                             int(par_value[1]))
-        elif par_value[0] == 'cal3-sv':
-            struct.pack_into('>f', m_config_data, ADDRESS_CALIBRATE3_SV,
-                             float(par_value[1]))
+            else:
+                # everything up to the next command is a regular value
+                end = buf.find(b'\x55\xaa', pos)
+                if end < 0:
+                    end = size
+                    if buf[end - 1] == 0x55:
+                        # possible command split over two blocks
+                        end -= 1
+                if end > pos:
+                    self._samples(buf[pos:end], self.offset + pos, events)
+                if end < size and not self.finished:
+                    self.marker = 0x55
+                    end += 1
+                pos = end
+
+        self.offset += pos
+        del buf[:pos]
+        if final:
+            self.finished = True
+        return events
+
+    def close(self):
+        return self.feed(b'', final=True)
+
+    def _samples(self, samples, offset, events):
+        # detect end of file, this is needed if the device is still logging but
+        # hasn't reached the end of the flash memory yet. a 0x55 value doesn't
+        # affect the end of file detection, so leave them out.
+        values = samples
+        if b'\x55' in samples:
+            values = samples.replace(b'\x55', b'')
+
+        end = -1
+        if self.eof_count > 0:
+            leading = len(values) - len(values.lstrip(b'\xff'))
+            if self.eof_count + leading >= EOF_COUNT:
+                end = EOF_COUNT - self.eof_count
+        if end < 0:
+            end = values.find(b'\xff' * EOF_COUNT)
+            if end >= 0:
+                end += EOF_COUNT
+
+        if end >= 0:
+            if values is not samples:
+                # find the position of the last value in the original samples
+                count = 0
+                for pos, c in enumerate(samples):
+                    if c != 0x55:
+                        count += 1
+                        if count == end:
+                            break
+                end = pos + 1
+            events.append((EVENT_SAMPLES, offset, samples[:end]))
+            self.finished = True
+            return
+
+        events.append((EVENT_SAMPLES, offset, samples))
+        trailing = len(values) - len(values.rstrip(b'\xff'))
+        if trailing == len(values):
+            self.eof_count += trailing
         else:
-            print("WARNING: parameter with name '{}' not supported".format(par_value[0]))
-
-    # erase all stored parameters in flash
-    m_device.write('<ECFG>>')
-    if not command_returned_ok():
-        print("WARNING: erase operation failed, parameters not stored on device")
-        return
-
-    if m_device_name in CONFIGURATION_BUFFER_SIZE:
-        size = CONFIGURATION_BUFFER_SIZE[m_device_name]
-    else:
-        size = DEFAULT_CONFIGURATION_SIZE
+            self.eof_count = trailing
+
+    def _command(self, buf, pos, final, events):
+        # returns the number of bytes used, or 0 if the command is incomplete
+        c = buf[pos]
+        available = len(buf) - pos - 1
+        offset = self.offset + pos - 2
+
+        # command: set count type
+        if c == 0x00:
+            if available < 9:
+                return self._incomplete(final)
+            data = buf[pos + 1:pos + 10]
+            self.save_mode = data[8]
+            self.data_type = get_save_mode(self.save_mode)[0]
+            events.append((EVENT_HEADER, offset, tuple(data[0:6]), self.save_mode))
+            return 10
+
+        # command: two, three or four byte value (large numbers)
+        elif c == 0x01 or c == 0x02 or c == 0x03:
+            size = c + 1
+            if available < size:
+                return self._incomplete(final)
+            value = 0
+            for x in range(pos + 1, pos + 1 + size):
+                value = value * 256 + buf[x]
+            events.append((EVENT_VALUE, offset, value, size))
+            return size + 1
+
+        # command: note
+        elif c == 0x04:
+            if available < 1:
+                return self._incomplete(final)
+            length = buf[pos + 1]
+            if available < length + 1 and not final:
+                return 0
+            note = bytes(buf[pos + 2:pos + 2 + length])
+            events.append((EVENT_NOTE, offset, note))
+            return min(length + 2, available + 1)
+
+        # command: unknown/unsupported
+        else:
+            events.append((EVENT_UNKNOWN, offset, c))
+            return 1
+
+    def _incomplete(self, final):
+        if final:
+            # a truncated command ends the log
+            self.finished = True
+        return 0
+
+
+def parse_data_file_fast(in_file=DEFAULT_BIN_FILE, out_file=DEFAULT_CSV_FILE,
+                         cpm_to_usievert=None, block_size=DEFAULT_BLOCK_SIZE, resume=False):
+    # with resume, a checkpoint is stored next to the csv file at the end of
+    # the history data. when the binary file is parsed again (e.g. a longer
+    # download of the same device) and still starts with the same data, the
+    # rows after the checkpoint are replaced by the rows of the new data.
+    if in_file is None:
+        in_file = DEFAULT_BIN_FILE
+    if m_verbose >= 1:
+        print("parsing file '" + in_file + "', and storing data to '" +
+              out_file + "'")
 
-    # write all cached parameters (from memory) into the device
-    for i in range(size):
-        cmd = struct.pack('>' + address_size + 'B', i, ord(m_config_data[i]))
-        m_device.write('<WCFG' + cmd + '>>')
-        if not command_returned_ok():
-            print("WARNING: write operation failed at address 0x%02X, (some) parameters not stored to device" % i)
+    decoder = HistoryDecoder()
+    prefix_hash = hashlib.sha1()
+    csv_size = 0
+    mode = 'w'
+    if resume:
+        previous = load_checkpoint(in_file, out_file, cpm_to_usievert)
+        if previous is not None:
+            previous, prefix_hash = previous
+            decoder.offset = previous['offset']
+            decoder.marker = previous['marker']
+            decoder.save_mode = previous['save_mode']
+            decoder.data_type = previous['data_type']
+            decoder.eof_count = previous['eof_count']
+            csv_size = previous['csv_size']
+            mode = 'r+'
+            if m_verbose >= 2:
+                print("continuing at offset {} of '{}'".format(decoder.offset, in_file))
+    remove_checkpoint(out_file)
+
+    # the checkpoint is taken at the end of the history data, the data after
+    # it is erased flash which is overwritten by the next download
+    end = max(decoder.offset, get_history_end(in_file))
+    length = get_data_length(in_file)
+    formatter = SampleFormatter(cpm_to_usievert)
+    data_type = decoder.data_type
+    checkpoint = None
+
+    with open(in_file, 'rb') as f_in, open_text(out_file, mode) as f_out:
+        f_out.seek(csv_size)
+        f_out.truncate()
+        f_in.seek(decoder.offset)
+        blocks = itertools.chain(read_blocks(f_in, block_size, end - decoder.offset), [None],
+                                 read_blocks(f_in, block_size, max(0, length - end) if length >= 0 else -1),
+                                 [b''])
+        pending = bytearray()
+
+        while not decoder.finished:
+            block = next(blocks)
+            if block is None:
+                # the end of the history data is reached
+                checkpoint = get_checkpoint(decoder, prefix_hash, f_out.tell(), cpm_to_usievert)
+                continue
 
-    # make the change permanent (write flash)
-    m_device.write('<CFGUPDATE>>')
-    if not command_returned_ok():
-        print("WARNING: update operation failed, parameters not stored on device")
-        return
+            offset = decoder.offset
+            events = decoder.feed(block, final=len(block) == 0)
+            if checkpoint is None:
+                # hash the data used by the decoder (the rest is kept by the
+                # decoder until the next block arrives)
+                pending += block
+                prefix_hash.update(bytes(pending[:decoder.offset - offset]))
+                del pending[:decoder.offset - offset]
+
+            lines, data_type = format_events(events, formatter, data_type)
+            f_out.write(''.join(lines))
+
+    if resume and checkpoint is not None:
+        save_checkpoint(out_file, checkpoint)
+
+
+def get_history_end(in_file):
+    # the end of the history data (after the last byte which isn't erased)
+    info = load_data_info(in_file)
+    if info is not None:
+        return info['end']
+
+    with open(in_file, 'rb') as f_in:
+        end = os.path.getsize(in_file)
+        while end > 0:
+            start = max(0, end - FLASH_PAGE_SIZE)
+            f_in.seek(start)
+            used = len(f_in.read(end - start).rstrip(b'\xff'))
+            if used > 0:
+                return start + used
+            end = start
+    return 0
 
 
-def get_date_and_time():
-    if m_device is None:
-        print('ERROR: no device connected')
+def get_data_length(in_file):
+    # no need to read beyond the end of the history data (the margin covers
+    # the end of file detection and the last command), -1 if unknown
+    info = load_data_info(in_file)
+    if info is None:
         return -1
+    return info['end'] + FLASH_PAGE_SIZE
 
-    m_device.write('<GETDATETIME>>')
-    date = m_device.read(7)
-
-    if date == '' or len(date) < 7:
-        print('WARNING: no valid date received')
-        return ''
 
-    (year, month, day, hour, minute, second, dummy) = struct.unpack(">BBBBBBB", date)
-    return "{}/{}/{} {}:{}:{}".format(year, month, day, hour, minute, second)
-
-
-def set_date_and_time(date_time):
-    if m_device is None:
-        print('ERROR: no device connected')
-        return -1
-
-    cmd = struct.pack('>BBBBBB',
-                      date_time.year - 2000,
-                      date_time.month,
-                      date_time.day,
-                      date_time.hour,
-                      date_time.minute,
-                      date_time.second)
-    m_device.write('<SETDATETIME' + cmd + '>>')
+def read_blocks(f_in, block_size=DEFAULT_BLOCK_SIZE, length=-1):
+    # yields the contents of a file in blocks, up to length bytes (if not -1)
+    while length != 0:
+        if length < 0:
+            block = f_in.read(block_size)
+        else:
+            block = f_in.read(min(block_size, length))
+            length -= len(block)
+        if len(block) == 0:
+            break
+        yield block
 
-    if not command_returned_ok():
-        print("WARNING: setting date and time not succeded")
 
+def format_events(events, formatter, data_type):
+    # formats decoded events as csv rows, returns the rows and the data type
+    # of the samples after the events
+    table = formatter.table(data_type)
+    lines = []
 
-def send_key(key):
-    if m_device is None:
-        print('ERROR: no device connected')
-        return -1
+    for event in events:
+        kind = event[0]
 
-    if key.lower() == 's1':
-        m_device.write('<KEY0>>')
+        if kind == EVENT_SAMPLES:
+            lines.append(''.join(map(table.__getitem__, event[2])))
 
-    elif key.lower() == 's2':
-        m_device.write('<KEY1>>')
+        elif kind == EVENT_HEADER:
+            data_type, mode_str = get_save_mode(event[3])
+            table = formatter.table(data_type)
+            lines.append(',,20%02d/%02d/%02d %02d:%02d:%02d,%s' %
+                         (event[2] + (mode_str,)) + EOL)
 
-    elif key.lower() == 's3':
-        m_device.write('<KEY2>>')
+        elif kind == EVENT_VALUE:
+            lines.append(formatter.row(event[2], data_type))
 
-    elif key.lower() == 's4':
-        m_device.write('<KEY3>>')
+        elif kind == EVENT_NOTE:
+            lines.append(',,,,' + to_str(event[2]) + EOL)
 
+        else:
+            lines.append(',,,,[%d?]' % event[2] + EOL)
+
+    return lines, data_type
+
+
+def parse_data_stream(stream, out_file=DEFAULT_CSV_FILE, cpm_to_usievert=None,
+                      flush=False):
+    # parse history data from an iterable of blocks (e.g. stream_data()), every
+    # block is written to the csv file before the next one is requested
+    remove_checkpoint(out_file)
+    decoder = HistoryDecoder()
+    data_type = decoder.data_type
+    formatter = SampleFormatter(cpm_to_usievert)
+    blocks = itertools.chain(stream, [b''])
+
+    with open_text(out_file) as f_out:
+        while not decoder.finished:
+            block = next(blocks)
+            lines, data_type = format_events(decoder.feed(block, final=len(block) == 0), formatter, data_type)
+            f_out.write(''.join(lines))
+            if flush:
+                f_out.flush()
+
+    # the end of the history data is found, stop reading
+    if hasattr(stream, 'close'):
+        stream.close()
+
+
+class HistoryLog(object):
+    """
+    Random access reader of a binary history file. An index of all segments
+    (the data following a '0x55 0xaa 0x00' header) is build once, and cached
+    next to the binary file ('<file>.idx'). Per segment the index holds the
+    byte offset, the start time, the sample interval, the number of samples
+    and the byte offset of every INDEX_STEP'th sample, so a query only decodes
+    the part of the (memory mapped) file covering the requested time range:
+
+        with HistoryLog('gq-gmc-log.bin') as log:
+            for timestamp, value, unit in log.samples(start, end):
+                ...
+    """
+
+    def __init__(self, in_file=DEFAULT_BIN_FILE, index_file=None, rebuild=False):
+        self.in_file = in_file
+        self.index_file = index_file or in_file + INDEX_SUFFIX
+        self._f_in = open(in_file, 'rb')
+        self._data = b''
+        if os.path.getsize(in_file) > 0:
+            self._data = mmap.mmap(self._f_in.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.segments = None
+        if not rebuild:
+            self.segments = self._load_index()
+        if self.segments is None:
+            self.segments = self._build_index()
+            self._save_index()
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._f_in.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _file_id(self):
+        stat = os.stat(self.in_file)
+        return [stat.st_size, int(stat.st_mtime)]
+
+    def _load_index(self):
+        if not os.path.isfile(self.index_file):
+            return None
 
-def firmware_update():
-    print('ERROR: option not yet available')
+        try:
+            with open(self.index_file, 'r') as f_in:
+                index = json.load(f_in)
+        except ValueError:
+            return None
 
+        if index.get('version') != INDEX_VERSION or index.get('file') != self._file_id():
+            return None
+        return index['segments']
 
-def factory_reset():
-    if m_device is None:
-        print('ERROR: no device connected')
-        return -1
+    def _save_index(self):
+        try:
+            with open(self.index_file, 'w') as f_out:
+                json.dump({'version': INDEX_VERSION,
+                           'file': self._file_id(),
+                           'segments': self.segments}, f_out)
+        except IOError:
+            print("WARNING: unable to store the history index '{}'".format(self.index_file))
+
+    def _build_index(self):
+        segments = []
+        segment = None
+        decoder = HistoryDecoder()
+        end = len(self._data)
+        info = load_data_info(self.in_file)
+        if info is not None:
+            end = min(end, info['end'] + FLASH_PAGE_SIZE)
+
+        for pos in range(0, end, DEFAULT_BLOCK_SIZE):
+            if decoder.finished:
+                break
+            block = self._data[pos:min(pos + DEFAULT_BLOCK_SIZE, end)]
+
+            for event in decoder.feed(block, final=pos + len(block) >= end):
+                kind = event[0]
+
+                if kind == EVENT_HEADER:
+                    segment = {
+                        'offset': event[1],
+                        'date': list(event[2]),
+                        'save_mode': event[3],
+                        'interval': SAVE_MODE_INTERVAL.get(event[3], 0),
+                        'count': 0,
+                        'end': event[1] + 12,
+                        'checkpoints': [[0, event[1] + 12]]
+                    }
+                    segments.append(segment)
+
+                elif segment is None:
+                    # samples without a header have no time
+                    continue
 
-    m_device.write('<FACTORYRESET>>')
+                elif kind == EVENT_SAMPLES:
+                    size = len(event[2])
+                    step = -(-segment['count'] // INDEX_STEP) * INDEX_STEP or INDEX_STEP
+                    while step < segment['count'] + size:
+                        segment['checkpoints'].append([step, event[1] + step - segment['count']])
+                        step += INDEX_STEP
+                    segment['count'] += size
+                    segment['end'] = event[1] + size
+
+                elif kind == EVENT_VALUE:
+                    if segment['count'] % INDEX_STEP == 0 and segment['count'] > 0:
+                        segment['checkpoints'].append([segment['count'], event[1]])
+                    segment['count'] += 1
+                    segment['end'] = event[1] + 3 + event[3]
+
+        return segments
+
+    def samples(self, start=None, end=None, cpm_to_usievert=None):
+        # yields (timestamp, value, unit) of all samples with start <= timestamp
+        # < end, in which start and end are datetime objects (or None)
+        for segment in self.segments:
+            seg_start = get_header_time(segment['date'])
+            interval = segment['interval']
+            data_type = get_save_mode(segment['save_mode'])[0]
+            if seg_start is None or interval == 0 or data_type == '' or segment['count'] == 0:
+                continue
 
-    if not command_returned_ok():
-        print("WARNING: factory reset not succeded")
+            # the range of samples within this segment
+            first = 0
+            last = segment['count']
+            if start is not None:
+                first = max(first, -int((seg_start - start).total_seconds() // interval))
+            if end is not None:
+                last = min(last, -int((seg_start - end).total_seconds() // interval))
+            if first >= last:
+                continue
 
+            # start decoding at the last checkpoint before the first sample
+            index, offset = segment['checkpoints'][0]
+            for checkpoint in segment['checkpoints']:
+                if checkpoint[0] > first:
+                    break
+                index, offset = checkpoint
+
+            decoder = HistoryDecoder()
+            decoder.offset = offset
+            for event in decoder.feed(self._data[offset:segment['end']], final=True):
+                if event[0] == EVENT_SAMPLES:
+                    values = event[2]
+                elif event[0] == EVENT_VALUE:
+                    values = [event[2]]
+                else:
+                    continue
 
-def reboot():
-    if m_device is None:
-        print('ERROR: no device connected')
-        return -1
+                skip = max(0, first - index)
+                for value in itertools.islice(values, skip, last - index):
+                    timestamp = seg_start + datetime.timedelta(seconds=(index + skip) * interval)
+                    value, unit = convert_cpm_to_usievert(value, data_type, cpm_to_usievert)
+                    yield timestamp, value, unit
+                    skip += 1
 
-    m_device.write('<REBOOT>>')
+                index += len(values)
+                if index >= last:
+                    break
 
 
 def dump_data(data):
-    for d in range(len(data)):
-        print("0x{:02x} 0x{:02x} ({:s})".format(d, ord(data[d]), data[d]))
-
-
-def open_device(port=None, baud_rate=115200, skip_check=False, device_type=None,
-                allow_fail=False):
-    global m_device, m_device_name
+    for d, c in enumerate(bytearray(data)):
+        print("0x{:02x} 0x{:02x} ({:s})".format(d, c, chr(c)))
 
-    if port is None or port == '':
-        port = DEFAULT_PORT
 
-    try:
-        m_device = serial.Serial(port, baudrate=baud_rate, timeout=1.0)
-    except serial.serialutil.SerialException:
-        if not allow_fail:
-            if platform.system() == 'Windows':
-                print("ERROR: No device found (use the '-p COM1' option and provide the correct port)")
-            else:
-                print("ERROR: No device found (use the '-p /dev/ttyUSB0' option and provide the correct port, or install the udev rule as described in the INSTALL file)")
-        return -1
+def set_verbose_level(verbose):
+    global m_verbose
+    m_verbose = verbose
 
-    clear_port()
 
-    res = 0
-    if not skip_check:
-        res = check_device_type()
+def read_device(port, out_file=None, cpm_to_usievert=None, skip_check=False,
+                device_type=None, baud_rate=DEFAULT_BAUD_RATE):
+    # read the CPM, and the history data if out_file is provided, of a single
+    # device ('{serial}' and '{port}' in out_file are replaced by the serial
+    # number and port name). returns a dictionary with the results and the
+    # timing of every step (in seconds).
+    import serial
 
-    if device_type is not None:
-        if device_type == 'GMC-280' or \
-           device_type == 'GMC-300' or \
-           device_type == 'GMC-320' or \
-           device_type == 'GMC-500':
-            m_device_name = device_type
-            if m_verbose == 2:
-                print("using device-type: {}".format(m_device_name))
-        else:
-            print("WARNING: unsupported selected device type '{}', defaulting to '{}'"
-                  .format(device_type, m_device_name))
+    result = {'port': port, 'device_type': None, 'serial': None, 'cpm': None,
+              'out_file': out_file, 'size': 0, 'error': None, 'timing': {}}
+    start_time = time.time()
+    device = GMCDevice()
 
-    return res
-
-
-def set_verbose_level(verbose):
-    global m_verbose
-    m_verbose = verbose
+    try:
+        if device.open(port=port, baud_rate=baud_rate, skip_check=skip_check,
+                       device_type=device_type) != 0:
+            result['error'] = 'device not found or supported'
+            return result
+        result['device_type'] = device.device_type
+        result['timing']['open'] = time.time() - start_time
+
+        step_time = time.time()
+        result['serial'] = device.get_serial_number()
+        result['cpm'] = device.get_cpm(cpm_to_usievert=cpm_to_usievert)
+        result['timing']['cpm'] = time.time() - step_time
+
+        if out_file is not None:
+            # the file name can contain the serial number and port name
+            out_file = out_file.format(serial=result['serial'], port=os.path.basename(port))
+            result['out_file'] = out_file
+            step_time = time.time()
+            if device.get_data(out_file=out_file) != 0:
+                result['error'] = 'reading the history data failed'
+                return result
+            result['size'] = os.path.getsize(out_file)
+            result['timing']['data'] = time.time() - step_time
+
+    except (serial.SerialException, OSError, IOError) as e:
+        result['error'] = str(e)
+
+    finally:
+        device.close()
+        result['timing']['total'] = time.time() - start_time
+
+    return result
+
+
+def read_devices(ports, out_files=None, cpm_to_usievert=None, skip_check=False,
+                 device_type=None, baud_rate=DEFAULT_BAUD_RATE, workers=None):
+    # read the CPM and history data of multiple devices in parallel, using a
+    # thread per device (or at most 'workers' threads). returns the results of
+    # read_device() in the order of the ports.
+    if out_files is None:
+        out_files = [None] * len(ports)
+    if workers is None:
+        workers = len(ports)
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(workers, len(ports))))
+    try:
+        return pool.map(lambda args: read_device(args[0], out_file=args[1],
+                                                 cpm_to_usievert=cpm_to_usievert,
+                                                 skip_check=skip_check,
+                                                 device_type=device_type,
+                                                 baud_rate=baud_rate),
+                        list(zip(ports, out_files)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+# module level interface, using a single default device (as used by the
+# command line tool)
+m_default_device = GMCDevice()
+
+open_device = m_default_device.open
+close_device = m_default_device.close
+command_returned_ok = m_default_device.command_returned_ok
+clear_port = m_default_device.clear_port
+check_device_type = m_default_device.check_device_type
+get_device_type = m_default_device.get_device_type
+get_serial_number = m_default_device.get_serial_number
+set_power = m_default_device.set_power
+get_voltage = m_default_device.get_voltage
+get_cpm = m_default_device.get_cpm
+get_data = m_default_device.get_data
+stream_data = m_default_device.stream_data
+read_flash = m_default_device.read_flash
+get_flash_size = m_default_device.get_flash_size
+sync_data = m_default_device.sync_data
+get_unit_conversion_from_device = m_default_device.get_unit_conversion_from_device
+set_heartbeat = m_default_device.set_heartbeat
+get_temperature = m_default_device.get_temperature
+get_gyro = m_default_device.get_gyro
+get_config = m_default_device.get_config
+list_config = m_default_device.list_config
+write_config = m_default_device.write_config
+get_date_and_time = m_default_device.get_date_and_time
+set_date_and_time = m_default_device.set_date_and_time
+send_key = m_default_device.send_key
+firmware_update = m_default_device.firmware_update
+factory_reset = m_default_device.factory_reset
+reboot = m_default_device.reboot
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+"""
+Archive of downloaded binary files (flash dumps). Every dump is split into
+flash pages (4 KByte, the size of a '<SPIR' request), which are stored once
+under their hash (compressed), and a manifest listing the page hashes of the
+dump. Consecutive dumps of a device share all pages except the ones written
+in between, so the archive only grows with the new history data:
+
+    <archive>/pages/<xx>/<sha1>               a page, xx the start of the hash
+    <archive>/manifests/<serial>-<time>.manifest
+
+A dump is read back from the archive page by page, e.g. to parse it without
+restoring the binary file:
+
+    archive, manifest = open_manifest(manifest_file)
+    gq_gmc.parse_data_stream(archive.blocks(manifest), 'gq-gmc-log.csv')
+"""
+
+import os
+import json
+import time
+import zlib
+import hashlib
+import gq_gmc
+
+DEFAULT_ARCHIVE_DIR = '~/.gq-gmc-control/archive'
+MANIFEST_SUFFIX = '.manifest'
+MANIFEST_VERSION = 1
+PAGE_SIZE = gq_gmc.FLASH_PAGE_SIZE
+
+
+class PageArchive(object):
+    """
+    A content addressed store of flash pages, and the manifests of the dumps.
+    """
+
+    def __init__(self, archive_dir=DEFAULT_ARCHIVE_DIR):
+        self.archive_dir = os.path.expanduser(archive_dir)
+        self.pages_dir = os.path.join(self.archive_dir, 'pages')
+        self.manifests_dir = os.path.join(self.archive_dir, 'manifests')
+
+    def page_file(self, page_hash):
+        return os.path.join(self.pages_dir, page_hash[:2], page_hash)
+
+    def add_page(self, page):
+        # stores a page if it isn't stored yet, returns its hash and whether
+        # it's new
+        page_hash = hashlib.sha1(page).hexdigest()
+        page_file = self.page_file(page_hash)
+        if os.path.isfile(page_file):
+            return page_hash, False
+
+        page_dir = os.path.dirname(page_file)
+        if not os.path.isdir(page_dir):
+            os.makedirs(page_dir)
+        # written under a temporary name first, so an interrupted write never
+        # leaves a partial page under its hash
+        tmp_file = page_file + '.tmp'
+        with open(tmp_file, 'wb') as f_out:
+            f_out.write(zlib.compress(bytes(page)))
+        os.rename(tmp_file, page_file)
+        return page_hash, True
+
+    def read_page(self, page_hash):
+        page_file = self.page_file(page_hash)
+        if not os.path.isfile(page_file):
+            raise IOError("page {} missing from the archive '{}'".format(page_hash, self.archive_dir))
+        with open(page_file, 'rb') as f_in:
+            page = zlib.decompress(f_in.read())
+        if hashlib.sha1(page).hexdigest() != page_hash:
+            raise IOError("page {} of the archive '{}' is corrupt".format(page_hash, self.archive_dir))
+        return page
+
+    def store(self, in_file, serial_number=None):
+        # adds a binary file to the archive, returns the manifest file
+        info = gq_gmc.load_data_info(in_file)
+        if serial_number is None and info is not None:
+            serial_number = info.get('serial')
+
+        pages = []
+        new_pages = 0
+        new_bytes = 0
+        with open(in_file, 'rb') as f_in:
+            for page in gq_gmc.read_blocks(f_in, PAGE_SIZE):
+                page_hash, new = self.add_page(page)
+                pages.append(page_hash)
+                if new:
+                    new_pages += 1
+                    new_bytes += len(page)
+
+        if not os.path.isdir(self.manifests_dir):
+            os.makedirs(self.manifests_dir)
+        created = time.time()
+        name = '{}-{}'.format(serial_number or 'unknown', time.strftime('%Y%m%d-%H%M%S', time.localtime(created)))
+        manifest_file = os.path.join(self.manifests_dir, name + MANIFEST_SUFFIX)
+        count = 1
+        while os.path.exists(manifest_file):
+            manifest_file = os.path.join(self.manifests_dir, '{}-{}{}'.format(name, count, MANIFEST_SUFFIX))
+            count += 1
+
+        with open(manifest_file, 'w') as f_out:
+            json.dump({'version': MANIFEST_VERSION,
+                       'file': os.path.basename(in_file),
+                       'serial': serial_number,
+                       'created': created,
+                       'size': os.path.getsize(in_file),
+                       'page_size': PAGE_SIZE,
+                       'info': info,
+                       'pages': pages}, f_out)
+
+        if gq_gmc.m_verbose >= 1:
+            print("archived '{}' to '{}': {} pages, {} new ({} bytes)"
+                  .format(in_file, manifest_file, len(pages), new_pages, new_bytes))
+        return manifest_file
+
+    def blocks(self, manifest):
+        # yields the pages of a dump, e.g. for gq_gmc.parse_data_stream()
+        for page_hash in manifest['pages']:
+            yield self.read_page(page_hash)
+
+    def restore(self, manifest, out_file):
+        # writes a dump (and its download information) to a binary file
+        with open(out_file, 'wb') as f_out:
+            for page in self.blocks(manifest):
+                f_out.write(page)
+
+        info = manifest['info']
+        if info is not None:
+            gq_gmc.save_data_info(out_file, info['address'], info['length'], info['end'], info['full_dump'],
+                                  info.get('serial'))
+
+
+def open_manifest(manifest_file):
+    # returns the archive of a manifest (the archive directory containing the
+    # manifests directory) and the manifest, or None if it can't be read
+    try:
+        with open(manifest_file, 'r') as f_in:
+            manifest = json.load(f_in)
+    except (IOError, ValueError) as e:
+        print("ERROR: unable to read the manifest '{}' ({})".format(manifest_file, e))
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('page_size') != PAGE_SIZE:
+        print("ERROR: unsupported manifest '{}'".format(manifest_file))
+        return None
+
+    archive_dir = os.path.dirname(os.path.dirname(os.path.abspath(manifest_file)))
+    return PageArchive(archive_dir), manifest
+
+
+def parse_manifest(manifest_file, out_file, output_format=gq_gmc.DEFAULT_OUTPUT_FORMAT, cpm_to_usievert=None):
+    # parses an archived dump, without restoring the binary file
+    result = open_manifest(manifest_file)
+    if result is None:
+        return -1
+    archive, manifest = result
+
+    if gq_gmc.m_verbose >= 1:
+        print("parsing archived dump '" + manifest_file + "', and storing data to '" + out_file + "'")
+
+    try:
+        if output_format == 'csv':
+            gq_gmc.parse_data_stream(archive.blocks(manifest), out_file, cpm_to_usievert=cpm_to_usievert)
+            return 0
+
+        import gq_gmc_columns
+        return gq_gmc_columns.parse_data_stream(archive.blocks(manifest), out_file, output_format,
+                                                cpm_to_usievert=cpm_to_usievert)
+    except IOError as e:
+        print("ERROR: {}".format(e))
+        return -1
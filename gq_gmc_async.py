@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+"""
+Asyncio interface to GQ GMC devices (Python 3.6+, Linux and OS X only). The
+tty is opened non-blocking and read by the event loop, so no thread is needed
+per device, e.g.:
+
+    async def main():
+        device = AsyncGMCDevice()
+        if await device.open('/dev/ttyUSB0') == 0:
+            print(await device.get_cpm())
+            async for cps in device.heartbeat():
+                print(cps)
+            device.close()
+
+    asyncio.get_event_loop().run_until_complete(main())
+"""
+
+import os
+import time
+import errno
+import struct
+import termios
+import asyncio
+import gq_gmc
+
+SUPPORTED_DEVICES = ['GMC-280', 'GMC-300', 'GMC-320', 'GMC-500']
+
+
+class AsyncGMCDevice(object):
+    """
+    A GQ GMC device, connected to a (serial) port. Received data is buffered
+    by a reader callback on the event loop, commands wait (with a timeout) for
+    the number of bytes they expect. Commands are serialized by a lock, a
+    heartbeat or history download holds the lock until its iteration stops (so
+    close it with aclose() when breaking out of the iteration early).
+    """
+
+    def __init__(self, loop=None, timeout=1.0):
+        self.loop = loop
+        self.timeout = timeout
+        self.port = None
+        self.fd = None
+        self.baud_rate = None
+        self.device_type = None
+        self.device_name = gq_gmc.DEFAULT_DEVICE_TYPE
+        self.serial_number = None
+        self._buffer = bytearray()
+        self._waiter = None
+        self._error = None
+        self._lock = None
+
+    async def open(self, port=None, baud_rate=gq_gmc.DEFAULT_BAUD_RATE, skip_check=False,
+                   device_type=None):
+        if port is None or port == '':
+            port = gq_gmc.DEFAULT_PORT
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+
+        try:
+            self.fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+            set_raw(self.fd, baud_rate)
+        except (OSError, termios.error, ValueError) as e:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            print("ERROR: No device found on '{}' ({})".format(port, e))
+            return -1
+
+        self.port = port
+        self.baud_rate = baud_rate
+        self._error = None
+        self._lock = asyncio.Lock()
+        self.loop.add_reader(self.fd, self._on_readable)
+
+        await self.clear_port()
+
+        res = 0
+        if not skip_check:
+            res = await self.check_device_type()
+
+        if device_type is not None:
+            if device_type in SUPPORTED_DEVICES:
+                self.device_name = device_type
+                if gq_gmc.m_verbose == 2:
+                    print("using device-type: {}".format(self.device_name))
+            else:
+                print("WARNING: unsupported selected device type '{}', defaulting to '{}'"
+                      .format(device_type, self.device_name))
+
+        return res
+
+    def close(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        self._wakeup()
+
+    def _on_readable(self):
+        try:
+            while True:
+                data = os.read(self.fd, 0x10000)
+                if not data:
+                    break
+                self._buffer += data
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            # e.g. EIO once the device is disconnected
+            self._error = e
+            self.loop.remove_reader(self.fd)
+        self._wakeup()
+
+    def _wakeup(self, waiter=None):
+        if waiter is None:
+            waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def _wait(self, timeout):
+        # wait until data is received, or the timeout (None for no timeout)
+        # expires
+        self._waiter = self.loop.create_future()
+        handle = None
+        if timeout is not None:
+            handle = self.loop.call_later(timeout, self._wakeup, self._waiter)
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
+            if handle is not None:
+                handle.cancel()
+
+    async def read(self, size, timeout=-1):
+        # returns up to size bytes, less when the timeout (in seconds, default
+        # self.timeout, None to wait forever) expires. read() and write() don't
+        # take the command lock.
+        if timeout == -1:
+            timeout = self.timeout
+        deadline = None
+        if timeout is not None:
+            deadline = self.loop.time() + timeout
+
+        while len(self._buffer) < size and self.fd is not None and self._error is None:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    break
+            await self._wait(remaining)
+
+        if self._error is not None and len(self._buffer) < size:
+            raise self._error
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def in_waiting(self):
+        return len(self._buffer)
+
+    async def write(self, data):
+        if self.fd is None:
+            raise OSError(errno.EBADF, 'device not open')
+
+        view = memoryview(data)
+        while len(view) > 0:
+            try:
+                view = view[os.write(self.fd, view):]
+            except BlockingIOError:
+                pass
+            if len(view) > 0:
+                writable = self.loop.create_future()
+                self.loop.add_writer(self.fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(self.fd)
+
+    async def command_returned_ok(self, deadline=gq_gmc.COMMAND_TABLE['WCFG'][1]):
+        # see gq_gmc.GMCDevice.command_returned_ok()
+        return await self.read(1, timeout=deadline) == gq_gmc.ACK
+
+    async def _command(self, command, size=None):
+        # send a command and return its reply, see gq_gmc.GMCDevice.transaction()
+        reply_size, deadline = gq_gmc.COMMAND_TABLE[command]
+        if size is None:
+            size = reply_size
+        async with self._lock:
+            await self.write(b'<' + command.encode('ascii') + b'>>')
+            return await self.read(size, timeout=deadline)
+
+    async def clear_port(self):
+        async with self._lock:
+            await self._clear_port()
+
+    async def _clear_port(self):
+        # close any pending previous command
+        await self.write(b'>>')
+
+        # get rid off all buffered data still in the queue, until nothing is
+        # received for a short (quiet) period
+        while True:
+            del self._buffer[:]
+            if len(await self.read(1, timeout=gq_gmc.CLEAR_QUIET)) == 0:
+                break
+
+    async def check_device_type(self):
+        self.device_type = await self.get_device_type()
+
+        if self.device_type == '' or len(self.device_type) < 8:
+            print("ERROR: device not found or supported")
+            return -1
+
+        self.device_name = self.device_type[:7]
+
+        if self.device_name in SUPPORTED_DEVICES:
+            if gq_gmc.m_verbose == 2:
+                print("device found: {}".format(self.device_type))
+
+        elif self.device_name[:3] == 'GMC':
+            print("WARNING: device found ({}) but officially not supported, using defaults"
+                  .format(self.device_type))
+            self.device_name = gq_gmc.DEFAULT_DEVICE_TYPE
+
+        else:
+            print("ERROR: device not found or supported")
+            return -1
+
+        return 0
+
+    async def get_device_type(self):
+        return (await self._command('GETVER')).decode('latin-1')
+
+    async def get_serial_number(self):
+        serial_number = await self._command('GETSERIAL')
+
+        if len(serial_number) < 7:
+            print('WARNING: no valid serial number received')
+            return ''
+
+        self.serial_number = ''.join('{:02X}'.format(x) for x in serial_number[:7])
+        return self.serial_number
+
+    async def get_cpm(self, cpm_to_usievert=None):
+        cpm = await self._command('GETCPM')
+
+        if len(cpm) < 2:
+            print('WARNING: no valid cpm received')
+            return ''
+
+        value = struct.unpack(">H", cpm)[0]
+        return gq_gmc.format_unit_value(value, 'CPM', cpm_to_usievert)
+
+    def get_flash_size(self):
+        if self.device_name is not None and self.device_name in gq_gmc.FLASH_SIZE:
+            return gq_gmc.FLASH_SIZE[self.device_name]
+        return gq_gmc.DEFAULT_FLASH_SIZE
+
+    async def read_flash(self, address, length, chunk_size=gq_gmc.SPIR_MAX_SIZE,
+                         window=gq_gmc.SPIR_WINDOW):
+        # read (part of) the flash, yielding the address and data of every chunk
+        reader = AsyncFlashReader(self, chunk_size=chunk_size, window=window)
+        chunks = reader.read(address, length)
+        try:
+            async with self._lock:
+                async for sub_addr, data in chunks:
+                    yield sub_addr, data
+        finally:
+            await chunks.aclose()
+            if gq_gmc.m_verbose >= 1 and reader.total_len > 0:
+                print(reader.summary())
+
+    async def stream_data(self, address=0x000000, length=None, full_dump=gq_gmc.DEFAULT_FULL_DUMP,
+                          flash_end=None):
+        # yields the history data in chunks, as soon as they are read from the
+        # device
+        if length is None:
+            length = self.get_flash_size()
+        if flash_end is None:
+            flash_end = gq_gmc.FlashEnd(address)
+
+        # make sure we don't have any data in the device buffer
+        await self.clear_port()
+
+        chunks = self.read_flash(address, length)
+        try:
+            async for sub_addr, data in chunks:
+                yield data
+
+                # the rest of the flash is erased, unless it has wrapped
+                if flash_end.update(sub_addr, data) and not full_dump:
+                    if gq_gmc.m_verbose >= 1:
+                        print("erased flash found at address 0x%06x, end of history data at 0x%06x"
+                              % (sub_addr, flash_end.end))
+                    break
+        finally:
+            await chunks.aclose()
+
+    async def get_data(self, address=0x000000, length=None, out_file=gq_gmc.DEFAULT_BIN_FILE,
+                       full_dump=gq_gmc.DEFAULT_FULL_DUMP):
+        if out_file is None or out_file == '':
+            out_file = gq_gmc.DEFAULT_BIN_FILE
+
+        if gq_gmc.m_verbose >= 1:
+            print("storing data to '" + out_file + "'")
+
+        total_len = 0
+        flash_end = gq_gmc.FlashEnd(address)
+
+        try:
+            with open(out_file, 'wb') as f_out:
+                async for data in self.stream_data(address, length, full_dump, flash_end):
+                    f_out.write(data)
+                    total_len += len(data)
+        except IOError as e:
+            print("ERROR: {}".format(e))
+            gq_gmc.remove_data_info(out_file)
+            return -1
+
+        gq_gmc.save_data_info(out_file, address, total_len, flash_end.end, full_dump,
+                              self.serial_number)
+        return 0
+
+    async def heartbeat(self):
+        # yields the counts per second (as sent by the device every second),
+        # the heartbeat is stopped when the iteration stops
+        async with self._lock:
+            await self.write(b'<HEARTBEAT1>>')
+            try:
+                while True:
+                    cps = await self.read(2, timeout=None)
+                    if len(cps) < 2:
+                        break
+                    yield struct.unpack(">H", cps)[0] & 0x3fff
+            finally:
+                # make sure we stop the heartbeat
+                if self.fd is not None:
+                    await self.write(b'<HEARTBEAT0>>')
+                    await self._clear_port()
+
+
+class AsyncFlashReader(gq_gmc.FlashReader):
+    """
+    Reads the flash using pipelined SPIR requests, see gq_gmc.FlashReader.
+    """
+
+    async def read(self, address, length):
+        device = self.gmc_device
+        sub_addr = address
+        end = address + length
+        start_time = time.time()
+
+        while sub_addr < end:
+            requests, cmd = self._batch(sub_addr, end)
+            batch_len = requests[-1][0] + requests[-1][1] - sub_addr
+
+            batch_time = time.time()
+            await device.write(cmd)
+            data = await device.read(batch_len, timeout=self._timeout(batch_len))
+            batch_time = time.time() - batch_time
+
+            requests, ok = self._check(requests, data, sub_addr, batch_len, batch_time,
+                                       device.in_waiting() > 0)
+            if not ok:
+                if self._failures > gq_gmc.SPIR_MAX_RETRIES:
+                    raise IOError("reading flash failed at address 0x%06x" % sub_addr)
+                await device._clear_port()
+                await asyncio.sleep(gq_gmc.SPIR_RETRY_DELAY * self._failures)
+
+            for chunk_addr, chunk in self._split(requests, data, sub_addr, length, start_time):
+                yield chunk_addr, chunk
+            if requests:
+                sub_addr = requests[-1][0] + requests[-1][1]
+
+        self.duration = time.time() - start_time
+
+    def baud_rate(self):
+        return self.gmc_device.baud_rate
+
+
+def set_raw(fd, baud_rate):
+    # configure the tty as a raw 8N1 serial port
+    speed = getattr(termios, 'B{}'.format(baud_rate), None)
+    if speed is None:
+        raise ValueError('unsupported baud rate {}'.format(baud_rate))
+
+    iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(fd)
+    iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP |
+               termios.INLCR | termios.IGNCR | termios.ICRNL | termios.IXON |
+               termios.IXOFF | termios.IXANY | termios.INPCK)
+    oflag &= ~termios.OPOST
+    lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+    cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB | getattr(termios, 'CRTSCTS', 0))
+    cflag |= termios.CS8 | termios.CLOCAL | termios.CREAD
+    cc[termios.VMIN] = 0
+    cc[termios.VTIME] = 0
+    termios.tcsetattr(fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc])
+    termios.tcflush(fd, termios.TCIOFLUSH)
+
+
+async def read_device(port, out_file=None, cpm_to_usievert=None, skip_check=False,
+                      device_type=None, baud_rate=gq_gmc.DEFAULT_BAUD_RATE):
+    # the asyncio version of gq_gmc.read_device()
+    result = {'port': port, 'device_type': None, 'serial': None, 'cpm': None,
+              'out_file': out_file, 'size': 0, 'error': None, 'timing': {}}
+    start_time = time.time()
+    device = AsyncGMCDevice()
+
+    try:
+        if await device.open(port=port, baud_rate=baud_rate, skip_check=skip_check,
+                             device_type=device_type) != 0:
+            result['error'] = 'device not found or supported'
+            return result
+        result['device_type'] = device.device_type
+        result['timing']['open'] = time.time() - start_time
+
+        step_time = time.time()
+        result['serial'] = await device.get_serial_number()
+        result['cpm'] = await device.get_cpm(cpm_to_usievert=cpm_to_usievert)
+        result['timing']['cpm'] = time.time() - step_time
+
+        if out_file is not None:
+            # the file name can contain the serial number and port name
+            out_file = out_file.format(serial=result['serial'], port=os.path.basename(port))
+            result['out_file'] = out_file
+            step_time = time.time()
+            if await device.get_data(out_file=out_file) != 0:
+                result['error'] = 'reading the history data failed'
+                return result
+            result['size'] = os.path.getsize(out_file)
+            result['timing']['data'] = time.time() - step_time
+
+    except (OSError, IOError) as e:
+        result['error'] = str(e)
+
+    finally:
+        device.close()
+        result['timing']['total'] = time.time() - start_time
+
+    return result
+
+
+async def read_devices(ports, out_files=None, cpm_to_usievert=None, skip_check=False,
+                       device_type=None, baud_rate=gq_gmc.DEFAULT_BAUD_RATE):
+    # read the CPM and history data of multiple devices concurrently, returns
+    # the results of read_device() in the order of the ports
+    if out_files is None:
+        out_files = [None] * len(ports)
+
+    return await asyncio.gather(*[read_device(port, out_file=out_file,
+                                              cpm_to_usievert=cpm_to_usievert,
+                                              skip_check=skip_check,
+                                              device_type=device_type,
+                                              baud_rate=baud_rate)
+                                  for port, out_file in zip(ports, out_files)])
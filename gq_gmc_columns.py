@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+"""
+Columnar output formats for the history data: Parquet, Arrow IPC and NumPy
+'.npz' files. Every sample is stored as a row with the following columns:
+
+timestamp: start time of the segment plus the sample interval (or NaT/null
+           when unknown)
+count:     the raw value as stored by the device
+unit:      the data type of the segment ('CPS', 'CPM' or '*' before the first
+           segment)
+usievert:  the value converted to uSv/h (or NaN without conversion)
+segment:   index of the segment (-1 before the first segment)
+
+All formats require NumPy, Parquet and Arrow IPC also require PyArrow. The
+rows are written in batches of row_group_size rows (a row group in Parquet, a
+record batch in Arrow IPC), so memory use doesn't depend on the file size.
+"""
+
+import os
+import shutil
+import tempfile
+import zipfile
+import importlib
+import itertools
+import gq_gmc
+
+FORMATS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+    'npz': '.npz'
+}
+
+DEFAULT_ROW_GROUP_SIZE = 0x10000  # rows
+
+# column name: numpy data type
+COLUMNS = [
+    ('timestamp', 'datetime64[s]'),
+    ('count', 'uint32'),
+    ('unit', 'U3'),
+    ('usievert', 'float64'),
+    ('segment', 'int32')
+]
+
+
+def get_usievert_factor(data_type, cpm_to_usievert):
+    value = gq_gmc.convert_cpm_to_usievert(1.0, data_type, cpm_to_usievert)
+    if value[1] == 'uSv/h':
+        return value[0]
+    return float('nan')
+
+
+def iter_batches(stream, cpm_to_usievert=None, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    # decode history data from an iterable of blocks into batches of columns
+    # (a dictionary with a numpy array per column)
+    import numpy
+
+    decoder = gq_gmc.HistoryDecoder()
+    data_type = decoder.data_type
+    factor = get_usievert_factor(data_type, cpm_to_usievert)
+    segment = -1
+    start = None
+    interval = numpy.timedelta64(0, 's')
+    index = 0
+
+    pieces = []
+    rows = 0
+    blocks = itertools.chain(stream, [b''])
+
+    while not decoder.finished:
+        block = next(blocks)
+
+        for event in decoder.feed(block, final=len(block) == 0):
+            kind = event[0]
+
+            if kind == gq_gmc.EVENT_HEADER:
+                segment += 1
+                data_type = gq_gmc.get_save_mode(event[3])[0]
+                factor = get_usievert_factor(data_type, cpm_to_usievert)
+                start = gq_gmc.get_header_time(event[2])
+                if start is not None:
+                    start = numpy.datetime64(start, 's')
+                interval = numpy.timedelta64(gq_gmc.SAVE_MODE_INTERVAL.get(event[3], 0), 's')
+                index = 0
+                continue
+
+            elif kind == gq_gmc.EVENT_SAMPLES:
+                counts = numpy.frombuffer(bytes(event[2]), dtype=numpy.uint8).astype(numpy.uint32)
+
+            elif kind == gq_gmc.EVENT_VALUE:
+                counts = numpy.array([event[2]], dtype=numpy.uint32)
+
+            else:
+                continue
+
+            # no samples are stored when logging is off
+            if data_type == '':
+                continue
+
+            size = len(counts)
+            if start is None:
+                timestamps = numpy.full(size, numpy.datetime64('NaT'), dtype='datetime64[s]')
+            else:
+                timestamps = start + (index + numpy.arange(size)) * interval
+            index += size
+
+            pieces.append((timestamps,
+                           counts,
+                           numpy.full(size, data_type, dtype='U3'),
+                           counts * factor,
+                           numpy.full(size, segment, dtype=numpy.int32)))
+            rows += size
+
+            while rows >= row_group_size:
+                batch, pieces = _split_batch(pieces, row_group_size)
+                rows -= row_group_size
+                yield batch
+
+    if rows > 0:
+        yield _split_batch(pieces, rows)[0]
+
+    if hasattr(stream, 'close'):
+        stream.close()
+
+
+def _split_batch(pieces, size):
+    # returns a batch of size rows, and the pieces which are left
+    import numpy
+
+    columns = []
+    rest = []
+    for c in range(len(COLUMNS)):
+        column = numpy.concatenate([piece[c] for piece in pieces])
+        columns.append(column[:size].astype(COLUMNS[c][1]))
+        rest.append(column[size:])
+
+    batch = dict((COLUMNS[c][0], columns[c]) for c in range(len(COLUMNS)))
+    if len(rest[0]) > 0:
+        return batch, [tuple(rest)]
+    return batch, []
+
+
+def _arrow_schema():
+    import pyarrow
+
+    return pyarrow.schema([
+        ('timestamp', pyarrow.timestamp('s')),
+        ('count', pyarrow.uint32()),
+        ('unit', pyarrow.string()),
+        ('usievert', pyarrow.float64()),
+        ('segment', pyarrow.int32())
+    ])
+
+
+def _arrow_batch(batch, schema):
+    import pyarrow
+
+    # NaT and NaN values are stored as null
+    arrays = [pyarrow.array(batch[field.name], type=field.type, from_pandas=True) for field in schema]
+    return pyarrow.RecordBatch.from_arrays(arrays, [field.name for field in schema])
+
+
+def write_parquet(batches, out_file):
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = _arrow_schema()
+    writer = pyarrow.parquet.ParquetWriter(out_file, schema)
+    try:
+        for batch in batches:
+            writer.write_table(pyarrow.Table.from_batches([_arrow_batch(batch, schema)]))
+    finally:
+        writer.close()
+
+
+def write_arrow(batches, out_file):
+    import pyarrow
+
+    schema = _arrow_schema()
+    with open(out_file, 'wb') as f_out:
+        writer = pyarrow.RecordBatchFileWriter(f_out, schema)
+        try:
+            for batch in batches:
+                writer.write_batch(_arrow_batch(batch, schema))
+        finally:
+            writer.close()
+
+
+def write_npz(batches, out_file):
+    # every column is appended to a temporary file, which is stored in the npz
+    # file (as a npy file) once the size of the columns is known
+    import numpy
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        raw_files = dict((name, open(os.path.join(tmp_dir, name + '.raw'), 'wb')) for name, dtype in COLUMNS)
+        size = 0
+        try:
+            for batch in batches:
+                for name, dtype in COLUMNS:
+                    raw_files[name].write(batch[name].tobytes())
+                size += len(batch['count'])
+        finally:
+            for f in raw_files.values():
+                f.close()
+
+        with zipfile.ZipFile(out_file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as f_out:
+            for name, dtype in COLUMNS:
+                raw_file = os.path.join(tmp_dir, name + '.raw')
+                npy_file = os.path.join(tmp_dir, name + '.npy')
+                with open(npy_file, 'wb') as f_npy:
+                    numpy.lib.format.write_array_header_1_0(f_npy, {
+                        'descr': numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)),
+                        'fortran_order': False,
+                        'shape': (size,)})
+                    with open(raw_file, 'rb') as f_raw:
+                        shutil.copyfileobj(f_raw, f_npy)
+                os.remove(raw_file)
+                f_out.write(npy_file, name + '.npy')
+                os.remove(npy_file)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+WRITERS = {
+    'parquet': write_parquet,
+    'arrow': write_arrow,
+    'npz': write_npz
+}
+
+
+def check_format(output_format):
+    # returns True if the modules needed for the output format are available
+    try:
+        importlib.import_module('numpy')
+        if output_format != 'npz':
+            importlib.import_module('pyarrow')
+    except ImportError as e:
+        print("ERROR: the '{}' output format is not available ({}), install NumPy and PyArrow "
+              "(pip install numpy pyarrow)".format(output_format, e))
+        return False
+    return True
+
+
+def parse_data_stream(stream, out_file, output_format, cpm_to_usievert=None,
+                      row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    if output_format not in WRITERS:
+        print("ERROR: unsupported output format '{}'".format(output_format))
+        return -1
+    if not check_format(output_format):
+        return -1
+
+    WRITERS[output_format](iter_batches(stream, cpm_to_usievert, row_group_size), out_file)
+    return 0
+
+
+def parse_data_file(in_file, out_file, output_format, cpm_to_usievert=None,
+                    row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    if gq_gmc.m_verbose >= 1:
+        print("parsing file '" + in_file + "', and storing data to '" +
+              out_file + "'")
+
+    with open(in_file, 'rb') as f_in:
+        blocks = gq_gmc.read_blocks(f_in, length=gq_gmc.get_data_length(in_file))
+        return parse_data_stream(blocks, out_file, output_format,
+                                 cpm_to_usievert=cpm_to_usievert,
+                                 row_group_size=row_group_size)
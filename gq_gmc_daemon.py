@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+"""
+Session daemon, which keeps a device open and serves the commands of other
+processes over a unix socket (Linux and OS X only). Opening the port and
+checking the device type is done only once, and the device type and
+configuration stay cached.
+
+Commands are executed one at a time, in the order they are received. While
+clients are subscribed to the heartbeat it's paused for every command, and
+resumed afterwards.
+
+The protocol is line based, every line is a JSON object. A client sends a
+single request, {"command": name, "args": [...], "kwargs": {...}}, and
+receives zero or more {"data": base64, "output": text} (stream_data) or
+{"value": cps} (heartbeat) lines, followed by {"result": value, "output": text,
+"error": message} (not for the heartbeat, which runs until the client
+disconnects).
+"""
+
+import os
+import sys
+import json
+import base64
+import signal
+import socket
+import datetime
+import threading
+import gq_gmc
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+HEARTBEAT_POLL = 0.1  # seconds between checking the command queue
+
+text_type = type(u'')
+
+# device methods which can be called by clients
+COMMANDS = [
+    'get_device_type',
+    'get_serial_number',
+    'set_power',
+    'get_voltage',
+    'get_cpm',
+    'get_data',
+    'stream_data',
+    'sync_data',
+    'get_unit_conversion_from_device',
+    'set_heartbeat',
+    'get_temperature',
+    'get_gyro',
+    'get_config',
+    'list_config',
+    'write_config',
+    'get_date_and_time',
+    'set_date_and_time',
+    'send_key',
+    'firmware_update',
+    'factory_reset',
+    'reboot'
+]
+
+# commands after which the cached configuration isn't valid anymore (after a
+# successful write_config the configuration is read back, and stays cached)
+INVALIDATE_CONFIG = ['factory_reset']
+
+
+class Daemon(object):
+    """
+    Serves the commands of clients for a single (opened) device. All device
+    access is done by a single worker thread.
+    """
+
+    def __init__(self, device, socket_path=gq_gmc.DEFAULT_SOCKET):
+        self.device = device
+        self.socket_path = os.path.expanduser(socket_path)
+        self.requests = queue.Queue()
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.heartbeat = False
+        self.server = None
+        self.output = _Output(sys.stdout)
+
+    def serve(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            print("ERROR: the daemon is not supported on this platform")
+            return -1
+
+        if connect(self.socket_path) is not None:
+            print("ERROR: a daemon is already running on '{}'".format(self.socket_path))
+            return -1
+        if os.path.exists(self.socket_path):
+            # left behind by a previous daemon
+            os.remove(self.socket_path)
+
+        socket_dir = os.path.dirname(self.socket_path)
+        if socket_dir != '' and not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir)
+
+        # only the current user can connect
+        umask = os.umask(0o077)
+        try:
+            self.server = _Server(self.socket_path, _Handler)
+        finally:
+            os.umask(umask)
+        self.server.daemon = self
+
+        # the output of a command is returned to its client, the output of all
+        # other threads is still printed
+        stdout = sys.stdout
+        self.output = _Output(stdout)
+        sys.stdout = self.output
+
+        worker = threading.Thread(target=self._worker)
+        worker.daemon = True
+        worker.start()
+
+        signal.signal(signal.SIGTERM, _terminate)
+        if gq_gmc.m_verbose >= 1:
+            print("serving '{}' on '{}', press CTRL-C to stop".format(self.device.port, self.socket_path))
+
+        try:
+            self.server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            print("")
+        finally:
+            self.server.server_close()
+            os.remove(self.socket_path)
+            if self.heartbeat:
+                self._stop_heartbeat()
+            sys.stdout = stdout
+        return 0
+
+    def submit(self, request):
+        # queue a request, returns the queue on which the responses are put
+        responses = queue.Queue()
+        self.requests.put((request, responses))
+        return responses
+
+    def subscribe(self):
+        values = queue.Queue()
+        with self.lock:
+            self.subscribers.append(values)
+        # wake up the worker to start the heartbeat
+        self.requests.put(None)
+        return values
+
+    def unsubscribe(self, values):
+        with self.lock:
+            self.subscribers.remove(values)
+        self.requests.put(None)
+
+    def _worker(self):
+        pending = b''
+        while True:
+            with self.lock:
+                subscribed = len(self.subscribers) > 0
+            if subscribed and not self.heartbeat:
+                self._start_heartbeat()
+                pending = b''
+            elif not subscribed and self.heartbeat:
+                self._stop_heartbeat()
+
+            try:
+                item = self.requests.get(block=not self.heartbeat)
+            except queue.Empty:
+                item = None
+
+            if item is not None:
+                # pause the heartbeat while executing the command
+                if self.heartbeat:
+                    self._stop_heartbeat()
+                self._execute(item[0], item[1])
+                continue
+
+            if self.heartbeat:
+                pending += self.device.read_reply(2 - len(pending), HEARTBEAT_POLL)
+                if len(pending) == 2:
+                    value = bytearray(pending)
+                    value = ((value[0] << 8) + value[1]) & 0x3fff
+                    pending = b''
+                    with self.lock:
+                        for values in self.subscribers:
+                            values.put(value)
+
+    def _start_heartbeat(self):
+        self.device.transaction('HEARTBEAT1')
+        self.heartbeat = True
+
+    def _stop_heartbeat(self):
+        self.device.transaction('HEARTBEAT0')
+        self.device.drain()
+        self.heartbeat = False
+
+    def _execute(self, request, responses):
+        command = request.get('command')
+        args = request.get('args', [])
+        kwargs = request.get('kwargs', {})
+        response = {'result': None, 'output': '', 'error': None}
+
+        if command not in COMMANDS:
+            response['error'] = "unsupported command '{}'".format(command)
+            responses.put(response)
+            return
+
+        if command == 'set_date_and_time':
+            args = [datetime.datetime(*args[0])]
+
+        verbose = gq_gmc.m_verbose
+        keep_config = command not in INVALIDATE_CONFIG
+        self.output.capture()
+        try:
+            gq_gmc.set_verbose_level(request.get('verbose', verbose))
+
+            if command == 'get_config' and self.device.config is not None:
+                # the cached configuration is still valid
+                result = None
+            elif command == 'stream_data':
+                # the output is sent along with the data, the client can stop
+                # reading before the final response
+                for data in self.device.stream_data(*args, **kwargs):
+                    responses.put({'data': base64.b64encode(data).decode('ascii'),
+                                   'output': _text(self.output.take())})
+                result = None
+            else:
+                result = getattr(self.device, command)(*args, **kwargs)
+
+            if command == 'write_config':
+                keep_config = result == 0
+            response['result'] = _text(result)
+
+        except Exception as e:
+            response['error'] = str(e)
+            if command == 'write_config':
+                keep_config = False
+
+        finally:
+            response['output'] = _text(self.output.release())
+            gq_gmc.set_verbose_level(verbose)
+            if not keep_config:
+                self.device.config = None
+                self.device.config_data = None
+
+        responses.put(response)
+
+
+class _Output(object):
+    """
+    Replaces sys.stdout while the daemon runs. The output of a thread which
+    captures its output (the worker, while executing a command) is written to
+    a buffer of its own, the output of all other threads to stdout.
+    """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.buffers = {}
+
+    def capture(self):
+        self.buffers[threading.current_thread()] = StringIO()
+
+    def take(self):
+        # returns the output captured so far, and continues capturing
+        output = self.buffers[threading.current_thread()].getvalue()
+        self.buffers[threading.current_thread()] = StringIO()
+        return output
+
+    def release(self):
+        # stops capturing, returns the captured output
+        return self.buffers.pop(threading.current_thread()).getvalue()
+
+    def write(self, data):
+        self.buffers.get(threading.current_thread(), self.stdout).write(data)
+
+    def flush(self):
+        self.buffers.get(threading.current_thread(), self.stdout).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+class _Server(socketserver.ThreadingMixIn, getattr(socketserver, 'UnixStreamServer', object)):
+    daemon_threads = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        daemon = self.server.daemon
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        try:
+            request = json.loads(line.decode('utf-8'))
+        except ValueError:
+            self._send({'result': None, 'output': '', 'error': 'invalid request'})
+            return
+
+        try:
+            if request.get('command') == 'open':
+                # the port is already open, check if it's the requested one
+                port = request.get('kwargs', {}).get('port')
+                if port is not None and os.path.realpath(port) != os.path.realpath(daemon.device.port):
+                    self._send({'result': -1, 'output': '',
+                                'error': "the daemon serves '{}'".format(daemon.device.port)})
+                else:
+                    self._send({'result': 0, 'output': '', 'error': None})
+
+            elif request.get('command') == 'heartbeat':
+                values = daemon.subscribe()
+                try:
+                    while True:
+                        self._send({'value': values.get()})
+                finally:
+                    daemon.unsubscribe(values)
+
+            else:
+                responses = daemon.submit(request)
+                while True:
+                    response = responses.get()
+                    self._send(response)
+                    if 'result' in response:
+                        break
+
+        except socket.error:
+            # the client disconnected
+            pass
+
+    def _send(self, response):
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+class RemoteDevice(object):
+    """
+    A device served by a daemon, with the same commands as gq_gmc.GMCDevice.
+    """
+
+    def __init__(self, socket_path=gq_gmc.DEFAULT_SOCKET):
+        self.socket_path = os.path.expanduser(socket_path)
+
+    def __getattr__(self, name):
+        if name not in COMMANDS:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+
+    def _request(self, command, *args, **kwargs):
+        # send a request, yields all responses
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+            request = {'command': command, 'args': args, 'kwargs': kwargs,
+                       'verbose': gq_gmc.m_verbose}
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+            f_in = sock.makefile('rb')
+            while True:
+                line = f_in.readline()
+                if not line:
+                    raise socket.error('connection to the daemon closed')
+                yield json.loads(line.decode('utf-8'))
+        finally:
+            sock.close()
+
+    def _call(self, command, *args, **kwargs):
+        for response in self._request(command, *args, **kwargs):
+            if 'result' in response:
+                return self._result(response)
+
+    def _result(self, response):
+        sys.stdout.write(_native(response['output']))
+        if response['error'] is not None:
+            print("ERROR: {}".format(response['error']))
+            return -1
+        return _native(response['result'])
+
+    def open(self, port=None, baud_rate=gq_gmc.DEFAULT_BAUD_RATE, skip_check=False, device_type=None,
+             allow_fail=False, use_cache=gq_gmc.DEFAULT_USE_CACHE, state_dir=gq_gmc.DEFAULT_STATE_DIR):
+        # the daemon already opened the device, check if it's the requested
+        # port (any port if None)
+        for response in self._request('open', port=port):
+            if response['error'] is not None and not allow_fail:
+                print("ERROR: {}".format(response['error']))
+            return response['result']
+
+    def close(self):
+        pass
+
+    def get_data(self, address=0x000000, length=None, out_file=gq_gmc.DEFAULT_BIN_FILE,
+                 full_dump=gq_gmc.DEFAULT_FULL_DUMP):
+        # the file is written by the daemon
+        if out_file is None or out_file == '':
+            out_file = gq_gmc.DEFAULT_BIN_FILE
+        return self._call('get_data', address, length, os.path.abspath(out_file), full_dump)
+
+    def sync_data(self, out_file=gq_gmc.DEFAULT_BIN_FILE, state_dir=gq_gmc.DEFAULT_STATE_DIR,
+                  full_dump=gq_gmc.DEFAULT_FULL_DUMP):
+        if out_file is None or out_file == '':
+            out_file = gq_gmc.DEFAULT_BIN_FILE
+        if state_dir is None or state_dir == '':
+            state_dir = gq_gmc.DEFAULT_STATE_DIR
+        return self._call('sync_data', os.path.abspath(out_file),
+                          os.path.abspath(os.path.expanduser(state_dir)), full_dump)
+
+    def stream_data(self, address=0x000000, length=None, full_dump=gq_gmc.DEFAULT_FULL_DUMP):
+        responses = self._request('stream_data', address, length, full_dump)
+        response = {'data': None}
+        try:
+            while 'data' in response:
+                response = next(responses)
+                sys.stdout.write(_native(response['output']))
+                if 'data' in response:
+                    yield base64.b64decode(response['data'])
+        except GeneratorExit:
+            # the stream is closed as soon as the end of the history data is
+            # parsed, the output of the rest of the download is still shown
+            while 'data' in response:
+                response = next(responses)
+                sys.stdout.write(_native(response['output']))
+            raise
+        finally:
+            responses.close()
+
+        # a failed download fails the same way as on the daemon
+        if response['error'] is not None:
+            raise IOError(response['error'])
+
+    def set_date_and_time(self, date_time):
+        return self._call('set_date_and_time', [date_time.year, date_time.month, date_time.day,
+                                                date_time.hour, date_time.minute, date_time.second])
+
+    def set_heartbeat(self, enable, cpm_to_usievert=None):
+        if not enable:
+            return self._call('set_heartbeat', False)
+
+        try:
+            for response in self._request('heartbeat'):
+                print(gq_gmc.format_unit_value(response['value'], 'CPS', cpm_to_usievert))
+        except KeyboardInterrupt:
+            print("")
+
+
+def connect(socket_path=gq_gmc.DEFAULT_SOCKET, port=None):
+    # returns a RemoteDevice if a daemon is running on the socket (and serves
+    # the port, if provided), otherwise None
+    socket_path = os.path.expanduser(socket_path)
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return None
+
+    device = RemoteDevice(socket_path)
+    try:
+        if device.open(port=port, allow_fail=True) != 0:
+            return None
+    except socket.error:
+        return None
+    return device
+
+
+def _text(value):
+    # python 2 commands return and print byte strings (e.g. the raw
+    # configuration), which are send as latin-1 to keep every byte intact
+    if sys.version_info[0] < 3 and isinstance(value, str):
+        return value.decode('latin-1')
+    return value
+
+
+def _native(value):
+    # the reverse of _text()
+    if sys.version_info[0] < 3 and isinstance(value, text_type):
+        try:
+            return value.encode('latin-1')
+        except UnicodeEncodeError:
+            return value.encode('utf-8')
+    return value
+
+
+def _terminate(signum, frame):
+    sys.exit(0)
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+"""
+Emulator of a GQ GMC device (GQ-RFC1201), served over a pseudo terminal (Linux
+and OS X only). The name of the pseudo terminal can be used as the port of
+gq_gmc.open_device() or as the '--port' option of gq-gmc-control.py, e.g.:
+
+    $ ./gq_gmc_emulator.py --flash tests/test-data.bin
+    emulating GMC-500Re 1.03 on '/dev/pts/5', press CTRL-C to stop
+    $ ./gq-gmc-control.py --port /dev/pts/5 --data
+"""
+
+import os
+import sys
+import pty
+import tty
+import time
+import random
+import select
+import struct
+import argparse
+import threading
+import gq_gmc
+
+DEFAULT_MODEL = 'GMC-500'
+DEFAULT_VERSION = 'Re 1.03'
+DEFAULT_SERIAL_NUMBER = b'\xf4\x88\x00\x11\x22\x33\x44'
+DEFAULT_CPM = 20
+DEFAULT_CPS = 1
+DEFAULT_HEARTBEAT_INTERVAL = 1.0  # seconds
+DEFAULT_WRITE_SIZE = 64  # bytes per write on the pseudo terminal
+
+FAULTS = ['drop', 'truncate', 'corrupt', 'nak']
+
+# command: size of the binary arguments
+COMMANDS = {
+    b'GETVER': 0,
+    b'GETSERIAL': 0,
+    b'GETCPM': 0,
+    b'GETCPS': 0,
+    b'GETVOLT': 0,
+    b'GETTEMP': 0,
+    b'GETGYRO': 0,
+    b'GETCFG': 0,
+    b'GETDATETIME': 0,
+    b'SETDATETIME': 6,
+    b'SPIR': 5,
+    b'ECFG': 0,
+    b'WCFG': None,  # depends on the model
+    b'CFGUPDATE': 0,
+    b'HEARTBEAT0': 0,
+    b'HEARTBEAT1': 0,
+    b'POWERON': 0,
+    b'POWEROFF': 0,
+    b'KEY0': 0,
+    b'KEY1': 0,
+    b'KEY2': 0,
+    b'KEY3': 0,
+    b'FACTORYRESET': 0,
+    b'REBOOT': 0
+}
+
+
+class Emulator(object):
+    """
+    A GQ GMC device served over a pseudo terminal.
+
+    byte_delay: time to send a single byte, e.g. 10.0 / 115200 to emulate the
+                line rate of the serial port (0 sends as fast as possible)
+    command_delay: time between receiving a command and sending the response
+    flash: the contents of the history flash (default all erased)
+    config: the contents of the configuration buffer (default all erased)
+    faults: {command: (fault, probability)}, in which fault is one of 'drop'
+            (no response), 'truncate' (only half of the response), 'corrupt'
+            (flip the bits of the first byte) or 'nak' (0x00 instead of 0xaa)
+    """
+
+    def __init__(self, model=DEFAULT_MODEL, version=DEFAULT_VERSION,
+                 serial_number=DEFAULT_SERIAL_NUMBER, flash=None, config=None,
+                 byte_delay=0.0, command_delay=0.0, faults=None, seed=None,
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL):
+        self.model = model
+        self.version = (model + version).encode('ascii')[:14].ljust(14)
+        self.serial_number = serial_number
+        self.byte_delay = byte_delay
+        self.command_delay = command_delay
+        self.faults = faults or {}
+        self.heartbeat_interval = heartbeat_interval
+        self.cpm = DEFAULT_CPM
+        self.cps = DEFAULT_CPS
+        self.voltage = b'4.9'
+        self.temperature = (23, 5, 0)
+        self.gyro = (0, 0, 0)
+        self.date_time = None  # use the host time
+        self.power = True
+
+        flash_size = gq_gmc.FLASH_SIZE.get(model, gq_gmc.DEFAULT_FLASH_SIZE)
+        self.flash = bytearray(b'\xff' * flash_size)
+        if flash is not None:
+            self.flash[:len(flash)] = bytearray(flash[:flash_size])
+
+        config_size = gq_gmc.CONFIGURATION_BUFFER_SIZE.get(model, gq_gmc.DEFAULT_CONFIGURATION_SIZE)
+        self.config = bytearray(b'\xff' * config_size)
+        if config is not None:
+            self.config[:len(config)] = bytearray(config[:config_size])
+        self.stored_config = bytearray(self.config)
+
+        if config_size > 0x100:
+            self.address_size = 2
+        else:
+            self.address_size = 1
+
+        # statistics
+        self.commands = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        self.port = None
+        self._random = random.Random(seed)
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self._heartbeat = False
+        self._next_heartbeat = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._master is not None:
+            os.close(self._master)
+            os.close(self._slave)
+            self._master = None
+            self._slave = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _serve(self):
+        buf = bytearray()
+        while self._running:
+            timeout = 0.05
+            if self._heartbeat:
+                timeout = max(0, min(timeout, self._next_heartbeat - time.time()))
+
+            readable = select.select([self._master], [], [], timeout)[0]
+            if readable:
+                try:
+                    data = os.read(self._master, 4096)
+                except OSError:
+                    break
+                self.bytes_received += len(data)
+                buf += data
+                self._handle_commands(buf)
+
+            if self._heartbeat and time.time() >= self._next_heartbeat:
+                self._next_heartbeat += self.heartbeat_interval
+                self._send(struct.pack('>H', self.cps & 0x3fff))
+
+    def _handle_commands(self, buf):
+        while True:
+            # skip anything which isn't a command (like the '>>' of clear_port)
+            start = buf.find(b'<')
+            if start < 0:
+                del buf[:]
+                return
+            del buf[:start]
+
+            end = buf.find(b'>>')
+            if end < 0 and len(buf) < 32:
+                return
+
+            name = None
+            for command in COMMANDS:
+                if buf[1:1 + len(command)] == command:
+                    # prefer the longest match (e.g. 'GETCPM' and 'GETCPS')
+                    if name is None or len(command) > len(name):
+                        name = command
+
+            if name is None:
+                # unknown command, skip it
+                if end < 0:
+                    del buf[:1]
+                else:
+                    del buf[:end + 2]
+                continue
+
+            size = COMMANDS[name]
+            if size is None:
+                size = self.address_size + 1
+            length = 1 + len(name) + size + 2
+            if len(buf) < length:
+                return
+
+            args = bytes(buf[1 + len(name):1 + len(name) + size])
+            del buf[:length]
+            self.commands[name] = self.commands.get(name, 0) + 1
+
+            if self.command_delay > 0:
+                time.sleep(self.command_delay)
+            response = self._execute(name, args)
+            if response:
+                self._send(self._fault(name, response))
+
+    def _fault(self, name, response):
+        if name not in self.faults:
+            return response
+
+        fault, probability = self.faults[name]
+        if self._random.random() >= probability:
+            return response
+
+        if fault == 'drop':
+            return b''
+        elif fault == 'truncate':
+            return response[:len(response) // 2]
+        elif fault == 'corrupt':
+            return bytearray([response[0] ^ 0xff]) + response[1:]
+        elif fault == 'nak':
+            return response.replace(b'\xaa', b'\x00')
+        return response
+
+    def _execute(self, name, args):
+        args = bytearray(args)
+
+        if name == b'GETVER':
+            return bytearray(self.version)
+
+        elif name == b'GETSERIAL':
+            return bytearray(self.serial_number)
+
+        elif name == b'GETCPM':
+            return bytearray(struct.pack('>H', self.cpm))
+
+        elif name == b'GETCPS':
+            return bytearray(struct.pack('>H', self.cps))
+
+        elif name == b'GETVOLT':
+            return bytearray(self.voltage)
+
+        elif name == b'GETTEMP':
+            return bytearray([self.temperature[0], self.temperature[1], self.temperature[2], 0xaa])
+
+        elif name == b'GETGYRO':
+            return bytearray(struct.pack('>hhhB', self.gyro[0], self.gyro[1], self.gyro[2], 0xaa))
+
+        elif name == b'GETDATETIME':
+            t = self.date_time or time.localtime()[:6]
+            return bytearray([t[0] % 100, t[1], t[2], t[3], t[4], t[5], 0xaa])
+
+        elif name == b'SETDATETIME':
+            self.date_time = (2000 + args[0],) + tuple(args[1:6])
+            return bytearray(b'\xaa')
+
+        elif name == b'SPIR':
+            address = (args[0] << 16) + (args[1] << 8) + args[2]
+            length = (args[3] << 8) + args[4]
+            return self.flash[address:address + length]
+
+        elif name == b'GETCFG':
+            return bytearray(self.config)
+
+        elif name == b'ECFG':
+            self.config = bytearray(b'\xff' * len(self.config))
+            return bytearray(b'\xaa')
+
+        elif name == b'WCFG':
+            address = 0
+            for x in args[:self.address_size]:
+                address = address * 256 + x
+            if address >= len(self.config):
+                return bytearray(b'\x00')
+            self.config[address] = args[self.address_size]
+            return bytearray(b'\xaa')
+
+        elif name == b'CFGUPDATE':
+            self.stored_config = bytearray(self.config)
+            return bytearray(b'\xaa')
+
+        elif name == b'HEARTBEAT1':
+            self._heartbeat = True
+            self._next_heartbeat = time.time() + self.heartbeat_interval
+
+        elif name == b'HEARTBEAT0':
+            self._heartbeat = False
+
+        elif name == b'POWERON':
+            self.power = True
+
+        elif name == b'POWEROFF':
+            self.power = False
+
+        elif name == b'FACTORYRESET':
+            self.config = bytearray(b'\xff' * len(self.config))
+            self.stored_config = bytearray(self.config)
+            return bytearray(b'\xaa')
+
+        elif name == b'REBOOT':
+            self._heartbeat = False
+            self.config = bytearray(self.stored_config)
+
+        return None
+
+    def _send(self, data):
+        with self._lock:
+            if self.byte_delay <= 0:
+                os.write(self._master, bytes(data))
+            else:
+                for pos in range(0, len(data), DEFAULT_WRITE_SIZE):
+                    sub = bytes(data[pos:pos + DEFAULT_WRITE_SIZE])
+                    os.write(self._master, sub)
+                    time.sleep(len(sub) * self.byte_delay)
+            self.bytes_sent += len(data)
+
+
+def parse_fault(s):
+    fault = s.split(':')
+    if len(fault) == 2:
+        fault.append('1.0')
+    if len(fault) != 3 or fault[1] not in FAULTS:
+        raise argparse.ArgumentTypeError("Not a valid fault: '{}'.".format(s))
+    return fault[0].upper().encode('ascii'), (fault[1], float(fault[2]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulator of a GQ GMC device, served over a pseudo terminal.')
+    parser.add_argument('-Y', '--device-type',
+        action='store', default=DEFAULT_MODEL,
+        choices=sorted(gq_gmc.CONFIGURATION_BUFFER_SIZE.keys()),
+        help="the emulated device type (default '{}')".format(DEFAULT_MODEL))
+    parser.add_argument('-f', '--flash',
+        action='store', default=None,
+        help='binary file with the contents of the history flash (e.g. tests/test-data.bin)')
+    parser.add_argument('-g', '--config',
+        action='store', default=None,
+        help='binary file with the contents of the configuration buffer')
+    parser.add_argument('-b', '--baud-rate',
+        action='store', default=0, type=int,
+        help='emulate the line rate of the given baud-rate (default as fast as possible)')
+    parser.add_argument('-d', '--command-delay',
+        action='store', default=0.0, type=float,
+        help='delay in seconds between receiving a command and sending the response')
+    parser.add_argument('-F', '--fault',
+        action='append', default=[], type=parse_fault, metavar='COMMAND:FAULT[:PROBABILITY]',
+        help="inject a fault in the response of a command, e.g. 'SPIR:truncate:0.1'. supported faults: "
+             + ', '.join(FAULTS))
+    args = parser.parse_args()
+
+    flash = None
+    if args.flash is not None:
+        with open(args.flash, 'rb') as f_in:
+            flash = f_in.read()
+    config = None
+    if args.config is not None:
+        with open(args.config, 'rb') as f_in:
+            config = f_in.read()
+    byte_delay = 0.0
+    if args.baud_rate > 0:
+        byte_delay = 10.0 / args.baud_rate
+
+    emulator = Emulator(model=args.device_type, flash=flash, config=config,
+                        byte_delay=byte_delay, command_delay=args.command_delay,
+                        faults=dict(args.fault))
+    emulator.start()
+    print("emulating {} on '{}', press CTRL-C to stop".format(emulator.version.decode('ascii'), emulator.port))
+    sys.stdout.flush()
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("")
+    finally:
+        emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+"""
+Prometheus exporter. The device is polled by a single loop every
+poll_interval seconds, and the values are kept (as rendered metrics) in
+memory. Scrapes of '/metrics' are served from memory without any serial
+traffic, so the number of scrapers doesn't matter for the device.
+
+The following metrics are exported (labeled with the serial number and
+model of the device):
+
+    gq_gmc_cpm                          counts per minute
+    gq_gmc_cps                          counts per second
+    gq_gmc_usievert_per_hour            the CPM converted to uSv/h
+    gq_gmc_voltage_volts                voltage of the battery (or power supply)
+    gq_gmc_temperature_celsius          temperature
+    gq_gmc_gyro                         gyroscopic data (per axis)
+    gq_gmc_up                           1 if all values were read by the last poll
+    gq_gmc_poll_duration_seconds        time needed by the last poll
+    gq_gmc_last_poll_timestamp_seconds  time of the last successful poll
+    gq_gmc_staleness_seconds            age of the values (at the time of the scrape)
+    gq_gmc_polls_total                  number of polls
+    gq_gmc_poll_errors_total            number of polls which failed to read a value
+"""
+
+import time
+import struct
+import signal
+import threading
+import gq_gmc
+
+DEFAULT_METRICS_ADDRESS = ':9563'
+DEFAULT_POLL_INTERVAL = 10.0  # seconds
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# name: (type, help)
+METRICS = [
+    ('gq_gmc_cpm', 'gauge', 'Counts per minute.'),
+    ('gq_gmc_cps', 'gauge', 'Counts per second.'),
+    ('gq_gmc_usievert_per_hour', 'gauge', 'Counts per minute converted to uSv/h.'),
+    ('gq_gmc_voltage_volts', 'gauge', 'Voltage of the battery (or power supply).'),
+    ('gq_gmc_temperature_celsius', 'gauge', 'Temperature of the device.'),
+    ('gq_gmc_gyro', 'gauge', 'Gyroscopic data.'),
+    ('gq_gmc_up', 'gauge', 'Whether all values were read by the last poll.'),
+    ('gq_gmc_poll_duration_seconds', 'gauge', 'Time needed by the last poll.'),
+    ('gq_gmc_last_poll_timestamp_seconds', 'gauge', 'Time of the last successful poll.'),
+    ('gq_gmc_polls_total', 'counter', 'Number of polls.'),
+    ('gq_gmc_poll_errors_total', 'counter', 'Number of polls which failed to read a value.')
+]
+
+
+def read_reply(gmc_device, command):
+    # returns the reply of a command, or None if it's short (or followed by
+    # unexpected data). the port is then cleared until nothing is received for
+    # the time of a reply, so a late reply isn't read as the reply of the next
+    # command.
+    size, deadline = gq_gmc.COMMAND_TABLE[command]
+    reply = gmc_device.transaction(command)
+    if len(reply) < size or gmc_device.device.in_waiting > 0:
+        gmc_device.clear_port(deadline)
+        return None
+    return reply
+
+
+def read_values(gmc_device, cpm_to_usievert=None):
+    # reads all values from the device, a value which can't be read is left
+    # out (which fails the poll)
+    values = {}
+
+    cpm = read_reply(gmc_device, 'GETCPM')
+    if cpm is not None:
+        values['gq_gmc_cpm'] = struct.unpack('>H', cpm)[0]
+        if cpm_to_usievert is not None:
+            values['gq_gmc_usievert_per_hour'] = \
+                gq_gmc.convert_cpm_to_usievert(values['gq_gmc_cpm'], 'CPM', cpm_to_usievert)[0]
+
+    cps = read_reply(gmc_device, 'GETCPS')
+    if cps is not None:
+        values['gq_gmc_cps'] = struct.unpack('>H', cps)[0] & 0x3fff
+
+    voltage = read_reply(gmc_device, 'GETVOLT')
+    if voltage is not None:
+        try:
+            values['gq_gmc_voltage_volts'] = float(voltage)
+        except ValueError:
+            # not a voltage, the replies are out of sync
+            gmc_device.clear_port(gq_gmc.COMMAND_TABLE['GETVOLT'][1])
+
+    temp = read_reply(gmc_device, 'GETTEMP')
+    if temp is not None:
+        temp = bytearray(temp)
+        value = float('{:d}.{:d}'.format(temp[0], temp[1]))
+        values['gq_gmc_temperature_celsius'] = -value if temp[2] != 0 else value
+
+    gyro = read_reply(gmc_device, 'GETGYRO')
+    if gyro is not None:
+        values['gq_gmc_gyro'] = struct.unpack('>hhhB', gyro)[:3]
+
+    return values
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def format_label(value):
+    # escapes a label value, as required by the text format
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Exporter(object):
+    """
+    Polls a device (gq_gmc.GMCDevice), and serves the values to scrapers.
+    """
+
+    def __init__(self, gmc_device, address=DEFAULT_METRICS_ADDRESS, poll_interval=DEFAULT_POLL_INTERVAL,
+                 cpm_to_usievert=None):
+        self.gmc_device = gmc_device
+        self.poll_interval = poll_interval
+        self.cpm_to_usievert = cpm_to_usievert
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.labels = ''
+        self.polls = 0
+        self.errors = 0
+        # replaced as a whole by the poller: (rendered metrics, time of the
+        # last successful poll)
+        self.metrics = ('', None)
+
+    def poll(self):
+        start_time = time.time()
+        values = read_values(self.gmc_device, self.cpm_to_usievert)
+        duration = time.time() - start_time
+
+        expected = 5 if self.cpm_to_usievert is None else 6
+        up = len(values) == expected
+        self.polls += 1
+        if not up:
+            self.errors += 1
+            if gq_gmc.m_verbose >= 1:
+                print("WARNING: not all values could be read from the device")
+
+        values['gq_gmc_up'] = 1 if up else 0
+        values['gq_gmc_poll_duration_seconds'] = duration
+        last_poll = start_time if up else self.metrics[1]
+        if last_poll is not None:
+            values['gq_gmc_last_poll_timestamp_seconds'] = last_poll
+        values['gq_gmc_polls_total'] = self.polls
+        values['gq_gmc_poll_errors_total'] = self.errors
+
+        self.metrics = (self.render(values), last_poll)
+
+    def render(self, values):
+        lines = []
+        for name, metric_type, description in METRICS:
+            if name not in values:
+                continue
+            lines.append('# HELP {} {}\n'.format(name, description))
+            lines.append('# TYPE {} {}\n'.format(name, metric_type))
+            if name == 'gq_gmc_gyro':
+                for axis, value in zip('xyz', values[name]):
+                    lines.append('{}{{{},axis="{}"}} {}\n'.format(name, self.labels, axis, value))
+            else:
+                lines.append('{}{{{}}} {}\n'.format(name, self.labels, format_value(values[name])))
+        return ''.join(lines)
+
+    def scrape(self):
+        # only the staleness is determined at the time of the scrape
+        metrics, last_poll = self.metrics
+        if last_poll is None:
+            return metrics
+        return metrics + ('# HELP gq_gmc_staleness_seconds Age of the values.\n'
+                          '# TYPE gq_gmc_staleness_seconds gauge\n'
+                          'gq_gmc_staleness_seconds{{{}}} {}\n'
+                          .format(self.labels, format_value(time.time() - last_poll)))
+
+    def serve(self):
+        import serial
+
+        device = self.gmc_device
+        serial_number = device.serial_number
+        if serial_number is None:
+            serial_number = device.get_serial_number()
+        self.labels = 'serial="{}",model="{}"'.format(format_label(serial_number), format_label(device.device_name))
+
+        # the http server is only imported when it's started
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.scrape().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                if gq_gmc.m_verbose >= 3:
+                    BaseHTTPRequestHandler.log_message(self, format, *args)
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        try:
+            server = Server(self.address, Handler)
+        except (IOError, OSError) as e:
+            print("ERROR: unable to listen on '{}:{}' ({})".format(self.address[0], self.address[1], e))
+            return -1
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        if gq_gmc.m_verbose >= 1:
+            print("serving metrics on 'http://{}:{}/metrics', press CTRL-C to stop"
+                  .format(self.address[0] or '0.0.0.0', server.server_address[1]))
+
+        signal.signal(signal.SIGINT, device.exit_gracefully)
+        signal.signal(signal.SIGTERM, device.exit_gracefully)
+
+        try:
+            next_poll = time.time()
+            while not device.terminate:
+                now = time.time()
+                if now >= next_poll:
+                    try:
+                        self.poll()
+                    except serial.SerialException as e:
+                        # the device is gone (e.g. unplugged)
+                        print("ERROR: unable to poll the device ({})".format(e))
+                        return -1
+                    next_poll = max(next_poll + self.poll_interval, now)
+                time.sleep(min(0.1, max(0, next_poll - time.time())))
+        finally:
+            server.shutdown()
+            server.server_close()
+        return 0
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+"""
+Generator of synthetic history data, as stored in the flash of a GQ GMC
+device. The history consists of segments, every segment starts with a header
+(the start time and the save mode), followed by the samples of the save mode
+('off' segments have no samples). All save modes are used, and besides one
+byte samples the segments contain:
+
+- two, three and four byte values ('0x55 0xaa 0x01' to '0x55 0xaa 0x03')
+- notes ('0x55 0xaa 0x04')
+- one byte samples with the value 0x55 (the first byte of a command)
+- short runs of 0xff samples (shorter than the end of file marker)
+
+The history is followed by an erased (0xff) tail. The data only depends on the
+seed, so files of the same size and seed are identical, e.g.:
+
+    $ ./gq_gmc_generator.py --size 1M gq-gmc-log.bin
+"""
+
+import random
+import struct
+import argparse
+import gq_gmc
+
+DEFAULT_SEED = 0
+DEFAULT_TAIL_SIZE = gq_gmc.FLASH_PAGE_SIZE  # bytes of erased flash after the history
+SEGMENT_SAMPLES = (100, 5000)  # minimum and maximum number of samples in a segment
+START_TIME = (17, 7, 28, 16, 50, 43)
+TABLE_SIZE = 0x10000  # random samples per save mode
+SPECIAL_INTERVAL = 300  # maximum number of regular samples between two special ones
+
+# save mode: (minimum, maximum) of a one byte sample
+SAMPLE_RANGE = {
+    1: (0, 5),
+    2: (10, 60),
+    3: (30, 250),
+    4: (0, 5),
+    5: (10, 60)
+}
+
+NOTES = [b'GMC note', b'calibration check', b'moved to basement', b'x']
+
+
+def parse_size(size):
+    # '64K', '1M' or '100M' to a number of bytes
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    size = size.strip().upper()
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def command(c, data=b''):
+    return b'\x55\xaa' + bytearray([c]) + bytes(data)
+
+
+class HistoryGenerator(object):
+    """
+    Generates history data segment by segment, so files of any size can be
+    written without keeping the data in memory.
+    """
+
+    def __init__(self, seed=DEFAULT_SEED):
+        self.random = random.Random(seed)
+        self.time = list(START_TIME)
+        self.segments = 0
+        self.tables = {}
+
+    def randint(self, low, high):
+        # the same values for all python versions (unlike random.randint)
+        return low + int(self.random.random() * (high - low + 1))
+
+    def chance(self, p):
+        return self.random.random() < p
+
+    def header(self, save_mode):
+        return command(0x00, bytearray(self.time) + b'\x55\xaa' + bytearray([save_mode]))
+
+    def advance(self, seconds):
+        # the start time of the next segment (months are kept at 28 days)
+        t = self.time
+        t[5] += seconds
+        for i, limit in [(5, 60), (4, 60), (3, 24)]:
+            t[i - 1] += t[i] // limit
+            t[i] %= limit
+        if t[2] > 28:
+            t[1] += (t[2] - 1) // 28
+            t[2] = (t[2] - 1) % 28 + 1
+        if t[1] > 12:
+            t[0] += (t[1] - 1) // 12
+            t[1] = (t[1] - 1) % 12 + 1
+        t[0] %= 100
+
+    def table(self, save_mode):
+        # random one byte samples of a save mode, segments are made of slices
+        # of this table (it's twice TABLE_SIZE, so slices don't need to wrap)
+        if save_mode not in self.tables:
+            low, high = SAMPLE_RANGE[save_mode]
+            table = bytearray(self.randint(low, high) for i in range(2 * TABLE_SIZE))
+            for i in range(1, len(table)):
+                if table[i - 1] == 0x55 and table[i] == 0xaa:
+                    # a 0x55 value followed by 0xaa would be a command
+                    table[i] = 0xab
+            self.tables[save_mode] = table
+        return self.tables[save_mode]
+
+    def segment(self):
+        # returns the data of the next segment, the save modes are used in turn
+        save_mode = self.segments % len(gq_gmc.SAVE_MODE)
+        self.segments += 1
+        data = bytearray(self.header(save_mode))
+
+        if self.chance(0.5):
+            data += self.note()
+
+        if save_mode == 0:
+            # logging is off, no samples are stored
+            self.advance(self.randint(60, 3600))
+            return data
+
+        table = self.table(save_mode)
+        low = SAMPLE_RANGE[save_mode][0]
+        samples = self.randint(*SEGMENT_SAMPLES)
+        count = 0
+        while count < samples:
+            # regular samples, followed by a special one
+            run = min(self.randint(1, SPECIAL_INTERVAL), samples - count)
+            offset = self.randint(0, TABLE_SIZE - 1)
+            data += table[offset:offset + run]
+            count += run + 1
+
+            r = self.random.random()
+            if r < 0.3:
+                # a value which doesn't fit in a single byte
+                size = self.randint(2, 4)
+                value = self.randint(256, (1 << (8 * size)) - 1)
+                data += command(size - 1, struct.pack('>I', value)[4 - size:])
+            elif r < 0.45:
+                data += self.note()
+                count -= 1
+            elif r < 0.85:
+                # a 0x55 value (followed by a regular value)
+                data += bytearray([0x55, low])
+                count += 1
+            else:
+                # less 0xff values than the end of file marker, followed by a
+                # regular value
+                ff_count = self.randint(1, 20)
+                data += b'\xff' * ff_count + bytearray([low])
+                count += ff_count
+
+        self.advance(count * gq_gmc.SAVE_MODE_INTERVAL[save_mode])
+        return data
+
+    def note(self):
+        note = NOTES[self.randint(0, len(NOTES) - 1)]
+        return command(0x04, bytearray([len(note)]) + note)
+
+    def history(self, size):
+        # yields segments until at least size bytes are generated
+        generated = 0
+        while generated < size:
+            data = self.segment()
+            generated += len(data)
+            yield data
+
+
+def write_history(out_file, size, seed=DEFAULT_SEED, tail_size=DEFAULT_TAIL_SIZE):
+    # writes size bytes of history data (the last segment is cut off, like
+    # a device which is still logging) followed by an erased tail, returns the
+    # size of the history data
+    written = 0
+    with open(out_file, 'wb') as f_out:
+        for data in HistoryGenerator(seed).history(size):
+            data = data[:size - written]
+            f_out.write(data)
+            written += len(data)
+        f_out.write(b'\xff' * tail_size)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generator of synthetic GQ GMC history data.')
+    parser.add_argument('out_file',
+        help='the binary file to create')
+    parser.add_argument('-s', '--size',
+        action='store', default='1M', type=parse_size,
+        help="the size of the history data, e.g. '64K', '1M' or '100M' (default '1M')")
+    parser.add_argument('-S', '--seed',
+        action='store', default=DEFAULT_SEED, type=int,
+        help='the seed of the generated data (default {})'.format(DEFAULT_SEED))
+    parser.add_argument('-t', '--tail-size',
+        action='store', default=DEFAULT_TAIL_SIZE, type=parse_size,
+        help='the size of the erased flash after the history data (default {})'.format(DEFAULT_TAIL_SIZE))
+    args = parser.parse_args()
+
+    size = write_history(args.out_file, args.size, seed=args.seed, tail_size=args.tail_size)
+    print("{} bytes of history data written to '{}'".format(size, args.out_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+"""
+Heartbeat recorder. The heartbeat frames (the counts of every second) are
+read in bulk, and stored with the time they are received in a fixed size
+ring buffer. A rolling CPM (of the last minute) and average CPM (of the last
+hour) are updated with every sample, and the samples are written to a sink
+(e.g. a csv file) in batches, so a recorder can run for months using the
+same amount of memory.
+
+Every frame is a 16 bit value, of which the lower 14 bits are the counts, and
+the upper 2 bits are flags. The csv sink writes a line per sample:
+
+    2019-01-02 03:04:05.678,<counts>,<flags>
+
+The SQLite sink (used for files ending with '.db', '.sqlite' or '.sqlite3')
+stores the samples in the 'heartbeat' table:
+
+    timestamp  REAL     seconds since the epoch (UTC)
+    cps        INTEGER  counts
+    flags      INTEGER  flags
+    usievert   REAL     the counts converted to uSv/h (or NULL)
+
+The samples are handed over to a background thread every second, which
+inserts them in batches (in a database in WAL mode), so storage never blocks
+reading the heartbeat.
+"""
+
+import os
+import time
+import array
+import signal
+import datetime
+import threading
+import gq_gmc
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+DEFAULT_RECORD_FILE = 'gq-gmc-heartbeat.csv'
+RING_SIZE = 4096  # samples, more than an hour of heartbeats
+FLUSH_INTERVAL = 60.0  # seconds between writes to the sink
+CPM_WINDOW = 60.0  # seconds
+AVERAGE_WINDOW = 3600.0  # seconds
+READ_TIMEOUT = 0.2  # seconds
+SQLITE_EXTENSIONS = ['.db', '.sqlite', '.sqlite3']
+SQLITE_FLUSH_INTERVAL = 1.0  # seconds between handing samples to the writer thread
+SQLITE_BATCH_SIZE = 1000  # samples per transaction
+SQLITE_BATCH_INTERVAL = 5.0  # maximum seconds before a transaction is committed
+SQLITE_QUEUE_SIZE = 3600  # batches waiting to be written
+FRAME_SIZE = 2  # bytes
+VALUE_MASK = 0x3fff
+FLAGS_SHIFT = 14
+
+
+class RingBuffer(object):
+    """
+    A fixed size ring buffer of samples (timestamp, value and flags), backed
+    by arrays. Samples are addressed by their absolute index, the number of
+    samples appended before it.
+    """
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.timestamps = array.array('d', [0.0]) * size
+        self.values = array.array('H', [0]) * size
+        self.flags = array.array('B', [0]) * size
+        self.total = 0
+
+    def append(self, timestamp, value, flags):
+        i = self.total % self.size
+        self.timestamps[i] = timestamp
+        self.values[i] = value
+        self.flags[i] = flags
+        self.total += 1
+
+    def oldest(self):
+        # absolute index of the oldest sample still available
+        return max(0, self.total - self.size)
+
+    def samples(self, start, end=None):
+        # yields the (timestamp, value, flags) of the samples in [start, end)
+        if end is None:
+            end = self.total
+        for n in range(max(start, self.oldest()), end):
+            i = n % self.size
+            yield self.timestamps[i], self.values[i], self.flags[i]
+
+
+class RollingWindow(object):
+    """
+    The sum and number of the samples of the last 'seconds' in a ring buffer,
+    updated incrementally: new samples are added, and samples are subtracted
+    once they are too old (or about to be overwritten in the ring buffer).
+    """
+
+    def __init__(self, ring, seconds):
+        self.ring = ring
+        self.seconds = seconds
+        self.tail = 0
+        self.sum = 0
+        self.count = 0
+
+    def add(self, value):
+        self.sum += value
+        self.count += 1
+
+    def expire(self, now, oldest=None):
+        if oldest is None:
+            oldest = self.ring.oldest()
+        ring = self.ring
+        while self.tail < ring.total:
+            i = self.tail % ring.size
+            if self.tail >= oldest and ring.timestamps[i] > now - self.seconds:
+                break
+            self.sum -= ring.values[i]
+            self.count -= 1
+            self.tail += 1
+
+    def cpm(self):
+        # the counts per minute, based on the available samples (of a second)
+        if self.count == 0:
+            return None
+        return self.sum * 60.0 / self.count
+
+
+class CsvSink(object):
+    """
+    Appends the samples to a csv file.
+    """
+    flush_interval = FLUSH_INTERVAL
+
+    def __init__(self, out_file=DEFAULT_RECORD_FILE):
+        self.out_file = out_file
+        self.f_out = open(out_file, 'a')
+
+    def write(self, samples):
+        lines = []
+        for timestamp, value, flags in samples:
+            lines.append('{},{:d},{:d}\n'.format(
+                datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+                value, flags))
+        self.f_out.writelines(lines)
+        self.f_out.flush()
+        return True
+
+    def close(self):
+        self.f_out.close()
+        return 0
+
+
+class SqliteSink(object):
+    """
+    Stores the samples in a SQLite database. The samples are queued, and
+    inserted by a writer thread once SQLITE_BATCH_SIZE samples are waiting or
+    the oldest waiting sample is SQLITE_BATCH_INTERVAL seconds old.
+    """
+    flush_interval = SQLITE_FLUSH_INTERVAL
+
+    def __init__(self, out_file, cpm_to_usievert=None, batch_size=SQLITE_BATCH_SIZE,
+                 batch_interval=SQLITE_BATCH_INTERVAL, queue_size=SQLITE_QUEUE_SIZE):
+        import sqlite3
+
+        self.out_file = out_file
+        self.cpm_to_usievert = cpm_to_usievert
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.batches = queue.Queue(queue_size)
+        self.written = 0
+        self.transactions = 0
+        self.error = None
+
+        # create the database before recording, so errors are reported at once
+        try:
+            connection = self.connect()
+        except sqlite3.Error as e:
+            raise IOError(str(e))
+        connection.close()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def connect(self):
+        import sqlite3
+
+        connection = sqlite3.connect(self.out_file)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS heartbeat "
+                           "(timestamp REAL NOT NULL, cps INTEGER NOT NULL, flags INTEGER NOT NULL, usievert REAL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS heartbeat_timestamp ON heartbeat (timestamp)")
+        connection.commit()
+        return connection
+
+    def write(self, samples):
+        # never blocks, returns False if the writer thread can't keep up (the
+        # samples are offered again with the next flush)
+        if self.error is not None:
+            return False
+        try:
+            self.batches.put_nowait(list(samples))
+        except queue.Full:
+            return False
+        return True
+
+    def rows(self, samples):
+        rows = []
+        for timestamp, value, flags in samples:
+            if self.cpm_to_usievert is None:
+                usievert = None
+            else:
+                usievert = gq_gmc.convert_cpm_to_usievert(value, 'CPS', self.cpm_to_usievert)[0]
+            rows.append((timestamp, value, flags, usievert))
+        return rows
+
+    def run(self):
+        import sqlite3
+
+        try:
+            connection = self.connect()
+        except sqlite3.Error as e:
+            self.error = e
+            return
+
+        pending = []
+        deadline = None
+        stop = False
+        try:
+            while not stop:
+                try:
+                    if deadline is None:
+                        batch = self.batches.get()
+                    else:
+                        batch = self.batches.get(timeout=max(0, deadline - time.time()))
+                    if batch is None:
+                        stop = True
+                    else:
+                        if deadline is None:
+                            deadline = time.time() + self.batch_interval
+                        pending.extend(self.rows(batch))
+                except queue.Empty:
+                    pass
+
+                if len(pending) > 0 and (stop or len(pending) >= self.batch_size or time.time() >= deadline):
+                    try:
+                        connection.executemany("INSERT INTO heartbeat VALUES (?, ?, ?, ?)", pending)
+                        connection.commit()
+                    except sqlite3.Error as e:
+                        # keep the samples, and try again after the next batch
+                        # interval (not right away, the database is probably
+                        # still locked)
+                        self.error = e
+                        connection.rollback()
+                        if stop:
+                            break
+                        deadline = time.time() + self.batch_interval
+                        continue
+                    self.error = None
+                    self.written += len(pending)
+                    self.transactions += 1
+                    pending = []
+                    deadline = None
+
+        finally:
+            connection.close()
+
+    def close(self):
+        # writes all queued samples
+        self.batches.put(None)
+        self.thread.join()
+        if self.error is not None:
+            print("ERROR: unable to write the heartbeat to '{}' ({})".format(self.out_file, self.error))
+            return -1
+        return 0
+
+
+def open_sink(out_file, cpm_to_usievert=None):
+    # the sink is selected by the extension of the file
+    if os.path.splitext(out_file)[1].lower() in SQLITE_EXTENSIONS:
+        return SqliteSink(out_file, cpm_to_usievert=cpm_to_usievert)
+    return CsvSink(out_file)
+
+
+class HeartbeatRecorder(object):
+    """
+    Records the heartbeat of a device (gq_gmc.GMCDevice) to a sink.
+    """
+
+    def __init__(self, gmc_device, sink, ring_size=RING_SIZE, flush_interval=None):
+        self.gmc_device = gmc_device
+        self.sink = sink
+        if flush_interval is None:
+            flush_interval = sink.flush_interval
+        self.flush_interval = flush_interval
+        self.ring = RingBuffer(ring_size)
+        self.minute = RollingWindow(self.ring, CPM_WINDOW)
+        self.hour = RollingWindow(self.ring, AVERAGE_WINDOW)
+        self.pending = bytearray()
+        self.flushed = 0  # absolute index of the first sample not written to the sink
+        self.dropped = 0  # samples overwritten before they were written to the sink
+
+    def feed(self, data, timestamp):
+        # decode all complete frames in the received data
+        self.pending += bytearray(data)
+        frames = len(self.pending) // FRAME_SIZE
+        for n in range(frames):
+            frame = (self.pending[n * FRAME_SIZE] << 8) + self.pending[n * FRAME_SIZE + 1]
+            self.add(timestamp, frame & VALUE_MASK, frame >> FLAGS_SHIFT)
+        del self.pending[:frames * FRAME_SIZE]
+
+    def add(self, timestamp, value, flags=0):
+        # the sample which is overwritten can't be part of a window anymore
+        oldest = self.ring.total + 1 - self.ring.size
+        self.minute.expire(timestamp, oldest)
+        self.hour.expire(timestamp, oldest)
+        self.ring.append(timestamp, value, flags)
+        self.minute.add(value)
+        self.hour.add(value)
+
+    def cpm(self, now=None):
+        # the CPM of the last minute
+        self.minute.expire(time.time() if now is None else now)
+        return self.minute.cpm()
+
+    def average_cpm(self, now=None):
+        # the average CPM of the last hour
+        self.hour.expire(time.time() if now is None else now)
+        return self.hour.cpm()
+
+    def flush(self):
+        oldest = self.ring.oldest()
+        if oldest > self.flushed:
+            self.dropped += oldest - self.flushed
+            self.flushed = oldest
+        total = self.ring.total
+        if total > self.flushed:
+            # samples which can't be written stay in the ring buffer
+            if not self.sink.write(self.ring.samples(self.flushed, total)):
+                return
+        self.flushed = total
+
+    def record(self, duration=None, status=None, status_interval=FLUSH_INTERVAL):
+        # record until terminated (or the duration in seconds expires), the
+        # status callback is called every status_interval seconds, and when
+        # done
+        device = self.gmc_device
+        start_time = time.time()
+        next_flush = start_time + self.flush_interval
+        next_status = start_time + status_interval
+
+        # signal handlers can only be installed from the main thread
+        if isinstance(threading.current_thread(), threading._MainThread):
+            signal.signal(signal.SIGINT, device.exit_gracefully)
+            signal.signal(signal.SIGTERM, device.exit_gracefully)
+
+        device.transaction('HEARTBEAT1')
+        try:
+            while not device.terminate:
+                data = device.read_reply(max(1, device.device.in_waiting), READ_TIMEOUT)
+                now = time.time()
+                if len(data) > 0:
+                    self.feed(data, now)
+
+                if now >= next_flush:
+                    self.flush()
+                    next_flush = now + self.flush_interval
+
+                if status is not None and now >= next_status:
+                    status(self)
+                    next_status = now + status_interval
+
+                if duration is not None and now - start_time >= duration:
+                    break
+
+        except KeyboardInterrupt:
+            print("")
+        finally:
+            # make sure we stop the heartbeat
+            device.transaction('HEARTBEAT0')
+            device.drain()
+            self.flush()
+            if status is not None:
+                status(self)
+
+
+def format_cpm(cpm, cpm_to_usievert=None):
+    if cpm is None:
+        return '-'
+    value = gq_gmc.convert_cpm_to_usievert(cpm, 'CPM', cpm_to_usievert)
+    if value[1] == 'uSv/h':
+        return '{:.4f} {:s}'.format(value[0], value[1])
+    return '{:.1f} {:s}'.format(value[0], value[1])
+
+
+def record(gmc_device, out_file=DEFAULT_RECORD_FILE, cpm_to_usievert=None, duration=None):
+    # record the heartbeat to a csv file (or SQLite database), showing the
+    # rolling CPM every minute
+    if out_file is None or out_file == '':
+        out_file = DEFAULT_RECORD_FILE
+
+    if gq_gmc.m_verbose >= 1:
+        print("recording heartbeat to '{}', press CTRL-C to stop".format(out_file))
+
+    def status(recorder):
+        if gq_gmc.m_verbose >= 1:
+            print("{} samples, last minute: {}, average of the last hour: {}"
+                  .format(recorder.ring.total, format_cpm(recorder.cpm(), cpm_to_usievert),
+                          format_cpm(recorder.average_cpm(), cpm_to_usievert)))
+
+    try:
+        sink = open_sink(out_file, cpm_to_usievert)
+    except (IOError, OSError) as e:
+        print("ERROR: unable to open '{}' ({})".format(out_file, e))
+        return -1
+
+    try:
+        recorder = HeartbeatRecorder(gmc_device, sink)
+        recorder.record(duration=duration, status=status)
+    finally:
+        res = sink.close()
+
+    if recorder.dropped > 0:
+        print("WARNING: {} samples dropped before they were written".format(recorder.dropped))
+    return res
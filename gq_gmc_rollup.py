@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+"""
+Rollups of the history data per minute, hour and day. The history data of a
+binary file is decoded once, and per bucket the number of samples, the sum,
+minimum and maximum (in CPM, CPS samples are multiplied by 60) and the sum of
+every sample multiplied by its save mode interval (in CPM seconds) are stored
+in a SQLite database next to the binary file ('<file>.rollup'):
+
+    with Rollup('gq-gmc-log.bin') as rollup:
+        rollup.update()
+        for row in rollup.query('hour', start, end, cpm_to_usievert):
+            ...
+
+The position in the binary file and the state of the decoder are stored with
+the buckets. An update only decodes the data added since the previous update
+(e.g. by '--data --sync'), unless the data before this position changed
+(the flash wrapped or was erased), in which case the rollup is rebuild. The
+erased flash after the history data isn't part of the rollup. The dose of a
+bucket (in uSv) is the CPM seconds converted with the CPM to uSv/h factor,
+divided by 3600.
+"""
+
+import os
+import mmap
+import json
+import hashlib
+import calendar
+import datetime
+import gq_gmc
+
+ROLLUP_SUFFIX = '.rollup'
+ROLLUP_VERSION = 1
+FLUSH_BUCKETS = 0x1000  # completed buckets written at once
+
+# level: bucket size in seconds
+LEVELS = {
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400
+}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def get_hash(data, offset):
+    # the hash of the page before an offset, to detect changes of the history
+    # data decoded by a previous update
+    return hashlib.sha1(data[max(0, offset - gq_gmc.FLASH_PAGE_SIZE):offset]).hexdigest()
+
+
+class Buckets(object):
+    """
+    Accumulates runs of samples into the current bucket of every level,
+    completed buckets are merged with the stored ones in batches. A bucket is
+    [level, start, count, sum, minimum, maximum, cpm_seconds], all integers,
+    so the result doesn't depend on how the data is split between updates.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.current = dict((size, None) for size in LEVELS.values())
+        self.completed = []
+        self.latest = {}
+        for size in LEVELS.values():
+            row = connection.execute("SELECT MAX(start) FROM rollup WHERE level = ?", (size,)).fetchone()
+            self.latest[size] = row[0] if row[0] is not None else -1
+
+    def add(self, timestamp, interval, values, factor):
+        # adds the samples of a segment starting at timestamp, every slice of
+        # the samples within a bucket is accumulated at once
+        count = len(values)
+        for size in self.current:
+            if interval >= size and count > 1:
+                # every sample is a bucket of its own
+                cpm = values[0] * factor
+                self._merge(size, timestamp - timestamp % size, 1, cpm, cpm, cpm, cpm * interval)
+                self.completed.append(self.current[size])
+                times = range(timestamp + interval, timestamp + count * interval, interval)
+                buckets = [[size, t - t % size, 1, cpm, cpm, cpm, cpm * interval]
+                           for t, cpm in zip(times, [value * factor for value in values[1:]])]
+                self.current[size] = buckets.pop()
+                self.completed.extend(buckets)
+                continue
+
+            i = 0
+            while i < count:
+                t = timestamp + i * interval
+                start = t - t % size
+                j = min(count, i - (t - start - size) // interval)
+                run = values[i:j]
+                total = sum(run) * factor
+                self._merge(size, start, j - i, total, min(run) * factor, max(run) * factor, total * interval)
+                i = j
+
+        if len(self.completed) >= FLUSH_BUCKETS:
+            self.flush()
+
+    def _merge(self, size, start, count, total, minimum, maximum, cpm_seconds):
+        bucket = self.current[size]
+        if bucket is None or bucket[1] != start:
+            if bucket is not None:
+                self.completed.append(bucket)
+            self.current[size] = [size, start, count, total, minimum, maximum, cpm_seconds]
+            return
+        bucket[2] += count
+        bucket[3] += total
+        bucket[4] = min(bucket[4], minimum)
+        bucket[5] = max(bucket[5], maximum)
+        bucket[6] += cpm_seconds
+
+    def flush(self, final=False):
+        if final:
+            self.completed.extend(bucket for bucket in self.current.values() if bucket is not None)
+            self.current = dict((size, None) for size in LEVELS.values())
+        # only buckets up to the latest stored bucket (e.g. the last bucket of
+        # the previous update, or after the clock was set back) can be stored
+        # already, the others are merged within the batch
+        merged = {}
+        for bucket in self.completed:
+            key = (bucket[0], bucket[1])
+            stored = merged.get(key)
+            if stored is None and bucket[1] <= self.latest[bucket[0]]:
+                row = self.connection.execute("SELECT level, start, count, sum, min, max, cpm_seconds FROM rollup "
+                                              "WHERE level = ? AND start = ?", key).fetchone()
+                if row is not None:
+                    stored = merged[key] = list(row)
+            if stored is None:
+                merged[key] = bucket
+                self.latest[bucket[0]] = max(self.latest[bucket[0]], bucket[1])
+                continue
+            stored[2] += bucket[2]
+            stored[3] += bucket[3]
+            stored[4] = min(stored[4], bucket[4])
+            stored[5] = max(stored[5], bucket[5])
+            stored[6] += bucket[6]
+        self.connection.executemany("INSERT OR REPLACE INTO rollup VALUES (?, ?, ?, ?, ?, ?, ?)", merged.values())
+        self.completed = []
+
+
+class Rollup(object):
+    """
+    The minute, hour and day rollups of a binary history file.
+    """
+
+    def __init__(self, in_file=gq_gmc.DEFAULT_BIN_FILE, rollup_file=None):
+        import sqlite3
+
+        self.in_file = in_file
+        self.rollup_file = rollup_file or in_file + ROLLUP_SUFFIX
+        self.connection = sqlite3.connect(self.rollup_file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS rollup "
+                                "(level INTEGER NOT NULL, start INTEGER NOT NULL, count INTEGER NOT NULL, "
+                                "sum INTEGER NOT NULL, min INTEGER NOT NULL, max INTEGER NOT NULL, "
+                                "cpm_seconds INTEGER NOT NULL, PRIMARY KEY (level, start)) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state (id INTEGER PRIMARY KEY, state TEXT NOT NULL)")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _load_state(self, data):
+        # returns the state of the previous update, or None if the data before
+        # its position changed
+        row = self.connection.execute("SELECT state FROM state WHERE id = 0").fetchone()
+        if row is None:
+            return None
+        try:
+            state = json.loads(row[0])
+        except ValueError:
+            return None
+
+        offset = state.get('offset', -1)
+        if state.get('version') != ROLLUP_VERSION or offset < 0 or offset > len(data):
+            return None
+        if get_hash(data, offset) != state['hash']:
+            return None
+        return state
+
+    def update(self):
+        # decodes the data added since the previous update, returns the number
+        # of decoded bytes
+        with open(self.in_file, 'rb') as f_in:
+            data = b''
+            if os.path.getsize(self.in_file) > 0:
+                data = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return self._update(data, min(gq_gmc.get_history_end(self.in_file), len(data)))
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+
+    def _update(self, data, end):
+        state = self._load_state(data)
+        if state is None:
+            if gq_gmc.m_verbose >= 2:
+                print("building the rollup of '{}'".format(self.in_file))
+            self.connection.execute("DELETE FROM rollup")
+            state = {'offset': 0, 'eof_count': 0, 'segment': None, 'finished': False}
+
+        start = state['offset']
+        if state['finished'] or start >= end:
+            return 0
+
+        decoder = gq_gmc.HistoryDecoder()
+        decoder.offset = start
+        decoder.eof_count = state['eof_count']
+        segment = state['segment']
+        buckets = Buckets(self.connection)
+
+        for pos in range(start, end, gq_gmc.DEFAULT_BLOCK_SIZE):
+            if decoder.finished:
+                break
+
+            for event in decoder.feed(data[pos:min(pos + gq_gmc.DEFAULT_BLOCK_SIZE, end)]):
+                kind = event[0]
+
+                if kind == gq_gmc.EVENT_HEADER:
+                    seg_start = gq_gmc.get_header_time(event[2])
+                    segment = {
+                        'start': None if seg_start is None else calendar.timegm(seg_start.timetuple()),
+                        'interval': gq_gmc.SAVE_MODE_INTERVAL.get(event[3], 0),
+                        'data_type': gq_gmc.get_save_mode(event[3])[0],
+                        'index': 0
+                    }
+                    continue
+                elif kind == gq_gmc.EVENT_SAMPLES:
+                    values = event[2]
+                elif kind == gq_gmc.EVENT_VALUE:
+                    values = [event[2]]
+                else:
+                    continue
+
+                if segment is None:
+                    # samples without a header have no time
+                    continue
+                if segment['start'] is None or segment['interval'] == 0 or segment['data_type'] == '':
+                    segment['index'] += len(values)
+                    continue
+
+                interval = segment['interval']
+                buckets.add(segment['start'] + segment['index'] * interval, interval, values,
+                            60 if segment['data_type'] == 'CPS' else 1)
+                segment['index'] += len(values)
+
+        # continue before a command (or 0x55 value) which isn't complete yet
+        offset = decoder.offset - {0: 0, 0x55: 1, 0x55aa: 2}[decoder.marker]
+        state = {
+            'version': ROLLUP_VERSION,
+            'offset': offset,
+            'hash': get_hash(data, offset),
+            'eof_count': decoder.eof_count,
+            'segment': segment,
+            'finished': decoder.finished
+        }
+
+        buckets.flush(final=True)
+        self.connection.execute("INSERT OR REPLACE INTO state (id, state) VALUES (0, ?)", (json.dumps(state),))
+        self.connection.commit()
+        return offset - start
+
+    def query(self, level, start=None, end=None, cpm_to_usievert=None):
+        # yields (start, samples, mean, minimum, maximum, unit, dose) of the
+        # buckets of a level with start <= bucket start < end, in which start
+        # and end are datetime objects (or None). the values are in CPM (or
+        # uSv/h), the dose in uSv (or None without conversion).
+        sql = "SELECT start, count, sum, min, max, cpm_seconds FROM rollup WHERE level = ?"
+        args = [LEVELS[level]]
+        if start is not None:
+            sql += " AND start >= ?"
+            args.append(calendar.timegm(start.timetuple()))
+        if end is not None:
+            sql += " AND start < ?"
+            args.append(calendar.timegm(end.timetuple()))
+
+        for row in self.connection.execute(sql + " ORDER BY start", args):
+            mean = row[2] / float(row[1])
+            minimum = row[3]
+            maximum = row[4]
+            unit = 'CPM'
+            dose = None
+            if cpm_to_usievert is not None:
+                mean, unit = gq_gmc.convert_cpm_to_usievert(mean, 'CPM', cpm_to_usievert)
+                minimum = gq_gmc.convert_cpm_to_usievert(minimum, 'CPM', cpm_to_usievert)[0]
+                maximum = gq_gmc.convert_cpm_to_usievert(maximum, 'CPM', cpm_to_usievert)[0]
+                dose = gq_gmc.convert_cpm_to_usievert(row[5], 'CPM', cpm_to_usievert)[0] / 3600
+            yield EPOCH + datetime.timedelta(seconds=row[0]), row[1], mean, minimum, maximum, unit, dose
+
+
+def write_rollup(in_file, out_file, level, cpm_to_usievert=None):
+    # updates the rollup of a binary file, and writes the buckets of a level
+    # to a csv file
+    if level not in LEVELS:
+        print("ERROR: unsupported rollup level '{}'".format(level))
+        return -1
+
+    if gq_gmc.m_verbose >= 1:
+        print("updating the rollup of '{}', and storing the {} rollup to '{}'".format(in_file, level, out_file))
+
+    with Rollup(in_file) as rollup:
+        decoded = rollup.update()
+        if gq_gmc.m_verbose >= 2:
+            print("{} bytes decoded".format(decoded))
+
+        with gq_gmc.open_text(out_file) as f_out:
+            lines = []
+            for start, samples, mean, minimum, maximum, unit, dose in rollup.query(level,
+                                                                                  cpm_to_usievert=cpm_to_usievert):
+                if unit == 'uSv/h':
+                    lines.append('{},{:d},{:.4f},{:.4f},{:.4f},{},{:.4f}\n'
+                                 .format(start.strftime('%Y/%m/%d %H:%M:%S'), samples, mean, minimum, maximum,
+                                         unit, dose))
+                else:
+                    lines.append('{},{:d},{:.2f},{:.0f},{:.0f},{},\n'
+                                 .format(start.strftime('%Y/%m/%d %H:%M:%S'), samples, mean, minimum, maximum,
+                                         unit))
+                if len(lines) >= gq_gmc.WRITE_LINES:
+                    f_out.write(''.join(lines))
+                    lines = []
+            f_out.write(''.join(lines))
+    return 0
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+"""
+Statistics of the serial traffic of a device. When the 'stats' attribute of a
+gq_gmc.GMCDevice is set before it's opened, the serial port is wrapped by an
+InstrumentedSerial, which records per command:
+
+- the number of commands sent (batched commands are counted one by one)
+- the bytes sent and received
+- the number of reads, short reads (less bytes than requested) and timeouts
+  (nothing received)
+- a histogram of the read latencies
+
+Reads are accounted to the last command sent. The data discarded after a
+'>>' (clear_port) is accounted to 'drain', the read which ends the drain
+isn't a timeout. A retry is only counted when the device sends a command again
+after a short or failed reply (gq_gmc.GMCDevice.count_retries(), e.g. one per
+SPIR request of a failed batch). Without the 'stats' attribute the serial port
+is used directly, so there is no overhead.
+"""
+
+import json
+import time
+import gq_gmc
+
+# upper bounds of the latency histogram buckets in milliseconds
+HISTOGRAM_BOUNDS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# commands by decreasing length, so 'GETCPM' doesn't match 'GETCPS'
+COMMANDS = sorted(gq_gmc.COMMAND_TABLE.keys(), key=len, reverse=True)
+
+CLEAR = 'clear'
+DRAIN = 'drain'
+
+
+class CommandStats(object):
+    """
+    The statistics of a single command.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.reads = 0
+        self.short_reads = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.read_time = 0.0
+        self.max_latency = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def add_read(self, requested, received, duration):
+        self.reads += 1
+        self.bytes_in += received
+        if received == 0 and requested > 0:
+            self.timeouts += 1
+        elif received < requested:
+            self.short_reads += 1
+        self.read_time += duration
+        self.max_latency = max(self.max_latency, duration)
+
+        ms = duration * 1000
+        for i, bound in enumerate(HISTOGRAM_BOUNDS):
+            if ms <= bound:
+                self.histogram[i] += 1
+                return
+        self.histogram[-1] += 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'reads': self.reads,
+            'short_reads': self.short_reads,
+            'timeouts': self.timeouts,
+            'retries': self.retries,
+            'read_time': self.read_time,
+            'max_latency': self.max_latency,
+            'histogram': [[bound, count] for bound, count in zip(HISTOGRAM_BOUNDS + [None], self.histogram)]
+        }
+
+
+class SerialStats(object):
+    """
+    The statistics of all commands sent to a device.
+    """
+
+    def __init__(self):
+        self.commands = {}
+        self.current = None
+        self.start_time = time.time()
+        self.drained = 0
+
+    def get(self, name):
+        if name not in self.commands:
+            self.commands[name] = CommandStats()
+        return self.commands[name]
+
+    def wrap(self, device):
+        return InstrumentedSerial(device, self)
+
+    def add_write(self, data):
+        data = bytes(bytearray(data))
+        if data.startswith(b'<'):
+            name = '?'
+            for command in COMMANDS:
+                if data.startswith(b'<' + command.encode('ascii')):
+                    name = command
+                    break
+            count = max(1, data.count(b'<' + name.encode('ascii')))
+        else:
+            # the start of clear_port
+            name = CLEAR
+            count = 1
+
+        stats = self.get(name)
+        stats.count += count
+        stats.bytes_out += len(data)
+        self.current = name
+
+    def add_read(self, requested, received, duration):
+        if self.current == DRAIN:
+            # the port is drained until nothing is received
+            self.drained += received
+            requested = received
+        self.get(self.current or '?').add_read(requested, received, duration)
+
+    def add_retry(self, name, count=1):
+        self.get(name).retries += count
+
+    def add_drain(self, discarded):
+        self.current = DRAIN
+        self.drained += discarded
+        self.get(DRAIN).bytes_in += discarded
+
+    def to_dict(self):
+        elapsed = time.time() - self.start_time
+        commands = dict((name, stats.to_dict()) for name, stats in self.commands.items())
+        bytes_in = sum(stats.bytes_in for stats in self.commands.values())
+        bytes_out = sum(stats.bytes_out for stats in self.commands.values())
+        return {
+            'elapsed': elapsed,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'bytes_in_per_s': bytes_in / elapsed if elapsed > 0 else 0.0,
+            'drained': self.drained,
+            'commands': commands
+        }
+
+    def summary(self):
+        result = self.to_dict()
+        lines = ["{:<12s} {:>6s} {:>9s} {:>9s} {:>6s} {:>6s} {:>8s} {:>7s} {:>9s} {:>9s}"
+                 .format('command', 'count', 'bytes out', 'bytes in', 'reads', 'short', 'timeouts', 'retries',
+                         'mean ms', 'max ms')]
+        for name in sorted(self.commands.keys()):
+            stats = self.commands[name]
+            mean = stats.read_time / stats.reads * 1000 if stats.reads > 0 else 0.0
+            lines.append("{:<12s} {:6d} {:9d} {:9d} {:6d} {:6d} {:8d} {:7d} {:9.2f} {:9.2f}"
+                         .format(name, stats.count, stats.bytes_out, stats.bytes_in, stats.reads,
+                                 stats.short_reads, stats.timeouts, stats.retries, mean,
+                                 stats.max_latency * 1000))
+
+        lines.append("")
+        lines.append("read latency histogram (ms):")
+        for name in sorted(self.commands.keys()):
+            buckets = []
+            for bound, count in zip(HISTOGRAM_BOUNDS + [None], self.commands[name].histogram):
+                if count > 0:
+                    buckets.append("{}{}: {}".format('<=' if bound is not None else '>',
+                                                     bound if bound is not None else HISTOGRAM_BOUNDS[-1],
+                                                     count))
+            if buckets:
+                lines.append("{:<12s} {}".format(name, ', '.join(buckets)))
+
+        lines.append("")
+        lines.append("elapsed {:.2f} s, {:d} bytes out, {:d} bytes in ({:.0f} bytes/s), {:d} bytes drained"
+                     .format(result['elapsed'], result['bytes_out'], result['bytes_in'],
+                             result['bytes_in_per_s'], self.drained))
+        return '\n'.join(lines)
+
+    def report(self, out_file=None):
+        # prints a summary, or writes the statistics as JSON to a file
+        if out_file is None or out_file == '':
+            print(self.summary())
+            return
+        with open(out_file, 'w') as f_out:
+            json.dump(self.to_dict(), f_out, indent=4, sort_keys=True, separators=(',', ': '))
+            f_out.write('\n')
+
+
+class InstrumentedSerial(object):
+    """
+    Wraps a serial port (serial.Serial), recording the statistics of all
+    writes and reads. All other attributes are those of the serial port.
+    """
+
+    def __init__(self, device, stats):
+        self.__dict__['_device'] = device
+        self.__dict__['_stats'] = stats
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._device, name, value)
+
+    def write(self, data):
+        self._stats.add_write(data)
+        return self._device.write(data)
+
+    def read(self, size=1):
+        start_time = time.time()
+        data = self._device.read(size)
+        self._stats.add_read(size, len(data), time.time() - start_time)
+        return data
+
+    def readinto(self, buf):
+        start_time = time.time()
+        size = self._device.readinto(buf)
+        self._stats.add_read(len(buf), size or 0, time.time() - start_time)
+        return size
+
+    def reset_input_buffer(self):
+        # only used to drain the port
+        self._stats.add_drain(self._device.in_waiting)
+        return self._device.reset_input_buffer()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+# Ingest benchmark of the heartbeat sinks. Heartbeat frames are fed to the
+# recorder as fast as possible (instead of one per second), and handed over to
+# the sink in batches, like the recorder does while reading a device. The time
+# spent in the read loop (decoding and handing over the samples) and the
+# sustained rate until all samples are stored are shown.
+
+import os
+import sys
+import time
+import struct
+import random
+import argparse
+import tempfile
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..'))
+
+import gq_gmc_recorder
+
+
+def frames(count, seed=0):
+    rnd = random.Random(seed)
+    return b''.join(struct.pack('>H', rnd.randint(0, 50)) for i in range(count))
+
+
+def benchmark(name, sink, samples, chunk):
+    recorder = gq_gmc_recorder.HeartbeatRecorder(None, sink, ring_size=max(gq_gmc_recorder.RING_SIZE, 2 * chunk))
+    data = frames(chunk)
+    timestamp = time.time()
+    loop_time = 0.0
+    worst = 0.0
+
+    start = time.time()
+    for n in range(samples // chunk):
+        before = time.time()
+        recorder.feed(data, timestamp + n)
+        recorder.flush()
+        duration = time.time() - before
+        loop_time += duration
+        worst = max(worst, duration)
+    sink.close()
+    total = time.time() - start
+
+    count = samples // chunk * chunk
+    print("{:<8s} {:8d} samples, read loop {:6.3f} s (worst hand-over {:6.2f} ms), stored in {:6.3f} s, "
+          "{:9.0f} samples/s, {:d} dropped"
+          .format(name, count, loop_time, worst * 1000, total, count / total, recorder.dropped))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='heartbeat sink benchmark')
+    parser.add_argument('--samples', type=int, default=1000000, help='number of samples')
+    parser.add_argument('--chunk', type=int, default=1000, help='samples handed over to the sink at once')
+    parser.add_argument('--batch-size', type=int, default=gq_gmc_recorder.SQLITE_BATCH_SIZE,
+                        help='samples per SQLite transaction')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        csv_file = os.path.join(tmp_dir, 'heartbeat.csv')
+        benchmark('csv', gq_gmc_recorder.CsvSink(csv_file), args.samples, args.chunk)
+
+        db_file = os.path.join(tmp_dir, 'heartbeat.db')
+        sink = gq_gmc_recorder.SqliteSink(db_file, cpm_to_usievert=(1000, 6.5), batch_size=args.batch_size)
+        benchmark('sqlite', sink, args.samples, args.chunk)
+        print("sqlite   {:d} transactions".format(sink.transactions))
+    finally:
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
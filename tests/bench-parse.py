@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+# Throughput (MB/s) and peak memory use (RSS) of the history data parsers, on
+# synthetic history data (see gq_gmc_generator.py) of different sizes. Every
+# run is done in a separate process, so the peak memory use is the one of the
+# run. The results can be stored as JSON, and compared with the results of a
+# previous run:
+#
+#   $ ./bench-parse.py --output baseline.json
+#   $ ./bench-parse.py --baseline baseline.json
+#
+# the second run fails when a parser is more than '--threshold' slower (or
+# uses more memory) than in the baseline.
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..'))
+
+import gq_gmc
+import gq_gmc_generator
+
+PARSERS = {
+    'reference': gq_gmc.parse_data_file,
+    'fast': gq_gmc.parse_data_file_fast
+}
+
+DEFAULT_SIZES = '64K,1M,100M'
+DEFAULT_THRESHOLD = 0.2
+REPEAT_MAX_SIZE = 1 << 20  # larger files are only parsed once
+RSS_MARGIN = 1.0  # MB of peak memory use which is never a regression
+
+
+def peak_rss():
+    # peak memory use of this process in MB
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / float(1 << 20)
+    return rss / 1024.0
+
+
+def run(parser, in_file, out_file):
+    # a single run, in the process started by measure()
+    gq_gmc.set_verbose_level(0)
+    start = time.time()
+    PARSERS[parser](in_file, out_file, cpm_to_usievert=(1000, 6.5))
+    duration = time.time() - start
+    print(json.dumps({'seconds': duration, 'peak_rss_mb': peak_rss()}))
+
+
+def measure(parser, in_file, size, repeat, tmp_dir):
+    out_file = os.path.join(tmp_dir, 'out.csv')
+    best = None
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                          '--run', parser, in_file, out_file])
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    os.remove(out_file)
+
+    return {
+        'parser': parser,
+        'size': size,
+        'seconds': best['seconds'],
+        'mb_per_s': size / float(1 << 20) / best['seconds'],
+        'peak_rss_mb': best['peak_rss_mb']
+    }
+
+
+def compare(results, baseline, threshold):
+    # returns the number of regressions
+    previous = dict(((r['parser'], r['size']), r) for r in baseline['results'])
+    regressions = 0
+    for result in results:
+        key = (result['parser'], result['size'])
+        if key not in previous:
+            continue
+        base = previous[key]
+        if result['mb_per_s'] < base['mb_per_s'] * (1 - threshold):
+            print("REGRESSION: {} {}: {:.2f} MB/s, was {:.2f} MB/s"
+                  .format(result['parser'], result['size'], result['mb_per_s'], base['mb_per_s']))
+            regressions += 1
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + threshold) + RSS_MARGIN:
+            print("REGRESSION: {} {}: peak RSS {:.1f} MB, was {:.1f} MB"
+                  .format(result['parser'], result['size'], result['peak_rss_mb'], base['peak_rss_mb']))
+            regressions += 1
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='history data parser benchmark')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help="comma separated sizes of the history data (default '{}')".format(DEFAULT_SIZES))
+    parser.add_argument('--parsers', default='fast,reference',
+                        help="comma separated parsers: {} (default 'fast,reference')"
+                             .format(', '.join(sorted(PARSERS.keys()))))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of which the best is used, for files up to 1M (default 3)')
+    parser.add_argument('--seed', type=int, default=gq_gmc_generator.DEFAULT_SEED,
+                        help='seed of the generated history data')
+    parser.add_argument('--output', default=None,
+                        help='store the results as JSON')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON results of a previous run, fail on regressions')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed slow down (and memory increase) as a fraction (default {})'
+                             .format(DEFAULT_THRESHOLD))
+    parser.add_argument('--run', nargs=3, default=None, metavar=('PARSER', 'IN_FILE', 'OUT_FILE'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run(*args.run)
+        return 0
+
+    parsers = args.parsers.split(',')
+    for name in parsers:
+        if name not in PARSERS:
+            print("ERROR: unknown parser '{}'".format(name))
+            return 1
+
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for size_str in args.sizes.split(','):
+            size = gq_gmc_generator.parse_size(size_str)
+            in_file = os.path.join(tmp_dir, 'history.bin')
+            gq_gmc_generator.write_history(in_file, size, seed=args.seed)
+
+            for name in parsers:
+                repeat = args.repeat if size <= REPEAT_MAX_SIZE else 1
+                result = measure(name, in_file, size, repeat, tmp_dir)
+                results.append(result)
+                print("{:<10s} {:>6s} {:9.3f} s {:8.2f} MB/s, peak RSS {:7.1f} MB"
+                      .format(name, size_str, result['seconds'], result['mb_per_s'], result['peak_rss_mb']))
+            os.remove(in_file)
+    finally:
+        os.rmdir(tmp_dir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f_out:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'seed': args.seed,
+                       'results': results}, f_out, indent=4, sort_keys=True, separators=(',', ': '))
+            f_out.write('\n')
+
+    if args.baseline is not None:
+        with open(args.baseline) as f_in:
+            baseline = json.load(f_in)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions > 0:
+            print("FAILED: {} regression(s) compared to '{}'".format(regressions, args.baseline))
+            return 1
+        print("OK: no regressions compared to '{}'".format(args.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
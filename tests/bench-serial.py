@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+# Throughput benchmark of the '--data' and '--write-config' commands, and the
+# latency of single commands, using the device emulator instead of a real
+# device.
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOL = os.path.join(TESTS_DIR, '..', 'gq-gmc-control.py')
+sys.path.insert(0, os.path.join(TESTS_DIR, '..'))
+
+import gq_gmc
+import gq_gmc_emulator
+
+
+def run_tool(port, args, home_dir):
+    # the tool doesn't use the cache, and stores its state (and looks for a
+    # daemon) in a temporary home directory instead of the user's
+    cmd = [sys.executable, TOOL, '--port', port, '--verbose', '1', '--no-cache'] + args
+    env = dict(os.environ, HOME=home_dir)
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(cmd, stdout=devnull, env=env)
+    return time.time() - start
+
+
+def benchmark(name, emulator, args, repeat, home_dir):
+    timings = []
+    for i in range(repeat):
+        sent = emulator.bytes_sent
+        received = emulator.bytes_received
+        duration = run_tool(emulator.port, args, home_dir)
+        timings.append((duration, emulator.bytes_sent - sent, emulator.bytes_received - received))
+
+    best = min(timings)
+    print("{:<14s} best {:7.3f} s, {:8d} bytes in, {:6d} bytes out, {:9.0f} bytes/s"
+          .format(name, best[0], best[1], best[2], best[1] / best[0]))
+
+
+def latency(emulator, repeat):
+    device = gq_gmc.GMCDevice()
+    start = time.time()
+    device.open(emulator.port, use_cache=False)
+    print("{:<14s} {:7.1f} ms".format('open', (time.time() - start) * 1000))
+
+    commands = [
+        ('GETVER', device.get_device_type),
+        ('GETSERIAL', device.get_serial_number),
+        ('GETCPM', device.get_cpm),
+        ('GETVOLT', device.get_voltage),
+        ('GETCFG', device.get_config),
+        ('GETDATETIME', device.get_date_and_time)
+    ]
+    for name, command in commands:
+        timings = []
+        for i in range(repeat * 10):
+            start = time.time()
+            command()
+            timings.append(time.time() - start)
+        print("{:<14s} best {:7.1f} ms, mean {:7.1f} ms"
+              .format(name, min(timings) * 1000, sum(timings) * 1000 / len(timings)))
+    device.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput benchmark using the GQ GMC device emulator.')
+    parser.add_argument('-Y', '--device-type', default=gq_gmc_emulator.DEFAULT_MODEL,
+                        help="the emulated device type (default '{}')".format(gq_gmc_emulator.DEFAULT_MODEL))
+    parser.add_argument('-f', '--flash', default=os.path.join(TESTS_DIR, 'test-data.bin'),
+                        help='binary file with the contents of the history flash')
+    parser.add_argument('-b', '--baud-rate', default=115200, type=int,
+                        help='emulated line rate, 0 for as fast as possible (default 115200)')
+    parser.add_argument('-d', '--command-delay', default=0.0, type=float,
+                        help='delay in seconds between receiving a command and sending the response')
+    parser.add_argument('-r', '--repeat', default=3, type=int,
+                        help='number of runs per benchmark (default 3)')
+    args = parser.parse_args()
+
+    with open(args.flash, 'rb') as f_in:
+        flash = f_in.read()
+    byte_delay = 0.0
+    if args.baud_rate > 0:
+        byte_delay = 10.0 / args.baud_rate
+
+    emulator = gq_gmc_emulator.Emulator(model=args.device_type, flash=flash,
+                                        byte_delay=byte_delay, command_delay=args.command_delay)
+    tmp_dir = tempfile.mkdtemp()
+    bin_file = os.path.join(tmp_dir, 'gq-gmc-log.bin')
+
+    try:
+        with emulator:
+            print("emulating {} on '{}' ({} baud, {} s command delay)"
+                  .format(args.device_type, emulator.port, args.baud_rate, args.command_delay))
+            benchmark('--data', emulator, ['--data', '--no-parse', bin_file], args.repeat, tmp_dir)
+            benchmark('--write-config', emulator, ['--write-config', 'cal1-cpm=1000'], args.repeat, tmp_dir)
+            gq_gmc.set_verbose_level(0)
+            latency(emulator, args.repeat)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
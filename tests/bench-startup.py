@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+# Startup time of the commands which don't use a device ('--only-parse',
+# '--list-tool-config' and '--version'). Every command is run in a new
+# process, and the best time (minus the startup time of the bare interpreter)
+# has to stay within the '--budget'. The modules which are only needed for a
+# device (pyserial, SQLite, the http server, ...) may not be imported:
+#
+#   $ ./bench-startup.py
+#   $ ./bench-startup.py --importtime  # the slowest imports (python 3.7+)
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOL = os.path.join(TESTS_DIR, '..', 'gq-gmc-control.py')
+TEST_DATA = os.path.join(TESTS_DIR, 'test-data.bin')
+
+COMMANDS = [
+    ('only-parse', ['--only-parse', TEST_DATA, '{tmp_dir}/test-data.csv']),
+    ('list-tool-config', ['--list-tool-config']),
+    ('version', ['--version'])
+]
+
+# modules which are only imported once a device is used
+DEVICE_MODULES = ['serial', 'sqlite3', 'multiprocessing', 'http.server', 'BaseHTTPServer', 'socketserver',
+                  'SocketServer', 'gq_gmc_daemon', 'gq_gmc_stats', 'gq_gmc_columns']
+
+DEFAULT_BUDGET = 80.0  # ms on top of the startup of the bare interpreter
+DEFAULT_REPEAT = 10
+IMPORTTIME_TOP = 15
+
+# runs the tool, and stores the names of all imported modules afterwards
+MODULES_WRAPPER = '''
+import os, sys, json, runpy
+modules_file, tool = sys.argv[1:3]
+sys.argv = sys.argv[2:]
+sys.path.insert(0, os.path.dirname(os.path.abspath(tool)))
+try:
+    runpy.run_path(tool, run_name='__main__')
+except SystemExit:
+    pass
+with open(modules_file, 'w') as f_out:
+    json.dump(sorted(sys.modules), f_out)
+'''
+
+
+def get_env():
+    # an installed tool starts from compiled modules, so they may be written
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def best_time(cmd, repeat):
+    env = get_env()
+    with open(os.devnull, 'w') as devnull:
+        # the first run compiles the modules (if needed)
+        subprocess.call(cmd, stdout=devnull, stderr=devnull, env=env)
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            subprocess.call(cmd, stdout=devnull, stderr=devnull, env=env)
+            duration = time.time() - start
+            if best is None or duration < best:
+                best = duration
+    return best
+
+
+def imported_modules(args, tmp_dir):
+    modules_file = os.path.join(tmp_dir, 'modules.json')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call([sys.executable, '-c', MODULES_WRAPPER, modules_file, TOOL] + args,
+                        stdout=devnull, stderr=devnull, env=get_env())
+    with open(modules_file) as f_in:
+        return json.load(f_in)
+
+
+def print_importtime(args):
+    # the slowest imports (including the imports they do), as reported by
+    # '-X importtime'
+    if sys.version_info < (3, 7):
+        print("  (-X importtime requires python 3.7 or newer)")
+        return
+
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', TOOL] + args,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=get_env())
+    stderr = process.communicate()[1].decode('utf-8', 'replace')
+    imports = []
+    for line in stderr.splitlines():
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        imports.append((int(fields[1]), fields[2].rstrip()))
+    for cumulative, name in sorted(imports, reverse=True)[:IMPORTTIME_TOP]:
+        print("  {:8.1f} ms {}".format(cumulative / 1000.0, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='startup benchmark of the commands without a device')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='number of runs of which the best is used (default {})'.format(DEFAULT_REPEAT))
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET,
+                        help='allowed startup time in ms, on top of the bare interpreter (default {:.0f})'
+                             .format(DEFAULT_BUDGET))
+    parser.add_argument('--importtime', action='store_true',
+                        help='show the slowest imports of every command')
+    parser.add_argument('--output', default=None,
+                        help='store the results as JSON')
+    args = parser.parse_args()
+
+    interpreter = best_time([sys.executable, '-c', 'pass'], args.repeat)
+    print("{:<18s} {:8.1f} ms".format('python', interpreter * 1000))
+
+    results = []
+    failures = 0
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name, cmd_args in COMMANDS:
+            cmd_args = [arg.format(tmp_dir=tmp_dir) for arg in cmd_args]
+            duration = best_time([sys.executable, TOOL] + cmd_args, args.repeat)
+            startup = (duration - interpreter) * 1000
+            modules = [m for m in DEVICE_MODULES if m in imported_modules(cmd_args, tmp_dir)]
+            results.append({'command': name, 'seconds': duration, 'startup_ms': startup,
+                            'device_modules': modules})
+            print("{:<18s} {:8.1f} ms, startup {:6.1f} ms".format(name, duration * 1000, startup))
+
+            if startup > args.budget:
+                print("FAILED: {} exceeds the startup budget of {:.0f} ms".format(name, args.budget))
+                failures += 1
+            if modules:
+                print("FAILED: {} imports {}".format(name, ', '.join(modules)))
+                failures += 1
+            if args.importtime:
+                print_importtime(cmd_args)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f_out:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'interpreter_seconds': interpreter,
+                       'budget_ms': args.budget,
+                       'results': results}, f_out, indent=4, sort_keys=True, separators=(',', ': '))
+            f_out.write('\n')
+
+    if failures > 0:
+        return 1
+    print("OK: all commands within the startup budget of {:.0f} ms".format(args.budget))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -50,6 +50,59 @@ verify_only_parse()
     fi
 }
 
+verify_only_parse_python3()
+{
+    # the same parse (and result) with python 3, if available
+    if ! command -v python3 > /dev/null; then
+        return
+    fi
+
+    echo -n "testing 'python3 --only-parse test-data.bin test-data-py3.csv': "
+    echo "\$ python3 ${TOOL} --only-parse test-data.bin test-data-py3.csv" >> ${LOG}
+    rm -f test-data-py3.csv
+    python3 ${TOOL} --only-parse test-data.bin test-data-py3.csv >> ${LOG} 2>> ${LOG} && \
+        diff -q test-data-py3.csv test-compare-data.csv >> ${LOG} 2>> ${LOG}
+
+    if [ $? -eq 0 ]; then
+        echo 'OK'
+    else
+        echo 'FAILED'
+        echo 'FAILED' >> ${LOG}
+    fi
+    rm -f test-data-py3.csv
+}
+
+verify_only_parse_format()
+{
+    # without an output file, the file name has the extension of the format
+    FORMAT=$1
+    OUTPUT_FILE=gq-gmc-log.${FORMAT}
+
+    rm -f ${OUTPUT_FILE}
+    verify_pass "--only-parse test-data.bin --format ${FORMAT}"
+
+    if [ ! -s "${OUTPUT_FILE}" ]; then
+        echo "generated ${FORMAT} file missing or empty: FAILED"
+        echo "generated ${FORMAT} file missing or empty: FAILED" >> ${LOG}
+    fi
+    rm -f ${OUTPUT_FILE}
+}
+
+verify_history_log()
+{
+    # the samples (and cached index) of gq_gmc.HistoryLog
+    echo -n "testing 'history-log-tests.py': "
+    echo "\$ ./history-log-tests.py" >> ${LOG}
+    ./history-log-tests.py >> ${LOG} 2>> ${LOG}
+
+    if [ $? -eq 0 ]; then
+        echo 'OK'
+    else
+        echo 'FAILED'
+        echo 'FAILED' >> ${LOG}
+    fi
+}
+
 verify_pass_background()
 {
     ARGS="$@"
@@ -102,6 +155,10 @@ verify_fail "--temperature --gyro"
 verify_fail "--serial --device-info"
 verify_fail "--power-on --power-off"
 verify_fail "--heartbeat --heartbeat-off"
+verify_fail "--heartbeat --record"
+verify_fail "--cpm --rollup hour"
+verify_fail "--data --no-parse --rollup hour"
+verify_fail "--cpm --archive"
 verify_fail ""
 
 verify_pass "--device-info"
@@ -132,14 +189,34 @@ kill -2 ${PID}
 verify_pass "--cpm"  # should fail if the heartbeat is still active
 
 verify_pass "--heartbeat-off"
+
+verify_pass_background "--record gq-gmc-heartbeat-test.csv"
+sleep 5
+kill -2 ${PID}
+verify_pass "--cpm"  # should fail if the heartbeat is still active
+rm -f gq-gmc-heartbeat-test.csv
 verify_pass "--voltage"
 verify_pass "--temperature"
 verify_pass "--gyro"
 
 verify_pass_data_with_file "gq-gmc-test.csv"
 verify_pass_data_with_file "gq-gmc-test.bin" "--no-parse"
+verify_pass_data_with_file "gq-gmc-test.csv" "--sync"
+verify_pass_data_with_file "gq-gmc-test.csv" "--sync"
+verify_pass_data_with_file "gq-gmc-test.csv" "--sync --rollup hour"
+verify_pass_data_with_file "gq-gmc-test.csv" "--archive gq-gmc-test-archive"
+verify_pass "--only-parse `ls gq-gmc-test-archive/manifests/*.manifest | head -n 1` gq-gmc-test.csv"
+rm -rf gq-gmc-test-archive
+# the binary files of the downloads above (and their download information and
+# rollup)
+rm -f gq-gmc-test.bin.info gq-gmc-log.bin gq-gmc-log.bin.info gq-gmc-log.bin.rollup
 
 verify_only_parse
+verify_only_parse_python3
+verify_only_parse_format npz
+verify_history_log
+verify_pass "--only-parse test-data.bin test-data-rollup.csv --rollup minute"
+rm -f test-data-rollup.csv test-data.bin.rollup
 
 verify_pass "--list-config"
 #verify_pass "--write-config"
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (c) 2019, Chaim Zax <chaim.zax@gmail.com>
+
+# The samples of gq_gmc.HistoryLog compared with the rows of
+# 'test-compare-data.csv', for the whole file and for random time ranges. The
+# file is opened twice, the second time the cached index must be used (it's
+# stored in a temporary directory):
+#
+#   $ ./history-log-tests.py
+
+import os
+import sys
+import random
+import shutil
+import datetime
+import tempfile
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_DATA = os.path.join(TESTS_DIR, 'test-data.bin')
+TEST_COMPARE_DATA = os.path.join(TESTS_DIR, 'test-compare-data.csv')
+sys.path.insert(0, os.path.join(TESTS_DIR, '..'))
+
+import gq_gmc
+
+CPM_TO_USIEVERT = (1000, 6.50)  # the conversion of 'test-compare-data.csv'
+RANGES = 50
+SEED = 1
+
+# save mode description: interval between two samples in seconds
+INTERVALS = dict((description, gq_gmc.SAVE_MODE_INTERVAL.get(mode, 0))
+                 for mode, (data_type, description) in gq_gmc.SAVE_MODE.items())
+
+
+def expected_samples():
+    # (timestamp, row) of all samples in the csv file, the time of a sample
+    # follows from the segment header and the sample interval
+    samples = []
+    start = None
+    interval = 0
+    with open(TEST_COMPARE_DATA, 'r') as f_in:
+        for line in f_in:
+            fields = line.rstrip('\n').split(',')
+            if len(fields) == 4 and fields[0] == '' and fields[1] == '':
+                start = datetime.datetime.strptime(fields[2], '%Y/%m/%d %H:%M:%S')
+                interval = INTERVALS.get(fields[3], 0)
+                index = 0
+            elif len(fields) == 2 and start is not None and interval > 0:
+                samples.append((start + datetime.timedelta(seconds=index * interval), line.rstrip('\n')))
+                index += 1
+    return samples
+
+
+def format_sample(value, unit):
+    if unit == 'uSv/h':
+        return '{:.4f},{:s}'.format(value, unit)
+    return '{:d},{:s}'.format(value, unit)
+
+
+def log_samples(log, start=None, end=None):
+    return [(timestamp, format_sample(value, unit))
+            for timestamp, value, unit in log.samples(start, end, cpm_to_usievert=CPM_TO_USIEVERT)]
+
+
+class CachedHistoryLog(gq_gmc.HistoryLog):
+    # fails if the index isn't loaded from the cached index file
+    def _build_index(self):
+        raise AssertionError("the index is built again, instead of loaded from '{}'".format(self.index_file))
+
+
+def check(name, expected, samples):
+    if samples == expected:
+        return 0
+    print("FAILED: {}, {} samples expected, {} received".format(name, len(expected), len(samples)))
+    return 1
+
+
+def main():
+    expected = expected_samples()
+    rnd = random.Random(SEED)
+    ranges = []
+    for i in range(RANGES):
+        first, last = sorted(rnd.sample(range(len(expected)), 2))
+        ranges.append((expected[first][0], expected[last][0]))
+
+    failures = 0
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        index_file = os.path.join(tmp_dir, os.path.basename(TEST_DATA) + gq_gmc.INDEX_SUFFIX)
+        with gq_gmc.HistoryLog(TEST_DATA, index_file=index_file) as log:
+            failures += check('all samples', expected, log_samples(log))
+        if not os.path.isfile(index_file):
+            print("FAILED: no index stored in '{}'".format(index_file))
+            failures += 1
+
+        for log_class in [gq_gmc.HistoryLog, CachedHistoryLog]:
+            with log_class(TEST_DATA, index_file=index_file) as log:
+                for start, end in ranges:
+                    failures += check("{} from {} to {}".format(log_class.__name__, start, end),
+                                      [sample for sample in expected if start <= sample[0] < end],
+                                      log_samples(log, start, end))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if failures > 0:
+        return 1
+    print("OK: {} samples, {} time ranges".format(len(expected), len(ranges)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())